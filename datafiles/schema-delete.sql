@@ -4,4 +4,5 @@
 DELETE FROM generic_backend_connections;
 DELETE FROM sub_connections;
 DELETE FROM service_connections;
+DELETE FROM outbound_messages;
 
@@ -2,6 +2,8 @@
 -- This is mainly for development
 
 DROP TABLE generic_backend_connections;
+DROP FUNCTION generic_backend_set_change_seq();
+DROP TABLE outbound_messages;
 DROP TABLE sub_connections;
 DROP TABLE service_connections;
 DROP TYPE directionality;
@@ -0,0 +1,24 @@
+-- OpenNSA SQL Schema (PostgreSQL) upgrade
+-- Adds the aggregated data plane status counters to service connections,
+-- and computes them for existing connections.
+
+ALTER TABLE service_connections
+    ADD COLUMN sub_connection_count            integer NOT NULL DEFAULT 0,
+    ADD COLUMN data_plane_active_count         integer NOT NULL DEFAULT 0,
+    ADD COLUMN data_plane_max_version          integer NOT NULL DEFAULT 0,
+    ADD COLUMN data_plane_inconsistent_count   integer NOT NULL DEFAULT 0;
+
+UPDATE service_connections sc SET
+    sub_connection_count            = agg.n,
+    data_plane_active_count         = agg.active,
+    data_plane_max_version          = agg.max_version,
+    data_plane_inconsistent_count   = agg.inconsistent
+FROM (
+    SELECT service_connection_id,
+           count(*)                                                   AS n,
+           count(*) FILTER (WHERE data_plane_active)                  AS active,
+           coalesce(max(data_plane_version), 0)                       AS max_version,
+           count(*) FILTER (WHERE data_plane_consistent IS NOT TRUE)  AS inconsistent
+    FROM sub_connections GROUP BY service_connection_id
+) agg
+WHERE sc.id = agg.service_connection_id;
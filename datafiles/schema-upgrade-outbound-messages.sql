@@ -0,0 +1,16 @@
+-- OpenNSA SQL Schema (PostgreSQL) upgrade
+-- Adds the table for the outbound message (callback) queue.
+
+-- callbacks to requesters, which have not been delivered yet (see protocols/shared/outboundqueue.py)
+CREATE TABLE outbound_messages (
+    id                      serial                      PRIMARY KEY,
+    destination             text                        NOT NULL, -- reply to url
+    connection_id           text,                                 -- messages for a connection are delivered in order
+    action                  text                        NOT NULL, -- soap action
+    payload                 text                        NOT NULL,
+    correlation_id          text,
+    requester_nsa           text,
+    provider_nsa            text,
+    created                 timestamp                   NOT NULL,
+    expires                 timestamp                   NOT NULL
+);
@@ -0,0 +1,23 @@
+-- OpenNSA SQL Schema (PostgreSQL) upgrade
+-- Adds the change sequence number to generic backend connections, which is
+-- needed for using a backend snapshot file (the snapshot backend option).
+
+ALTER TABLE generic_backend_connections ADD COLUMN change_seq bigint;
+
+-- change sequence number, set on every insert and update, used for checking backend snapshots
+-- this is the (64 bit, never wrapping) transaction id, a sequence would break lastval() for the inserted id
+CREATE FUNCTION generic_backend_set_change_seq() RETURNS trigger AS $$
+BEGIN
+    NEW.change_seq := txid_current();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER generic_backend_connections_change_seq BEFORE INSERT OR UPDATE ON generic_backend_connections
+    FOR EACH ROW EXECUTE PROCEDURE generic_backend_set_change_seq();
+
+-- number existing connections
+UPDATE generic_backend_connections SET change_seq = change_seq;
+ALTER TABLE generic_backend_connections ALTER COLUMN change_seq SET NOT NULL;
+
+CREATE INDEX generic_backend_connections_change_seq_idx ON generic_backend_connections (change_seq);
@@ -47,6 +47,11 @@ CREATE TABLE service_connections (
     parameter               parameter[],
     security_attributes     security_attribute[],
     connection_trace        text[],
+    -- aggregated data plane status, maintained by the aggregator when sub connections change
+    sub_connection_count            integer             NOT NULL DEFAULT 0,
+    data_plane_active_count         integer             NOT NULL DEFAULT 0,
+    data_plane_max_version          integer             NOT NULL DEFAULT 0,
+    data_plane_inconsistent_count   integer             NOT NULL DEFAULT 0, -- consistent flag false or null
     CHECK ( start_time < end_time)
 );
 
@@ -74,6 +79,21 @@ CREATE TABLE sub_connections (
 );
 
 
+-- callbacks to requesters, which have not been delivered yet (see protocols/shared/outboundqueue.py)
+CREATE TABLE outbound_messages (
+    id                      serial                      PRIMARY KEY,
+    destination             text                        NOT NULL, -- reply to url
+    connection_id           text,                                 -- messages for a connection are delivered in order
+    action                  text                        NOT NULL, -- soap action
+    payload                 text                        NOT NULL,
+    correlation_id          text,
+    requester_nsa           text,
+    provider_nsa            text,
+    created                 timestamp                   NOT NULL,
+    expires                 timestamp                   NOT NULL
+);
+
+
 -- move this into the backend sometime
 CREATE TABLE generic_backend_connections (
     id                      serial                      PRIMARY KEY,
@@ -100,9 +120,24 @@ CREATE TABLE generic_backend_connections (
     bandwidth               integer                     NOT NULL, -- mbps
     parameter               parameter[],
     allocated               boolean                     NOT NULL, -- indicated if the resources are actually allocated
+    change_seq              bigint                      NOT NULL, -- set by trigger below
     CHECK ( start_time < end_time)
 );
 
+-- change sequence number, set on every insert and update, used for checking backend snapshots
+-- this is the (64 bit, never wrapping) transaction id, a sequence would break lastval() for the inserted id
+CREATE FUNCTION generic_backend_set_change_seq() RETURNS trigger AS $$
+BEGIN
+    NEW.change_seq := txid_current();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER generic_backend_connections_change_seq BEFORE INSERT OR UPDATE ON generic_backend_connections
+    FOR EACH ROW EXECUTE PROCEDURE generic_backend_set_change_seq();
+
+CREATE INDEX generic_backend_connections_change_seq_idx ON generic_backend_connections (change_seq);
+
 
 -- Force this to only have a single row
 -- generate new id with:
@@ -4,20 +4,35 @@ Connection abstraction.
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2012)
 """
+import time
 import datetime
 
 from zope.interface import implements
 
-from twisted.python import log
+from twisted.python import log, failure
 from twisted.internet import defer
 
 from opennsa.interface import INSIProvider, INSIRequester
 from opennsa import error, nsa, state, database, constants as cnt
+from opennsa.shared import identitycache
 
 
 
 LOG_SYSTEM = 'Aggregator'
 
+# number of candidate paths to try for a connection before giving up
+MAX_PATH_CANDIDATES = 3
+
+# seconds between logging the orm cache statistics
+CACHE_STATS_INTERVAL = 900
+
+# seconds to wait for the terminateConfirmed of a sub connection from an abandoned path
+ABANDONED_TERMINATE_TIMEOUT = 600
+
+# connection states where an operation is in progress, connections in these are never evicted from the orm cache
+TRANSIENT_STATES = ( state.RESERVE_CHECKING, state.RESERVE_COMMITTING, state.RESERVE_ABORTING,
+                     state.PROVISIONING, state.RELEASING, state.TERMINATING )
+
 
 
 def shortLabel(label):
@@ -46,6 +61,15 @@ def _logErrorResponse(err, connection_id, provider_nsa, action):
 
 
 
+def _connectionInFlight(conn):
+    return conn.reservation_state in TRANSIENT_STATES or conn.provision_state in TRANSIENT_STATES or conn.lifecycle_state in TRANSIENT_STATES
+
+
+def _connectionTerminated(conn):
+    return conn.lifecycle_state == state.TERMINATED
+
+
+
 def _createAggregateException(connection_id, action, results, provider_urns, default_error=error.InternalServerError):
 
     failures = [ conn for success,conn in results if not success ]
@@ -63,6 +87,52 @@ def _createAggregateException(connection_id, action, results, provider_urns, def
 
 
 
+QUERY_SUMMARY_SQL = '''
+SELECT connection_id, revision, global_reservation_id, description, requester_nsa,
+       reservation_state, provision_state, lifecycle_state,
+       source_network, source_port, source_label, dest_network, dest_port, dest_label,
+       start_time, end_time, bandwidth,
+       sub_connection_count, data_plane_active_count, data_plane_max_version, data_plane_inconsistent_count
+FROM service_connections sc
+WHERE %s
+ORDER BY id
+'''
+
+
+
+def _updateDataPlaneCounters(conn, sub_conn, sign):
+    # add (sign 1) or remove (sign -1) the data plane status of a sub connection in the connection counters
+    # new sub connections do not have the version and consistent attributes until they are set
+    conn.data_plane_active_count        += sign * int(bool(sub_conn.data_plane_active))
+    conn.data_plane_inconsistent_count  += sign * int(getattr(sub_conn, 'data_plane_consistent', None) is not True)
+    if sign > 0:
+        # versions only increase, so the max can be kept without looking at the other sub connections
+        conn.data_plane_max_version = max(conn.data_plane_max_version, getattr(sub_conn, 'data_plane_version', None) or 0)
+
+
+
+class ConnectionInfoRows(object):
+    """
+    Iterable of ConnectionInfo objects, created from query rows while
+    iterating. All the rows are fetched and kept in memory, and the query
+    response is built in full from them, so this does not bound the memory
+    use of a query. It only avoids keeping a ConnectionInfo object for each
+    row next to the response. There is no indexing, as every iteration
+    creates new objects.
+    """
+    def __init__(self, rows, build):
+        self.rows = rows
+        self.build = build
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        for row in self.rows:
+            yield self.build(row)
+
+
+
 class Aggregator:
 
     implements(INSIProvider, INSIRequester)
@@ -79,11 +149,15 @@ class Aggregator:
         self.plugin             = plugin
 
         self.reservations       = {} # correlation_id -> info
+        self.path_candidates    = {} # service connection key -> candidate path state, while the connection is being reserved
+        self.abandoned_sub_connections = {} # ( provider_nsa, connection_id ) -> abandon time, for sub connections from failed path candidates
+        self.loaded_ports       = {} # service connection key -> demarc port, for connections counted in the port load
         self.notification_id    = 0
+        self.reported_lookups   = 0 # cache lookups at last stats report
 
         # db orm cache, needed to avoid concurrent updates stepping on each other
-        self.db_connections = {}
-        self.db_sub_connections = {}
+        self.db_connections     = identitycache.IdentityCache(in_flight=_connectionInFlight, final=_connectionTerminated)
+        self.db_sub_connections = identitycache.IdentityCache(in_flight=_connectionInFlight, final=_connectionTerminated)
 
         # these are for query recursive, due to nsi being extremely crappy design
         self.query_requests = {}
@@ -96,6 +170,22 @@ class Aggregator:
         return nid
 
 
+    def cacheStats(self):
+        return { 'connections': self.db_connections.stats(), 'sub_connections': self.db_sub_connections.stats() }
+
+
+    def logCacheStats(self):
+        stats = self.cacheStats()
+        lookups = sum( s['hits'] + s['misses'] for s in stats.values() )
+        if lookups == self.reported_lookups:
+            return # nothing happened since last report
+        self.reported_lookups = lookups
+        for name in ('connections', 'sub_connections'):
+            s = stats[name]
+            log.msg('Cache %s: size: %i, hits: %i, misses: %i, evictions: %i, hit rate: %.2f' % \
+                    (name, s['size'], s['hits'], s['misses'], s['evictions'], s['hit_rate']), system=LOG_SYSTEM)
+
+
     def getProvider(self, nsi_agent_urn):
         return self.provider_registry.getProvider(nsi_agent_urn)
 
@@ -108,11 +198,11 @@ class Aggregator:
             # we should get 0 or 1 here since connection id is unique
             if len(connections) == 0:
                 return defer.fail( error.ConnectionNonExistentError('No connection with id %s' % connection_id) )
-            self.db_connections[connection_id] = connections[0]
-            return connections[0]
+            return self.db_connections.add(connection_id, connections[0])
 
-        if connection_id in self.db_connections:
-            return defer.succeed(self.db_connections[connection_id])
+        conn = self.db_connections.get(connection_id)
+        if conn is not None:
+            return defer.succeed(conn)
 
         d = database.ServiceConnection.findBy(connection_id=connection_id)
         d.addCallback(gotResult)
@@ -139,32 +229,28 @@ class Aggregator:
             # we should get 0 or 1 here since provider_nsa + connection id is unique
             if len(connections) == 0:
                 return defer.fail( error.ConnectionNonExistentError('No sub connection with connection id %s at provider %s' % (connection_id, provider_nsa) ) )
-            self.db_sub_connections[connection_id] = connections[0]
-            return connections[0]
+            return self.db_sub_connections.add(connection_id, connections[0])
 
-        if connection_id in self.db_sub_connections:
-            return defer.succeed(self.db_sub_connections[connection_id])
+        sub_conn = self.db_sub_connections.get(connection_id)
+        if sub_conn is not None:
+            return defer.succeed(sub_conn)
 
         d = database.SubConnection.findBy(provider_nsa=provider_nsa, connection_id=connection_id)
         d.addCallback(gotResult)
         return d
 
 
-    def getSubConnectionsByConnectionKey(self, service_connection_key):
-
-        def gotResult(rows):
-            def gotSubConns(results):
-                if all( [ r[0] for r in results ] ):
-                    return [ r[1] for r in results ]
-                else:
-                    return defer.fail( ValueError('Error retrieving one or more subconnections: %s' % str(results)) )
+    def _cacheSubConnections(self, sub_connections):
+        # use the cached instance for sub connections which are already loaded, so there is only one instance of each
+        return [ self.db_sub_connections.add(sc.connection_id, sc) for sc in sub_connections ]
 
-            defs = [ self.getSubConnection(r['provider_nsa'], r['connection_id']) for r in rows ]
-            return defer.DeferredList(defs).addCallback(gotSubConns)
 
-        dbconfig = database.Registry.getConfig()
-        d = dbconfig.select('sub_connections', where=['service_connection_id = ?', service_connection_key], select='provider_nsa, connection_id')
-        d.addCallback(gotResult)
+    def getSubConnectionsByConnectionKey(self, service_connection_key):
+        """
+        Returns the sub connections of a service connection, loaded in a single query.
+        """
+        d = database.SubConnection.find(where=['service_connection_id = ?', service_connection_key], orderby='order_id')
+        d.addCallback(self._cacheSubConnections)
         return d
 
 
@@ -245,8 +331,10 @@ class Aggregator:
                             dest_network=dest_stp.network, dest_port=dest_stp.port, dest_label=dest_stp.label,
                             start_time=criteria.schedule.start_time, end_time=criteria.schedule.end_time,
                             symmetrical=sd.symmetric, directionality=sd.directionality, bandwidth=sd.capacity,
-                            security_attributes=header.security_attributes, connection_trace=header.connection_trace)
+                            security_attributes=header.security_attributes, connection_trace=header.connection_trace,
+                            sub_connection_count=0, data_plane_active_count=0, data_plane_max_version=0, data_plane_inconsistent_count=0)
         yield conn.save()
+        conn = self.db_connections.add(conn.connection_id, conn)
 
         # Here we should return / callback and spawn off the path creation
 
@@ -311,25 +399,26 @@ class Aggregator:
                 local_stp      = dest_stp
                 remote_stp     = source_stp
 
-            # we should really find multiple port/link vectors to the remote network, but right now we don't
-            vector_port = self.route_vectors.vector(remote_stp.network)
-            if vector_port is None:
+            vector_ports = self.route_vectors.vectors(remote_stp.network, MAX_PATH_CANDIDATES)
+            if not vector_ports:
                 raise error.STPResolutionError('No vector to network %s, cannot create circuit' % remote_stp.network)
 
-            log.msg('Vector to %s via port %s' % (remote_stp.network, vector_port), system=LOG_SYSTEM)
+            log.msg('Vectors to %s via port(s) %s' % (remote_stp.network, ', '.join(vector_ports)), system=LOG_SYSTEM)
 
-            # this really shouldn't fail, so we don't need to check
-            demarc_ports = [ self.network_topology.getPort( self.network + ':' + vector_port ) ]
+            # one candidate path per demarc port, cheapest first
+            paths = []
+            for vector_port in vector_ports:
+                # this really shouldn't fail, so we don't need to check
+                ldp = self.network_topology.getPort( self.network + ':' + vector_port )
 
-            ldp = demarc_ports[0] # most of the time we will only have one anyway, should iterate and build multiple paths
+                local_demarc_port  = ldp.id_.rsplit(':', 1)[1]
+                remote_demarc_network, remote_demarc_port = ldp.remote_port.rsplit(':', 1) # [1] # this is wrong in the new naming scheme
 
-            local_demarc_port  = ldp.id_.rsplit(':', 1)[1]
-            remote_demarc_network, remote_demarc_port = ldp.remote_port.rsplit(':', 1) # [1] # this is wrong in the new naming scheme
+                local_link  = nsa.Link( local_stp, nsa.STP(local_stp.network, local_demarc_port, ldp.label()) )
+                remote_link = nsa.Link( nsa.STP(remote_demarc_network, remote_demarc_port, ldp.label()), remote_stp) # # the ldp label isn't quite correct
 
-            local_link  = nsa.Link( local_stp, nsa.STP(local_stp.network, local_demarc_port, ldp.label()) )
-            remote_link = nsa.Link( nsa.STP(remote_demarc_network, remote_demarc_port, ldp.label()), remote_stp) # # the ldp label isn't quite correct
+                paths.append( [ local_link, remote_link ] )
 
-            paths = [ [ local_link, remote_link ] ]
             paths = yield self.plugin.prunePaths(paths)
 
         elif cnt.AGGREGATOR in self.policies:
@@ -342,34 +431,133 @@ class Aggregator:
             raise error.ConnectionCreateError('None of the endpoints terminate in the network, rejecting request (network: %s + %s, nsa network %s)' %
                 (source_stp.network, dest_stp.network, self.network))
 
+        # only use the paths we have providers for
+        candidate_paths = []
+        resolution_errors = []
+        for path in paths:
+            try:
+                for link in path:
+                    if link.src_stp.network != self.network: # we got the local ones..
+                        self.provider_registry.getProviderByNetwork(link.src_stp.network)
+                candidate_paths.append(path)
+            except error.STPResolutionError as e:
+                log.msg('Skipping candidate path: %s' % e, system=LOG_SYSTEM)
+                resolution_errors.append(e)
+
+        if not candidate_paths:
+            if resolution_errors:
+                raise resolution_errors[0]
+            raise error.ConnectionCreateError('No paths to create connection through')
 
-        selected_path = paths[0] # shortest path (legacy structure)
-        log_path = ' -> '.join( [ str(p) for p in selected_path ] )
-        log.msg('Attempting to create path %s' % log_path, system=LOG_SYSTEM)
+        conn_trace = (header.connection_trace or []) + [ self.nsa_.urn() + ':' + conn.connection_id ]
 
-        for link in selected_path:
-            if link.src_stp.network == self.network:
-                continue # we got this..
-            p = self.provider_registry.getProviderByNetwork(link.src_stp.network)
-            if p is None:
-                raise error.ConnectionCreateError('No provider for network %s. Cannot create link.' % link.src_stp.network)
+        # kept until the connection is reserve held, so the next candidate can be tried if a reserveFailed arrives
+        self.path_candidates[conn.id] = { 'header'       : header,
+                                          'criteria'     : criteria,
+                                          'request_info' : request_info,
+                                          'conn_trace'   : conn_trace,
+                                          'paths'        : candidate_paths,
+                                          'attempt'      : 0,
+                                          'results'      : [],
+                                          'provider_urns': [] }
+
+        err = yield self._reserveCandidatePaths(conn)
+        if err is not None:
+            # I think this is out of spec, the aggregator shouldn't do anything here...
+            # the sub connections of the candidates have been terminated, switch state
+            yield state.terminating(conn)
+            yield state.terminated(conn)
+            raise err
 
-        conn_trace = (header.connection_trace or []) + [ self.nsa_.urn() + ':' + conn.connection_id ]
+        defer.returnValue(connection_id)
+
+
+    @defer.inlineCallbacks
+    def _reserveCandidatePaths(self, conn):
+        """
+        Reserves the remaining candidate paths of a connection in order, until
+        one of them is acked by all providers. The sub connections of failed
+        candidates are terminated. Returns None if a path was acked, otherwise
+        an error for all the failed attempts.
+        """
+        candidates = self.path_candidates[conn.id]
+
+        while candidates['paths']:
+
+            path = candidates['paths'].pop(0)
+            attempt = candidates['attempt']
+            candidates['attempt'] += 1
+
+            log_path = ' -> '.join( [ str(p) for p in path ] )
+            log.msg('Attempting to create path %s (candidate %i/%i)' % (log_path, attempt+1, attempt+1+len(candidates['paths'])), system=LOG_SYSTEM)
+
+            # a reserveFailed can arrive before all providers have acked, it is kept in failures
+            candidates['failures'] = []
+            results, conn_info = yield self._reservePath(candidates['header'], conn, candidates['criteria'], candidates['request_info'],
+                                                         path, candidates['conn_trace'], attempt)
+            failures = candidates.pop('failures')
+            successes = [ r[0] for r in results ]
+
+            if all(successes) and not failures:
+                log.msg('Connection %s: Reserve acked' % conn.connection_id, system=LOG_SYSTEM)
+                candidates['reserving'] = (path, results, conn_info)
+                self._addPathLoad(conn, path)
+                defer.returnValue(None)
+
+            candidates['results'] += results + [ (False, failure.Failure(err)) for _, err in failures ]
+            candidates['provider_urns'] += [ ci[1] for ci in conn_info ] + [ provider_urn for provider_urn, _ in failures ]
+
+            if candidates['paths']:
+                log.msg('Connection %s: Reserve failed for candidate path %i, trying next candidate' % (conn.connection_id, attempt+1), system=LOG_SYSTEM)
+            # currently we don't try and be too clever about cleaning, just do it
+            yield self._abandonPath(candidates['header'], conn, results, conn_info)
+
+        self.path_candidates.pop(conn.id, None)
+
+        # construct provider nsa urns, so we can produce a good error message
+        err = _createAggregateException(conn.connection_id, 'reservations', candidates['results'], candidates['provider_urns'], error.ConnectionCreateError)
+        defer.returnValue(err)
+
+
+    def _addPathLoad(self, conn, path):
+        # local link goes to the demarc port, count it, so connections are spread over equal cost ports
+        if len(path) > 1 and path[0].src_stp.network == self.network:
+            self._removePathLoad(conn)
+            self.loaded_ports[conn.id] = path[0].dst_stp.port
+            self.route_vectors.addPortLoad(path[0].dst_stp.port, 1)
+
+
+    def _removePathLoad(self, conn):
+        # called on every way a connection can end, only the first call after the load was added counts
+        port = self.loaded_ports.pop(conn.id, None)
+        if port is not None:
+            self.route_vectors.addPortLoad(port, -1)
+
+
+    def _reservePath(self, header, conn, criteria, request_info, path, conn_trace, attempt):
+        """
+        Sends reserve requests for each link in the path. Returns the results
+        of the requests (as a DeferredList) and a list of ( deferred,
+        provider urn, correlation id ) for each link.
+        """
+        sd = criteria.service_def
         conn_info = []
 
-        for idx, link in enumerate(selected_path):
+        for idx, link in enumerate(path):
 
             sub_connection_id = None
 
             if link.src_stp.network == self.network:
                 provider_urn = self.nsa_.urn()
-                sub_connection_id = connection_id
+                if attempt == 0:
+                    # make it seem like the aggregator isn't here, the id can only be used once though
+                    sub_connection_id = conn.connection_id
             else:
                 provider_urn = self.provider_registry.getProviderByNetwork(link.src_stp.network)
 
             c_header = nsa.NSIHeader(self.nsa_.urn(), provider_urn, security_attributes=header.security_attributes, connection_trace=conn_trace)
 
-            sd = nsa.Point2PointService(link.src_stp, link.dst_stp, conn.bandwidth, sd.directionality, sd.symmetric)
+            link_sd = nsa.Point2PointService(link.src_stp, link.dst_stp, conn.bandwidth, sd.directionality, sd.symmetric)
 
             # save info for db saving
             self.reservations[c_header.correlation_id] = {
@@ -381,51 +569,77 @@ class Aggregator:
                                                         'dest_network'   : link.dst_stp.network,
                                                         'dest_port'      : link.dst_stp.port }
 
-            crt = nsa.Criteria(criteria.revision, criteria.schedule, sd)
+            crt = nsa.Criteria(criteria.revision, criteria.schedule, link_sd)
 
             provider = self.getProvider(provider_urn)
             # note: request info will only be passed to local backends, remote requester will just ignore it
             d = provider.reserve(c_header, sub_connection_id, conn.global_reservation_id, conn.description, crt, request_info)
-            d.addErrback(_logErrorResponse, connection_id, provider_urn, 'reserve')
+            d.addErrback(_logErrorResponse, conn.connection_id, provider_urn, 'reserve')
 
-            conn_info.append( (d, provider_urn) )
+            conn_info.append( (d, provider_urn, c_header.correlation_id) )
 
             # Don't bother trying to save connection here, wait for reserveConfirmed
 
+        d = defer.DeferredList( [ c[0] for c in conn_info ], consumeErrors=True) # doesn't errback
+        d.addCallback(lambda results : (results, conn_info) )
+        return d
 
-        results = yield defer.DeferredList( [ c[0] for c in conn_info ], consumeErrors=True) # doesn't errback
-        successes = [ r[0] for r in results ]
 
-        if all(successes):
-            log.msg('Connection %s: Reserve acked' % conn.connection_id, system=LOG_SYSTEM)
-            defer.returnValue(connection_id)
+    @defer.inlineCallbacks
+    def _abandonPath(self, header, conn, results, conn_info):
+        # terminates the sub connections of a path which could not be reserved in full
 
-        else:
-            # I think this is out of spec, the aggregator shouldn't do anything here...
-            # terminate non-failed connections
-            # currently we don't try and be too clever about cleaning, just do it, and switch state
-            yield state.terminating(conn)
-            defs = []
-            reserved_connections = [ (sc_id, provider_urn) for (success,sc_id),(_,provider_urn) in zip(results, conn_info) if success ]
-            for (sc_id, provider_urn) in reserved_connections:
+        # confirmations for the reserved sub connections can still arrive, they are ignored
+        for (success, _), (_, _, correlation_id) in zip(results, conn_info):
+            if success and correlation_id in self.reservations:
+                self.reservations[correlation_id]['abandoned'] = True
+            else:
+                self.reservations.pop(correlation_id, None)
 
-                provider = self.getProvider(provider_urn)
-                t_header = nsa.NSIHeader(self.nsa_.urn(), provider_urn, security_attributes=header.security_attributes)
+        reserved_connections = [ (sc_id, provider_urn) for (success,sc_id),(_,provider_urn,_) in zip(results, conn_info) if success ]
 
-                d = provider.terminate(t_header, sc_id)
-                d.addCallbacks(
-                    lambda c : log.msg('Succesfully terminated sub connection %s at %s after partial reservation failure.' % (sc_id, provider_urn) , system=LOG_SYSTEM),
-                    lambda f : log.msg('Error terminating connection after partial-reservation failure: %s' % str(f), system=LOG_SYSTEM)
-                )
-                defs.append(d)
-            dl = defer.DeferredList(defs)
-            yield dl
-            yield state.terminated(conn)
+        # sub connections which a reserveConfirmed is still saving are removed by it, when it sees the abandoned mark
+        confirming = [ (sc_id, provider_urn) for (success,sc_id),(_,provider_urn,correlation_id) in zip(results, conn_info)
+                       if success and self.reservations.get(correlation_id, {}).get('confirming') ]
 
-            # construct provider nsa urns, so we can produce a good error message
-            provider_urns = [ ci[1] for ci in conn_info ]
-            err = _createAggregateException(connection_id, 'reservations', results, provider_urns, error.ConnectionCreateError)
-            raise err
+        # a reserveConfirmed can have arrived before the path was abandoned, remove the sub connections it created
+        sub_conns = yield self.getSubConnectionsByConnectionKey(conn.id)
+        abandoned = [ sc for sc in sub_conns if (sc.connection_id, sc.provider_nsa) in reserved_connections and not (sc.connection_id, sc.provider_nsa) in confirming ]
+        if abandoned:
+            for sc in abandoned:
+                conn.sub_connection_count -= 1
+                _updateDataPlaneCounters(conn, sc, -1)
+                self.db_sub_connections.remove(sc.connection_id)
+                yield sc.delete()
+            yield conn.save()
+
+        def terminated(_, sc_id, provider_urn):
+            log.msg('Succesfully terminated sub connection %s at %s after partial reservation failure.' % (sc_id, provider_urn) , system=LOG_SYSTEM)
+
+        def terminateFailed(f, sc_id, provider_urn):
+            log.msg('Error terminating connection after partial-reservation failure: %s' % str(f), system=LOG_SYSTEM)
+            self.abandoned_sub_connections.pop( (provider_urn, sc_id), None)
+
+        # forget the sub connections for which a terminateConfirmed never arrived
+        now = time.time()
+        for key, abandon_time in self.abandoned_sub_connections.items():
+            if now - abandon_time > ABANDONED_TERMINATE_TIMEOUT:
+                del self.abandoned_sub_connections[key]
+
+        defs = []
+        for (sc_id, provider_urn) in reserved_connections:
+
+            # the terminateConfirmed is not for any of our sub connections
+            self.abandoned_sub_connections[ (provider_urn, sc_id) ] = now
+
+            provider = self.getProvider(provider_urn)
+            t_header = nsa.NSIHeader(self.nsa_.urn(), provider_urn, security_attributes=header.security_attributes)
+
+            d = provider.terminate(t_header, sc_id)
+            d.addCallbacks(terminated, terminateFailed, callbackArgs=(sc_id, provider_urn), errbackArgs=(sc_id, provider_urn))
+            defs.append(d)
+
+        yield defer.DeferredList(defs)
 
 
     @defer.inlineCallbacks
@@ -479,6 +693,7 @@ class Aggregator:
             raise error.ConnectionGoneError('Connection %s has been terminated' % connection_id)
 
         yield state.reserveAbort(conn)
+        self._removePathLoad(conn)
 
         save_defs = []
         defs = []
@@ -608,6 +823,9 @@ class Aggregator:
             defer.returnValue(connection_id) # all good
 
         yield state.terminating(conn)
+        self.path_candidates.pop(conn.id, None)
+        # the terminateConfirmed messages might never arrive, so the load is removed here
+        self._removePathLoad(conn)
 
         defs = []
         sub_connections = yield self.getSubConnectionsByConnectionKey(conn.id)
@@ -642,39 +860,17 @@ class Aggregator:
 
         try:
             if connection_ids:
-                conns = yield database.ServiceConnection.find(where=['requester_nsa = ? AND connection_id IN ?', header.requester_nsa, tuple(connection_ids) ] )
+                where, args = 'sc.requester_nsa = %s AND sc.connection_id = ANY(%s)', (header.requester_nsa, list(connection_ids))
             elif global_reservation_ids:
-                conns = yield database.ServiceConnection.find(where=['requester_nsa = ? AND global_reservation_ids IN ?', header.requester_nsa, tuple(global_reservation_ids) ] )
+                where, args = 'sc.requester_nsa = %s AND sc.global_reservation_id = ANY(%s)', (header.requester_nsa, list(global_reservation_ids))
             else:
-                conns = yield database.ServiceConnection.find(where=['requester_nsa = ?', header.requester_nsa ] )
-
-            # largely copied from genericbackend, merge later
-            reservations = []
-            for c in conns:
-
-                source_stp  = nsa.STP(c.source_network, c.source_port, c.source_label)
-                dest_stp    = nsa.STP(c.dest_network, c.dest_port, c.dest_label)
-                schedule    = nsa.Schedule(c.start_time, c.end_time)
-                sd          = nsa.Point2PointService(source_stp, dest_stp, c.bandwidth, cnt.BIDIRECTIONAL, False, None)
-                criteria    = nsa.QueryCriteria(c.revision, schedule, sd)
-
-                sub_conns = yield self.getSubConnectionsByConnectionKey(c.id)
-                if len(sub_conns) == 0: # apparently this can happen
-                    data_plane_status = (False, 0, False)
-                else:
-                    aggr_active     = all( [ sc.data_plane_active     for sc in sub_conns ] )
-                    aggr_version    = max( [ sc.data_plane_version    for sc in sub_conns ] ) or 0 # can be None otherwise
-                    aggr_consistent = all( [ sc.data_plane_consistent for sc in sub_conns ] )
-                    data_plane_status = (aggr_active, aggr_version, aggr_consistent)
-
-                states = (c.reservation_state, c.provision_state, c.lifecycle_state, data_plane_status)
-                notification_id = self.getNotificationId()
-                result_id = 0
-
-                ci = nsa.ConnectionInfo(c.connection_id, c.global_reservation_id, c.description, cnt.EVTS_AGOLE, [ criteria ],
-                                        self.nsa_.urn(), c.requester_nsa, states, notification_id, result_id)
-                reservations.append(ci)
+                where, args = 'sc.requester_nsa = %s', (header.requester_nsa,)
+
+            # the aggregated data plane status is kept on the service connections, so the sub connections are not needed
+            rows = yield database.Registry.DBPOOL.runQuery(QUERY_SUMMARY_SQL % where, args)
 
+            log.msg('QuerySummary: %i connections matched' % len(rows), system=LOG_SYSTEM)
+            reservations = ConnectionInfoRows(rows, self._summaryConnectionInfo)
             self.parent_requester.querySummaryConfirmed(header, reservations)
 
         except Exception as e:
@@ -682,6 +878,31 @@ class Aggregator:
             raise e
 
 
+    def _summaryConnectionInfo(self, row):
+
+        (connection_id, revision, global_reservation_id, description, requester_nsa, reservation_state, provision_state, lifecycle_state,
+         source_network, source_port, source_label, dest_network, dest_port, dest_label, start_time, end_time, bandwidth,
+         n_sub_conns, n_active, max_version, n_inconsistent) = row
+
+        source_stp  = nsa.STP(source_network, source_port, source_label)
+        dest_stp    = nsa.STP(dest_network, dest_port, dest_label)
+        schedule    = nsa.Schedule(start_time, end_time)
+        sd          = nsa.Point2PointService(source_stp, dest_stp, bandwidth, cnt.BIDIRECTIONAL, False, None)
+        criteria    = nsa.QueryCriteria(revision, schedule, sd)
+
+        if n_sub_conns == 0: # apparently this can happen
+            data_plane_status = (False, 0, False)
+        else:
+            data_plane_status = (n_active == n_sub_conns, max_version, n_inconsistent == 0)
+
+        states = (reservation_state, provision_state, lifecycle_state, data_plane_status)
+        notification_id = self.getNotificationId()
+        result_id = 0
+
+        return nsa.ConnectionInfo(connection_id, global_reservation_id, description, cnt.EVTS_AGOLE, [ criteria ],
+                                  self.nsa_.urn(), requester_nsa, states, notification_id, result_id)
+
+
     @defer.inlineCallbacks
     def queryRecursive(self, header, connection_ids, global_reservation_ids, request_info=None):
 
@@ -735,10 +956,8 @@ class Aggregator:
             raise e
 
 
-    @defer.inlineCallbacks
     def queryRecursiveConfirmed(self, header, sub_result):
 
-        @defer.inlineCallbacks
         def createCQR(conn, children=None):
             # can we make this generic?
             c = conn
@@ -751,14 +970,7 @@ class Aggregator:
 
             criteria = nsa.QueryCriteria(c.revision, schedule, sd, children)
 
-            sub_conns = yield self.getSubConnectionsByConnectionKey(c.id)
-            if len(sub_conns) == 0: # apparently this can happen
-                data_plane_status = (False, 0, False)
-            else:
-                aggr_active     = all( [ sc.data_plane_active     for sc in sub_conns ] )
-                aggr_version    = max( [ sc.data_plane_version    for sc in sub_conns ] ) or 0 # can be None otherwise
-                aggr_consistent = all( [ sc.data_plane_consistent for sc in sub_conns ] )
-                data_plane_status = (aggr_active, aggr_version, aggr_consistent)
+            data_plane_status = database.dataPlaneStatus(c)
 
             states = (c.reservation_state, c.provision_state, c.lifecycle_state, data_plane_status)
             notification_id = self.getNotificationId()
@@ -766,7 +978,7 @@ class Aggregator:
 
             ci = nsa.ConnectionInfo(c.connection_id, c.global_reservation_id, c.description, cnt.EVTS_AGOLE, [ criteria ],
                                     self.nsa_.urn(), c.requester_nsa, states, notification_id, result_id)
-            defer.returnValue(ci)
+            return ci
 
         # ---
 
@@ -802,7 +1014,7 @@ class Aggregator:
                     self.query_calls.pop(k)
 
             log.msg('QueryRecursive : Emitting to parent requester', system=LOG_SYSTEM)
-            results = yield createCQR(conn, scr)
+            results = createCQR(conn, scr)
             self.parent_requester.queryRecursiveConfirmed(cb_header, [ results ] )
 
         else:
@@ -834,7 +1046,20 @@ class Aggregator:
             log.msg('Provider NSA in header %s for reserveConfirmed does not match saved identity %s' % (header.provider_nsa, org_provider_nsa), system=LOG_SYSTEM)
             raise error.SecurityError('Provider NSA for connection does not match saved identity')
 
-        resv_info = self.reservations.pop(header.correlation_id)
+        resv_info = self.reservations[header.correlation_id]
+
+        if resv_info.get('abandoned'):
+            self.reservations.pop(header.correlation_id)
+            log.msg('Ignoring reserveConfirmed for connection %s, the path it was part of has been abandoned' % connection_id, system=LOG_SYSTEM)
+            return
+
+        if resv_info.get('confirming'):
+            log.msg('Ignoring duplicate reserveConfirmed for connection %s' % connection_id, system=LOG_SYSTEM)
+            return
+
+        # the reservation is kept until the sub connection has been counted in the connection
+        # so the path can be abandoned while the sub connection is saved (see _abandonPath)
+        resv_info['confirming'] = True
 
         # gid and desc should be identical, not checking, same with bandwidth, schedule, etc
 
@@ -870,12 +1095,24 @@ class Aggregator:
                                     start_time=db_start_time, end_time=db_end_time, bandwidth=sd.capacity)
 
         yield sc.save()
+        sc = self.db_sub_connections.add(sc.connection_id, sc)
 
         # figure out if we can aggregate upwards
 
         conn = yield self.getConnectionByKey(sc.service_connection_id)
         sub_conns = yield self.getSubConnectionsByConnectionKey(conn.id)
 
+        self.reservations.pop(header.correlation_id, None)
+        if resv_info.get('abandoned'):
+            # the abandon terminates the sub connection at the provider, but leaves the sub connection to us, as it is not counted yet
+            log.msg('Connection %s: Path abandoned while saving sub connection %s, removing it' % (conn.connection_id, connection_id), system=LOG_SYSTEM)
+            self.db_sub_connections.remove(sc.connection_id)
+            yield sc.delete()
+            return
+
+        conn.sub_connection_count += 1
+        _updateDataPlaneCounters(conn, sc, 1)
+
         if sc.order_id == 0:
             conn.source_label = sd.source_stp.label
         if sc.order_id == len(sub_conns)-1:
@@ -883,14 +1120,15 @@ class Aggregator:
 
         yield conn.save()
 
-        outstanding_calls = [ v for v in self.reservations.values() if v.get('service_connection_id') == resv_info['service_connection_id'] ]
+        outstanding_calls = [ v for v in self.reservations.values() if v.get('service_connection_id') == resv_info['service_connection_id'] and not v.get('abandoned') ]
         if len(outstanding_calls) > 0:
             log.msg('Connection %s: Still missing %i reserveConfirmed call(s) to aggregate' % (conn.connection_id, len(outstanding_calls)), system=LOG_SYSTEM)
             return
 
         # if we get responses very close, multiple requests can trigger this, so we check main state as well
-        if all( [ sc.reservation_state == state.RESERVE_HELD for sc in sub_conns ] ) and conn.reservation_state != state.RESERVE_HELD:
+        if all( [ sc.reservation_state == state.RESERVE_HELD for sc in sub_conns ] ) and conn.reservation_state == state.RESERVE_CHECKING:
             log.msg('Connection %s: All sub connections reserve held, can emit reserveConfirmed' % (conn.connection_id), system=LOG_SYSTEM)
+            self.path_candidates.pop(conn.id, None)
             yield state.reserveHeld(conn)
             header = nsa.NSIHeader(conn.requester_nsa, self.nsa_.urn())
             source_stp = nsa.STP(conn.source_network, conn.source_port, conn.source_label)
@@ -922,12 +1160,53 @@ class Aggregator:
 
         resv_info = self.reservations.pop(header.correlation_id)
 
+        if resv_info.get('abandoned'):
+            log.msg('Ignoring reserveFailed for connection %s, the path it was part of has been abandoned' % connection_id, system=LOG_SYSTEM)
+            return
+
         service_connection_key = resv_info['service_connection_id']
 
+        candidates = self.path_candidates.get(service_connection_key)
+        if candidates and 'failures' in candidates:
+            log.msg('Connection %s: Reserve failed before all providers acked the path, path will be abandoned' % connection_id, system=LOG_SYSTEM)
+            candidates['failures'].append( (header.provider_nsa, err) )
+            return
+
+        # done before yielding, so only the first failure for a path moves on to the next candidate
+        reserving = candidates.pop('reserving', None) if candidates else None
+        if reserving and candidates['paths']:
+            for v in self.reservations.values():
+                if v.get('service_connection_id') == service_connection_key:
+                    v['abandoned'] = True
+        else:
+            self.path_candidates.pop(service_connection_key, None)
+            reserving = None
+
         conn = yield self.getConnectionByKey(service_connection_key)
-        if conn.reservation_state != state.RESERVE_FAILED: # since we can fail multiple times
+
+        if reserving and conn.lifecycle_state == state.CREATED:
+            path, results, conn_info = reserving
+            log.msg('Connection %s: Reserve failed for candidate path %i, trying next candidate' % (conn.connection_id, candidates['attempt']), system=LOG_SYSTEM)
+            self._removePathLoad(conn)
+            candidates['results'].append( (False, failure.Failure(err)) )
+            candidates['provider_urns'].append(header.provider_nsa)
+            yield self._abandonPath(candidates['header'], conn, results, conn_info)
+
+            path_err = yield self._reserveCandidatePaths(conn)
+            if path_err is None:
+                return
+
+            # none of the candidates could be reserved, and their sub connections have been terminated
+            yield state.reserveFailed(conn)
+            yield state.terminating(conn)
+            yield state.terminated(conn)
+            err = path_err.value if isinstance(path_err, failure.Failure) else path_err
+
+        elif conn.reservation_state != state.RESERVE_FAILED: # since we can fail multiple times
             yield state.reserveFailed(conn)
 
+        self._removePathLoad(conn)
+
         header = nsa.NSIHeader(conn.requester_nsa, self.nsa_.urn())
         self.parent_requester.reserveFailed(header, conn.connection_id, connection_states, err)
 
@@ -1014,6 +1293,11 @@ class Aggregator:
     @defer.inlineCallbacks
     def terminateConfirmed(self, header, connection_id):
 
+        if (header.provider_nsa, connection_id) in self.abandoned_sub_connections:
+            del self.abandoned_sub_connections[ (header.provider_nsa, connection_id) ]
+            log.msg('Terminate confirmed for sub connection %s from abandoned path. NSA %s' % (connection_id, header.provider_nsa), system=LOG_SYSTEM)
+            return
+
         sub_connection = yield self.getSubConnection(header.provider_nsa, connection_id)
         sub_connection.lifecycle_state = state.TERMINATED
         yield sub_connection.save()
@@ -1024,6 +1308,7 @@ class Aggregator:
         # if we get responses very close, multiple requests can trigger this, so we check main state as well
         if all( [ sc.lifecycle_state == state.TERMINATED for sc in sub_conns ] ) and conn.lifecycle_state != state.TERMINATED:
             yield state.terminated(conn)
+            self._removePathLoad(conn) # in case the connection was terminated without a terminate request
             header = nsa.NSIHeader(conn.requester_nsa, self.nsa_.urn())
             self.parent_requester.terminateConfirmed(header, conn.connection_id)
             self.plugin.connectionTerminated(conn)
@@ -1056,6 +1341,9 @@ class Aggregator:
         conn = yield self.getConnectionByKey(sub_conn.service_connection_id)
         sub_conns = yield self.getSubConnectionsByConnectionKey(conn.id)
 
+        # the held resources are released when the reservation times out
+        self._removePathLoad(conn)
+
         if conn.reservation_state == state.RESERVE_FAILED:
             log.msg("Connection %s: reserveTimeout: Connection has already failed, not notifying parent" % conn.connection_id, system=LOG_SYSTEM)
         elif sum ( [ 1 if sc.reservation_state == state.RESERVE_TIMEOUT else 0 for sc in sub_conns ] ) == 1:
@@ -1066,6 +1354,12 @@ class Aggregator:
             log.msg("Connection %s: reserveTimeout: Second or later reserveTimeout, not notifying parent" % conn.connection_id, system=LOG_SYSTEM)
 
 
+    def messageDeliveryTimeout(self, header, connection_id, notification_id, timestamp, correlation_id):
+
+        # the message is lost, the connection will be stuck in whatever state it was going out of, until the parent acts on it
+        log.msg("messageDeliveryTimeout from %s:%s. Message with correlation id %s was not delivered" % (header.provider_nsa, connection_id, correlation_id), system=LOG_SYSTEM)
+
+
     @defer.inlineCallbacks
     def dataPlaneStateChange(self, header, connection_id, notification_id, timestamp, dps):
 
@@ -1074,23 +1368,25 @@ class Aggregator:
                  (connection_id, active, version, consistent), system=LOG_SYSTEM)
 
         sub_conn = yield self.getSubConnection(header.provider_nsa, connection_id)
+        conn = yield self.getConnectionByKey(sub_conn.service_connection_id)
+
+        # update the aggregate counters with the change, instead of recomputing them from all sub connections
+        _updateDataPlaneCounters(conn, sub_conn, -1)
 
         sub_conn.data_plane_active      = active
         sub_conn.data_plane_version     = version
         sub_conn.data_plane_consistent  = consistent
 
-        yield sub_conn.save()
+        _updateDataPlaneCounters(conn, sub_conn, 1)
 
-        conn = yield self.getConnectionByKey(sub_conn.service_connection_id)
-        sub_conns = yield self.getSubConnectionsByConnectionKey(conn.id)
+        yield sub_conn.save()
+        yield conn.save()
 
         # At some point we should check if data plane aggregated state actually changes and only emit for those that change
 
         # do notification
-        actives  = [ sc.data_plane_active     for sc in sub_conns ]
-        aggr_active     = all( actives )
-        aggr_version    = max( [ sc.data_plane_version    for sc in sub_conns ] )
-        aggr_consistent = all( [ sc.data_plane_consistent for sc in sub_conns ] ) and all( [ a == actives[0] for a in actives ] ) # we need version here
+        aggr_active, aggr_version, aggr_consistent = database.dataPlaneStatus(conn)
+        aggr_consistent = aggr_consistent and conn.data_plane_active_count in (0, conn.sub_connection_count) # we need version here
 
         header = nsa.NSIHeader(conn.requester_nsa, self.nsa_.urn(), reply_to=conn.requester_url)
         now = datetime.datetime.utcnow()
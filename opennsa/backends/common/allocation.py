@@ -0,0 +1,165 @@
+"""
+Label allocation strategies.
+
+A strategy decides which of the free label values is chosen for a new
+reservation. The free values are given as a bitset (see calendar.labelMask),
+and the strategy yields the values in the order they should be tried. The
+caller verifies each candidate, and tells the strategy which value was chosen,
+so strategies with state (round-robin cursor, usage order) can update it.
+
+State is kept per allocation key, which is typically the ports and label type
+the label is allocated for.
+
+Author: Henrik Thostrup Jensen <htj@nordu.net>
+Copyright: NORDUnet (2016)
+"""
+
+import random
+import collections
+
+from opennsa.backends.common import calendar
+
+
+
+FIRST_FIT       = 'firstfit'
+LAST_FIT        = 'lastfit'
+ROUND_ROBIN     = 'roundrobin'
+LEAST_RECENTLY  = 'lru'
+RANDOM          = 'random'
+
+
+
+def _highValues(mask):
+    # values set in bitset, highest value first
+    while mask:
+        value = mask.bit_length() - 1
+        yield value
+        mask ^= 1 << value
+
+
+
+class FirstFit(object):
+
+    name = FIRST_FIT
+
+    def candidates(self, key, mask):
+        return calendar.maskValues(mask)
+
+    def allocated(self, key, value):
+        pass
+
+    def select(self, label, key=None):
+        """
+        Selects a value from the label set. Returns the value (not a label).
+        """
+        for value in self.candidates(key, calendar.labelMask(label)):
+            self.allocated(key, value)
+            return value
+        raise ValueError('Cannot select value from empty label %s' % label)
+
+
+
+class LastFit(FirstFit):
+
+    name = LAST_FIT
+
+    def candidates(self, key, mask):
+        return _highValues(mask)
+
+
+
+class RoundRobin(FirstFit):
+
+    name = ROUND_ROBIN
+
+    def __init__(self):
+        self.cursors = {} # key -> next value to try
+
+    def candidates(self, key, mask):
+        cursor = self.cursors.get(key, 0)
+        above = (mask >> cursor) << cursor
+        for value in calendar.maskValues(above):
+            yield value
+        for value in calendar.maskValues(mask ^ above): # wrap around
+            yield value
+
+    def allocated(self, key, value):
+        self.cursors[key] = value + 1
+
+
+
+class LeastRecentlyUsed(FirstFit):
+
+    name = LEAST_RECENTLY
+
+    def __init__(self):
+        self.used = {} # key -> ( bitset of used values, OrderedDict of used values, least recently used first )
+
+    def candidates(self, key, mask):
+        try:
+            used_mask, used_order = self.used[key]
+        except KeyError:
+            return calendar.maskValues(mask)
+        return self._candidates(mask, used_mask, list(used_order))
+
+    def _candidates(self, mask, used_mask, used_order):
+        # values never used come first, then the used ones, in the order they were used
+        for value in calendar.maskValues(mask & ~used_mask):
+            yield value
+        for value in used_order:
+            if mask & (1 << value):
+                yield value
+
+    def allocated(self, key, value):
+        try:
+            used_mask, used_order = self.used[key]
+        except KeyError:
+            used_mask, used_order = 0, collections.OrderedDict()
+        used_order.pop(value, None)
+        used_order[value] = None
+        self.used[key] = (used_mask | (1 << value), used_order)
+
+
+
+class Random(FirstFit):
+
+    name = RANDOM
+
+    SAMPLE_MISSES = 16 # misses in a row before shuffling the remaining values instead
+
+    def __init__(self, rng=None):
+        self.rng = rng or random.Random()
+
+    def candidates(self, key, mask):
+        # values are drawn from the range of the mask, and checked against it, so picking a value does not
+        # require listing all the free values, as long as a reasonable part of the range is free
+        misses = 0
+        while mask and misses < self.SAMPLE_MISSES:
+            value = self.rng.randint( (mask & -mask).bit_length() - 1, mask.bit_length() - 1 )
+            if mask & (1 << value):
+                mask ^= 1 << value
+                misses = 0
+                yield value
+            else:
+                misses += 1
+
+        values = list(calendar.maskValues(mask))
+        self.rng.shuffle(values)
+        for value in values:
+            yield value
+
+
+
+STRATEGIES = dict( [ (s.name, s) for s in (FirstFit, LastFit, RoundRobin, LeastRecentlyUsed, Random) ] )
+
+
+def createStrategy(name):
+    """
+    Creates a label allocation strategy from its name. Raises ValueError for
+    unknown strategies.
+    """
+    try:
+        return STRATEGIES[name.lower()]()
+    except KeyError:
+        raise ValueError('Unknown label allocation strategy: %s (available: %s)' % (name, ', '.join(sorted(STRATEGIES))))
+
@@ -5,27 +5,86 @@ Keeps track of reservation timeslots for resources.
 
 Inteded usage is for NRM backend which does not have their own reservation calendar.
 
-The module assumes that any expired reservations are removed. Otherwise the
-overlap detection will not work properly.
+Reservations are indexed per resource in an interval tree, so checking,
+adding, and removing a reservation is O(log n) in the number of reservations
+for the resource, regardless of how many other resources are in the calendar.
+
+Reservations are normally removed when a connection ends. Reservations which
+are not (e.g., due to a failed teardown) are removed by evictExpired, which
+should be called periodically. Otherwise the calendar will keep growing.
 
 None is allowed for start and end time. In that case the semantics is now for
 start time and forever for end time.
 
+The LabelCalendar keeps track of which label values are in use on a port over
+time. It is used for quickly finding free label values in a requested label
+set, by turning the busy label values into a bitset (a Python integer), and
+masking it out of the requested values. The set of values with reservations on
+a port is kept up to date as reservations are added and removed, so only
+requests for values which have reservations have to look at the time span.
+The LabelCalendar is only a search index; the ReservationCalendar is still the
+authoritative source on resource availability.
+
+The CapacityCalendar keeps track of the bandwidth committed on a port over
+time, as a step function. Unlike the other calendars, the time spans are
+half-open, so a reservation ending at the time another starts, does not add
+to its bandwidth usage.
+
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2016)
 """
 
+import heapq
 import types
+import bisect
 import datetime
 
 from opennsa import error
+from opennsa.backends.common import intervaltree, stepfunction
+
+
+
+# open ended reservations are stored in the interval trees with these values
+# a reservation without start time can never have started after any other reservation
+# so using the earliest possible time gives the same result as using now
+NO_START = datetime.datetime.min
+FOREVER  = datetime.datetime.max
+
+# reservations are closed intervals, so a free window must keep a distance to adjacent reservations
+WINDOW_GAP = datetime.timedelta(seconds=1)
+
+
+
+def freeWindows(busy, earliest, latest, duration):
+    """
+    Returns the time windows between earliest and latest, which are at least
+    the specified duration, and do not overlap any of the busy (start_time,
+    end_time) intervals. The busy intervals must be sorted on start time.
+    """
+    windows = []
+
+    def addWindow(start_time, end_time):
+        if end_time - start_time >= duration:
+            windows.append( (start_time, end_time) )
+
+    free_from = earliest
+    for start_time, end_time in busy:
+        if start_time > free_from:
+            addWindow(free_from, min(start_time - WINDOW_GAP, latest))
+        if end_time >= latest:
+            return windows
+        free_from = max(free_from, end_time + WINDOW_GAP)
+
+    addWindow(free_from, latest)
+    return windows
 
 
 
 class ReservationCalendar:
 
     def __init__(self):
-        self.reservations = [] # [ ( resource, start_time, end_time ) ]
+        self.reservations = {} # resource -> IntervalTree of ( start_time, end_time )
+        self.evicted = 0 # number of expired reservations removed by evictExpired
 
 
     def _checkArgs(self, resource, start_time, end_time):
@@ -43,30 +102,84 @@ class ReservationCalendar:
     def addReservation(self, resource, start_time, end_time):
         self._checkArgs(resource, start_time, end_time)
 
-        reservation = (resource, start_time, end_time)
-        self.reservations.append(reservation)
+        try:
+            resource_reservations = self.reservations[resource]
+        except KeyError:
+            resource_reservations = intervaltree.IntervalTree()
+            self.reservations[resource] = resource_reservations
+
+        resource_reservations.insert(start_time or NO_START, end_time or FOREVER)
 
 
     def removeReservation(self, resource, start_time, end_time):
         self._checkArgs(resource, start_time, end_time)
 
-        reservation = (resource, start_time, end_time)
         try:
-            self.reservations.remove(reservation)
-        except ValueError:
+            resource_reservations = self.reservations[resource]
+            resource_reservations.remove(start_time or NO_START, end_time or FOREVER)
+        except KeyError:
             raise ValueError('Reservation (%s, %s, %s) does not exist. Cannot remove' % (resource, start_time, end_time))
 
+        if len(resource_reservations) == 0:
+            self.reservations.pop(resource) # keep the index small
+
+
+    def evictExpired(self, now):
+        """
+        Removes all reservations which ended before now. Returns the number of
+        removed reservations.
+        """
+        n_evicted = 0
+        for resource, resource_reservations in self.reservations.items():
+            n_evicted += len(resource_reservations.removeEndingBefore(now))
+            if len(resource_reservations) == 0:
+                self.reservations.pop(resource)
+
+        self.evicted += n_evicted
+        return n_evicted
+
+
+    def findFreeWindows(self, resource, earliest, latest, duration, busy=()):
+        """
+        Returns the time windows, as a list of (start_time, end_time) tuples,
+        between earliest and latest, where the resource is free for at least
+        the specified duration (a timedelta). busy is a sorted list of
+        additional (start_time, end_time) intervals where the resource cannot
+        be used.
+        """
+        resource_reservations = self.reservations.get(resource)
+        reserved = resource_reservations.findOverlapping(earliest, latest) if resource_reservations is not None else []
+        reserved = [ (start_time, end_time) for start_time, end_time, _ in reserved ]
+        return freeWindows(heapq.merge(reserved, busy), earliest, latest, duration)
+
 
     def checkReservation(self, resource, start_time, end_time):
         self._checkArgs(resource, start_time, end_time)
+        self.checkSchedule(start_time, end_time)
+
+        resource_reservations = self.reservations.get(resource)
+        if resource_reservations is not None:
+            check_start_time = start_time or datetime.datetime.utcnow()
+            check_end_time   = end_time   or FOREVER
+            assert check_start_time < check_end_time, 'Cannot detect overlap for backwards reservation'
+            if resource_reservations.overlaps(check_start_time, check_end_time):
+                raise error.STPUnavailableError('Resource %s not available in specified time span' % resource)
+
+        # all good
 
+
+    def checkSchedule(self, start_time, end_time):
+        """
+        Checks that the schedule of a reservation is valid, regardless of resource.
+        """
         # check start time is before end time
         if start_time is not None and end_time is not None and start_time > end_time:
             raise error.PayloadError('Invalid request: Reverse duration (end time before start time)')
 
+        now = datetime.datetime.utcnow()
+
         if start_time is not None:
             # check that start time is not in the past
-            now = datetime.datetime.utcnow()
             if start_time < now:
                 delta = now - start_time
                 stamp = str(start_time).rsplit('.')[0]
@@ -77,36 +190,293 @@ class ReservationCalendar:
             if start_time > datetime.datetime(2025, 1, 1):
                 raise error.PayloadError('Invalid request: Start time after year 2025')
 
-        for (c_resource, c_start_time, c_end_time) in self.reservations:
-            if resource == c_resource:
-                if self._resourceOverlap(c_start_time, c_end_time, start_time, end_time):
-                    raise error.STPUnavailableError('Resource %s not available in specified time span' % resource)
 
-        # all good
 
+def labelMask(label):
+    """
+    Returns a bitset with the bits for the values in the label set.
+    """
+    mask = 0
+    for v1, v2 in label.values:
+        mask |= ( (1 << (v2 - v1 + 1)) - 1 ) << v1
+    return mask
 
-    def _resourceOverlap(self, res1_start_time, res1_end_time, res2_start_time, res2_end_time):
-        # resource temporal availability
 
-        # hack on
-        # instead of doing a lot of complicated branching for None checking, we just coalesce the values into something easier
+def maskValues(mask):
+    """
+    Yields the values set in a bitset, lowest value first.
+    """
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
 
-        now = datetime.datetime.utcnow()
-        forever = datetime.datetime(9999, 1, 1)
 
-        r1s = res1_start_time or now
-        r2s = res2_start_time or now
-        r1e = res1_end_time or forever
-        r2e = res2_end_time or forever
+class LabelCalendar:
 
-        assert r1s < r1e, 'Cannot detect overlap for backwards reservation (1)'
-        assert r2s < r2e, 'Cannot detect overlap for backwards reservation (2)'
+    def __init__(self):
+        self.labels = {} # (port, label type) -> IntervalTree of ( start_time, end_time, label value )
+        self.used   = {} # (port, label type) -> bitset of values with reservations (at any time)
+        self.counts = {} # (port, label type) -> { label value -> number of reservations }
+        self.evicted = 0
+
+
+    def _labelValue(self, label):
+        assert label.singleValue(), 'Label for reservation must be single valued (got %s)' % label.labelValue()
+        return label.values[0][0]
 
-        if r2e < r1s:
-            return False # res2 ends before res1 starts so it is ok
-        if r2s > r1e:
-            return False # res2 starts after res1 ends so it is ok
 
-        # resources overlap in time
-        return True
+    def addReservation(self, port, label, start_time, end_time):
+        if label is None:
+            return # no label values to keep track of
+
+        key = (port, label.type_)
+        try:
+            port_labels = self.labels[key]
+        except KeyError:
+            port_labels = intervaltree.IntervalTree()
+            self.labels[key] = port_labels
+
+        value = self._labelValue(label)
+        port_labels.insert(start_time or NO_START, end_time or FOREVER, value)
+        self._updateUsed(key, value, 1)
+
+
+    def _updateUsed(self, key, value, delta):
+        # keeps the set of values with reservations up to date, so it does not have to be found from the reservations
+        counts = self.counts.setdefault(key, {})
+        count = counts.get(value, 0) + delta
+        if count:
+            counts[value] = count
+            self.used[key] = self.used.get(key, 0) | (1 << value)
+        else:
+            counts.pop(value)
+            self.used[key] ^= 1 << value
+            if not counts:
+                self.counts.pop(key)
+                self.used.pop(key)
+
+
+    def removeReservation(self, port, label, start_time, end_time):
+        if label is None:
+            return
+
+        key = (port, label.type_)
+        value = self._labelValue(label)
+        try:
+            port_labels = self.labels[key]
+            port_labels.remove(start_time or NO_START, end_time or FOREVER, value)
+        except KeyError:
+            raise ValueError('Label reservation (%s, %s, %s, %s) does not exist. Cannot remove' % (port, label, start_time, end_time))
+
+        self._updateUsed(key, value, -1)
+        if len(port_labels) == 0:
+            self.labels.pop(key)
+
+
+    def evictExpired(self, now):
+        n_evicted = 0
+        for key, port_labels in self.labels.items():
+            for _, _, value in port_labels.removeEndingBefore(now):
+                self._updateUsed(key, value, -1)
+                n_evicted += 1
+            if len(port_labels) == 0:
+                self.labels.pop(key)
+
+        self.evicted += n_evicted
+        return n_evicted
+
+
+    def busyMask(self, port, label_type, start_time, end_time):
+        """
+        Returns a bitset of the label values used on the port in the time span.
+        """
+        port_labels = self.labels.get( (port, label_type) )
+        if port_labels is None:
+            return 0
+
+        mask = 0
+        for _, _, value in port_labels.findOverlapping(start_time or datetime.datetime.utcnow(), end_time or FOREVER):
+            mask |= 1 << value
+        return mask
+
+
+    def freeMask(self, ports, label, start_time, end_time):
+        """
+        Returns a bitset of the values in the label set, which are not in use
+        on any of the ports in the time span.
+        """
+        free = labelMask(label)
+        for port in ports:
+            if not free & self.used.get( (port, label.type_), 0 ):
+                continue # none of the values have reservations on the port, no need to look at the time span
+            free &= ~self.busyMask(port, label.type_, start_time, end_time)
+        return free
+
+
+    def findFreeWindows(self, port, label, earliest, latest, duration, busy=()):
+        """
+        Finds the time windows where the values in the label set are free on
+        the port, with a single search in the label reservations of the port.
+        busy is a sorted list of (start_time, end_time) intervals where the port
+        cannot be used, regardless of label (e.g., not enough bandwidth).
+
+        Returns a list of ((first value, last value), windows) tuples, for
+        ranges of consecutive label values with the same free windows. Values
+        without any free windows are left out.
+        """
+        reserved = {} # label value -> reservations, sorted on start time
+        port_labels = self.labels.get( (port, label.type_) )
+        if port_labels is not None:
+            for start_time, end_time, value in port_labels.findOverlapping(earliest, latest):
+                reserved.setdefault(value, []).append( (start_time, end_time) )
+        reserved_values = sorted(reserved)
+
+        # windows for all values without reservations
+        free = freeWindows(busy, earliest, latest, duration)
+
+        result = []
+
+        def addRange(first, last, windows):
+            if not windows:
+                return
+            if result and result[-1][0][1] == first - 1 and result[-1][1] == windows:
+                result[-1] = ( (result[-1][0][0], last), windows )
+            else:
+                result.append( ( (first, last), windows ) )
+
+        for v1, v2 in label.values:
+            # the values with reservations split the range into ranges of free values
+            first = v1
+            for value in reserved_values[bisect.bisect_left(reserved_values, v1):bisect.bisect_right(reserved_values, v2)]:
+                if value > first:
+                    addRange(first, value - 1, free)
+                addRange(value, value, freeWindows(heapq.merge(reserved[value], busy), earliest, latest, duration))
+                first = value + 1
+            if first <= v2:
+                addRange(first, v2, free)
+
+        return result
+
+
+    def findFreeValues(self, ports, label, start_time, end_time):
+        """
+        Yields the values in the label set, which are not in use on any of the
+        ports in the time span, lowest value first.
+        """
+        return maskValues(self.freeMask(ports, label, start_time, end_time))
+
+
+
+class CapacityCalendar:
+
+    def __init__(self):
+        self.usage = {} # port -> StepFunction of bandwidth
+        self.reservations = {} # port -> IntervalTree of ( start_time, end_time, bandwidth ), for finding expired reservations
+        self.evicted = 0
+
+
+    def addReservation(self, port, bandwidth, start_time, end_time):
+        if not bandwidth:
+            return # nothing to keep track of
+
+        try:
+            port_usage = self.usage[port]
+            port_reservations = self.reservations[port]
+        except KeyError:
+            port_usage = stepfunction.StepFunction()
+            port_reservations = intervaltree.IntervalTree()
+            self.usage[port] = port_usage
+            self.reservations[port] = port_reservations
+
+        port_usage.addStep(start_time or NO_START, end_time or FOREVER, bandwidth)
+        port_reservations.insert(start_time or NO_START, end_time or FOREVER, bandwidth)
+
+
+    def removeReservation(self, port, bandwidth, start_time, end_time):
+        if not bandwidth:
+            return
+
+        try:
+            port_usage = self.usage[port]
+            port_reservations = self.reservations[port]
+            port_reservations.remove(start_time or NO_START, end_time or FOREVER, bandwidth)
+        except KeyError:
+            raise ValueError('Capacity reservation (%s, %s, %s, %s) does not exist. Cannot remove' % (port, bandwidth, start_time, end_time))
+
+        port_usage.removeStep(start_time or NO_START, end_time or FOREVER, bandwidth)
+        if len(port_usage) == 0:
+            self.usage.pop(port)
+            self.reservations.pop(port)
+
+
+    def evictExpired(self, now):
+        n_evicted = 0
+        for port, port_reservations in self.reservations.items():
+            port_usage = self.usage[port]
+            for start_time, end_time, bandwidth in port_reservations.removeEndingBefore(now):
+                port_usage.removeStep(start_time, end_time, bandwidth)
+                n_evicted += 1
+            if len(port_usage) == 0:
+                self.usage.pop(port)
+                self.reservations.pop(port)
+
+        self.evicted += n_evicted
+        return n_evicted
+
+
+    def peakUsage(self, port, start_time, end_time):
+        """
+        Returns the highest bandwidth usage on the port in the time span.
+        """
+        port_usage = self.usage.get(port)
+        if port_usage is None:
+            return 0
+        return port_usage.peak(start_time or datetime.datetime.utcnow(), end_time or FOREVER)
+
+
+    def findBusy(self, port, bandwidth, capacity, earliest, latest):
+        """
+        Returns the time spans between earliest and latest, where the port does
+        not have the bandwidth available, given the port capacity, as a sorted
+        list of (start_time, end_time) tuples.
+        """
+        if not bandwidth:
+            return []
+        if bandwidth > capacity:
+            return [ (earliest, latest) ]
+
+        port_usage = self.usage.get(port)
+        if port_usage is None:
+            return []
+
+        threshold = capacity - bandwidth
+        usage = port_usage.value(earliest)
+        busy = []
+        busy_from = earliest if usage > threshold else None
+        for time, delta in port_usage.changes(earliest, latest):
+            usage += delta
+            if usage > threshold and busy_from is None:
+                busy_from = time
+            elif usage <= threshold and busy_from is not None:
+                busy.append( (busy_from, time) )
+                busy_from = None
+        if busy_from is not None:
+            busy.append( (busy_from, latest) )
+        return busy
+
+
+    def checkReservation(self, port, bandwidth, capacity, start_time, end_time):
+        """
+        Checks that the port has the bandwidth available in the time span,
+        given the port capacity.
+        """
+        if not bandwidth:
+            return
+
+        peak_usage = self.peakUsage(port, start_time, end_time)
+        if peak_usage + bandwidth > capacity:
+            raise error.BandwidthUnavailableError('Insufficient bandwidth on port %s in specified time span (requested: %i, available: %i, capacity: %i)' % \
+                                                  (port, bandwidth, max(0, capacity - peak_usage), capacity))
 
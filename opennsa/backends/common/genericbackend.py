@@ -13,20 +13,23 @@ Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2012)
 """
 
+import os
+import time
 import datetime
 
 from zope.interface import implements
 
 from twisted.python import log
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, task
 from twisted.application import service
 
 from opennsa.interface import INSIProvider
 
-from opennsa import constants as cnt, error, state, nsa, authz
-from opennsa.backends.common import scheduler, calendar
+from opennsa import constants as cnt, error, state, nsa, authz, logging
+from opennsa.backends.common import scheduler, calendar, snapshot, allocation
 
 from twistar.dbobject import DBObject
+from twistar.registry import Registry
 
 
 
@@ -35,6 +38,11 @@ class GenericBackendConnections(DBObject):
 
 
 
+# marker for the connection table in snapshots, see snapshot.py
+SNAPSHOT_MARKER_QUERY = 'SELECT count(*), coalesce(max(id), 0), coalesce(max(change_seq), 0) FROM generic_backend_connections'
+
+
+
 class GenericBackend(service.Service):
 
     implements(INSIProvider)
@@ -44,6 +52,17 @@ class GenericBackend(service.Service):
     # Yeah, it should be much less, but some NRMs are that slow
     TPC_TIMEOUT = 120 # seconds
 
+    # restoring the schedule on startup
+    RESTORE_CHUNK_SIZE  = 1000 # number of connections read from the database at a time
+    RESTORE_CONCURRENCY = 10   # number of overdue transitions run at the same time
+
+    # how often reservations which have passed their end time are removed from the calendars
+    COMPACTION_INTERVAL = 3600 # seconds
+
+    # File to write calendar and schedule snapshot to on shutdown, and read it from on startup.
+    # None means no snapshot. Must be set before the reactor is started.
+    snapshot_file = None
+
     def __init__(self, network, nrm_ports, connection_manager, parent_requester, log_system, minimum_duration=60):
 
         self.network            = network
@@ -57,8 +76,13 @@ class GenericBackend(service.Service):
 
         self.scheduler = scheduler.CallScheduler()
         self.calendar  = calendar.ReservationCalendar()
+        self.label_calendar = calendar.LabelCalendar()
+        self.capacity_calendar = calendar.CapacityCalendar()
+        self.label_allocation = allocation.FirstFit() # can be changed with the labelallocation option
         # need to build the calendar as well
 
+        self.compaction_call = task.LoopingCall(self.compactCalendars)
+
         # need to build schedule here
         self.restore_defer = defer.Deferred()
         reactor.callWhenRunning(self.buildSchedule)
@@ -66,15 +90,82 @@ class GenericBackend(service.Service):
 
     def startService(self):
         service.Service.startService(self)
+        self.compaction_call.clock = self.scheduler.clock
+        self.compaction_call.start(self.COMPACTION_INTERVAL, now=False)
 
 
     def stopService(self):
         service.Service.stopService(self)
-        if self.restore_defer.called:
+        if self.compaction_call.running:
+            self.compaction_call.stop()
+
+        def stopped(_):
+            transitions = self._pendingTransitions() if self.snapshot_file else None
             self.scheduler.cancelAllCalls()
-            return defer.succeed(None)
+            if self.snapshot_file:
+                return self._writeSnapshot(transitions)
+
+        if self.restore_defer.called:
+            return defer.maybeDeferred(stopped, None)
         else:
-            return self.restore_defer.addCallback( lambda _ : self.scheduler.cancelAllCalls() )
+            return self.restore_defer.addCallback(stopped)
+
+
+    def _pendingTransitions(self):
+        # scheduled transitions are all backend methods taking the connection as argument
+        return [ (transition_time, call.__name__, snapshot.connectionRecord(args[0]))
+                 for _, transition_time, call, args in self.scheduler.pendingCalls() ]
+
+
+    @defer.inlineCallbacks
+    def _writeSnapshot(self, transitions):
+        try:
+            rows = yield Registry.DBPOOL.runQuery(SNAPSHOT_MARKER_QUERY)
+            calendars = (self.calendar, self.label_calendar, self.capacity_calendar)
+            snapshot.writeSnapshot(self.snapshot_file, self.network, tuple(rows[0]), calendars, transitions)
+            log.msg('Wrote snapshot with %i scheduled transitions to %s' % (len(transitions), self.snapshot_file), system=self.log_system)
+        except Exception as e:
+            log.msg('Error writing snapshot to %s: %s' % (self.snapshot_file, e), system=self.log_system)
+
+
+    @defer.inlineCallbacks
+    def _readSnapshot(self):
+        """
+        Reads the snapshot file, and puts the calendars from it in place.
+        Returns the scheduled transitions from the snapshot, and the
+        connections which have changed since it was written. Returns None,
+        with empty calendars, if the snapshot cannot be used.
+        """
+        try:
+            snapshot_time, marker, calendars, transitions = snapshot.readSnapshot(self.snapshot_file, self.network)
+        except snapshot.SnapshotError as e:
+            log.msg('Not using snapshot: %s. Doing full restore.' % e, system=self.log_system)
+            defer.returnValue(None)
+        finally:
+            # a snapshot is only valid until the backend changes something, so it can only be used once
+            if os.path.exists(self.snapshot_file):
+                os.unlink(self.snapshot_file)
+
+        # put the calendars in place right away, so reservations made while checking the snapshot go into them
+        self.calendar, self.label_calendar, self.capacity_calendar = calendars
+
+        row_count, max_id, change_seq = marker
+        try:
+            # ids are never reused, so a different count means connections have been removed
+            rows = yield Registry.DBPOOL.runQuery('SELECT count(*) FROM generic_backend_connections WHERE id <= %s', (max_id,))
+            if rows[0][0] != row_count:
+                raise snapshot.SnapshotError('%i connections removed from database' % (row_count - rows[0][0]))
+            changed_conns = yield GenericBackendConnections.find(where=['change_seq > ?', change_seq], orderby='id')
+        except Exception as e:
+            log.msg('Not using snapshot: %s. Doing full restore.' % e, system=self.log_system)
+            self.calendar  = calendar.ReservationCalendar()
+            self.label_calendar = calendar.LabelCalendar()
+            self.capacity_calendar = calendar.CapacityCalendar()
+            defer.returnValue(None)
+
+        age = time.time() - snapshot_time
+        log.msg('Snapshot from %i seconds ago: %i scheduled transitions, %i connections changed since' % (age, len(transitions), len(changed_conns)), system=self.log_system)
+        defer.returnValue( (transitions, changed_conns) )
 
 
     def getNotificationId(self):
@@ -85,88 +176,284 @@ class GenericBackend(service.Service):
 
     @defer.inlineCallbacks
     def buildSchedule(self):
+        """
+        Restores the calendar and scheduled calls from the database.
 
-        conns = yield GenericBackendConnections.find(where=['lifecycle_state <> ?', state.TERMINATED])
-        for conn in conns:
-            # avoid race with newly created connections
-            if self.scheduler.hasScheduledCall(conn.connection_id):
-                continue
+        Connections are read in chunks ordered on id, so the whole table is
+        never loaded at once. Transitions which should have happened while the
+        backend was down (activation, end time, reservation timeout) are run
+        after the calendar has been restored, with a bounded number of them
+        running at the same time.
 
-            now = datetime.datetime.utcnow()
+        With a usable snapshot, the calendars and scheduled transitions are
+        taken from it, and only connections which have changed since it was
+        written, or have a transition which is overdue, are restored.
+        """
+        restore_start = time.time()
+        transitions = []
 
-            if conn.lifecycle_state in (state.PASSED_ENDTIME, state.TERMINATED):
-                continue # This connection has already lived it life to the fullest :-)
+        def restore(conns):
+            now = datetime.datetime.utcnow()
+            for conn in conns:
+                transition = self._restoreConnection(conn, now)
+                if transition is not None:
+                    transitions.append(transition)
+            return len(conns)
+
+        snapshot_result = None
+        if self.snapshot_file:
+            snapshot_result = yield self._readSnapshot()
+
+        n_conns = 0
+        if snapshot_result is not None:
+            snapshot_transitions, changed_conns = snapshot_result
+            now = datetime.datetime.utcnow()
+            restore_conns = []
+            for conn in changed_conns:
+                if not self.scheduler.hasScheduledCall(conn.connection_id): # otherwise changed after startup, and up to date
+                    self._discardReservations(conn)
+                    restore_conns.append(conn)
+
+            changed_ids = set( [ conn.connection_id for conn in changed_conns ] )
+            for transition_time, method_name, record in snapshot_transitions:
+                conn = GenericBackendConnections(**record)
+                if conn.connection_id in changed_ids:
+                    continue
+                if transition_time > now:
+                    self.scheduler.scheduleCall(conn.connection_id, transition_time, getattr(self, method_name), conn)
+                else:
+                    # overdue, restore it like a connection loaded from the database
+                    self._discardReservations(conn)
+                    restore_conns.append(conn)
 
-            if conn.reservation_state == state.RESERVE_START and not conn.allocated:
-                # This happens when a connection was reserved, but never committed and abort/timeout happened
-                log.msg('Connection %s: Was never comitted, not putting entry into calendar' % conn.connection_id, debug=True, system=self.log_system)
-                continue
+            n_conns += restore(restore_conns)
 
-            # add reservation, some of the following code will remove the reservation again
-            src_resource = self.connection_manager.getResource(conn.source_port, conn.source_label)
-            dst_resource = self.connection_manager.getResource(conn.dest_port,   conn.dest_label)
-            self.calendar.addReservation(  src_resource, conn.start_time, conn.end_time)
-            self.calendar.addReservation(  dst_resource, conn.start_time, conn.end_time)
+        else:
+            last_id = 0
+            while True:
+                conns = yield GenericBackendConnections.find(where=['lifecycle_state <> ? AND id > ?', state.TERMINATED, last_id],
+                                                             orderby='id', limit=self.RESTORE_CHUNK_SIZE)
+                n_conns += restore(conns)
+                if len(conns) < self.RESTORE_CHUNK_SIZE:
+                    break
+                last_id = conns[-1].id
+                log.msg('Restored %i connections (%.1f seconds)' % (n_conns, time.time() - restore_start), system=self.log_system)
+
+        # only start the transitions when all connections are in the calendar, as they change it
+        semaphore = defer.DeferredSemaphore(self.RESTORE_CONCURRENCY)
+        results = yield defer.DeferredList([ semaphore.run(*transition) for transition in transitions ], consumeErrors=True)
+        for success, result in results:
+            if not success:
+                log.msg('Error running transition during schedule restore: %s' % result.getErrorMessage(), system=self.log_system)
+                log.err(result)
+
+        log.msg('Scheduled calls restored (%i connections, %i immediate transitions, %.2f seconds)' % \
+                (n_conns, len(transitions), time.time() - restore_start), system=self.log_system)
+        self.restore_defer.callback(None)
 
-            if conn.end_time is not None and conn.end_time < now and conn.lifecycle_state not in (state.PASSED_ENDTIME, state.TERMINATED):
-                log.msg('Connection %s: Immediate end during buildSchedule' % conn.connection_id, system=self.log_system)
-                yield self._doEndtime(conn)
-                continue
 
-            elif conn.reservation_state == state.RESERVE_HELD:
-                abort_time = conn.reserve_time + datetime.timedelta(seconds=self.TPC_TIMEOUT)
-                timeout_time = min(abort_time, conn.end_time or abort_time) # or to handle None case
-                if timeout_time < now:
-                    # have passed the time when timeout should occur
-                    log.msg('Connection %s: Reservation Held, but timeout has passed, doing rollback' % conn.connection_id, system=self.log_system)
-                    yield self._doReserveRollback(conn) # will remove reservation
-                else:
-                    td = timeout_time - now
-                    log.msg('Connection %s: Reservation Held, scheduling timeout in %i seconds' % (conn.connection_id, td.total_seconds()), system=self.log_system)
-                    self.scheduler.scheduleCall(conn.connection_id, timeout_time, self._doReserveTimeout, conn)
-
-            elif conn.start_time is None or conn.start_time < now:
-                # we have passed start time, we must either: activate, schedule deactive, or schedule terminate
-                if conn.provision_state == state.PROVISIONED:
-                    if conn.data_plane_active:
-                        if conn.end_time is None:
-                            log.msg('Connection %s: already active, no scheduled end time' % conn.connection_id, system=self.log_system)
-                        else:
-                            self.scheduler.scheduleCall(conn.connection_id, conn.end_time, self._doEndtime, conn)
-                            td = conn.end_time - now
-                            log.msg('Connection %s: already active, scheduling end for %s UTC (%i seconds) (buildSchedule)' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
-                    else:
-                        log.msg('Connection %s: Immediate activate during buildSchedule' % conn.connection_id, system=self.log_system)
-                        yield self._doActivate(conn)
-                elif conn.provision_state == state.RELEASED:
+    def _restoreConnection(self, conn, now):
+        """
+        Adds the connection to the calendar and schedules its next transition.
+        If the transition should already have happened, it is returned as a
+        (callable, connection) tuple instead of being scheduled.
+        """
+        # avoid race with newly created connections
+        if self.scheduler.hasScheduledCall(conn.connection_id):
+            return
+
+        if conn.lifecycle_state in (state.PASSED_ENDTIME, state.TERMINATED):
+            return # This connection has already lived it life to the fullest :-)
+
+        if conn.reservation_state == state.RESERVE_START and not conn.allocated:
+            # This happens when a connection was reserved, but never committed and abort/timeout happened
+            logging.debug('Connection %s: Was never comitted, not putting entry into calendar', conn.connection_id, system=self.log_system)
+            return
+
+        # add reservation, some of the following code will remove the reservation again
+        self._addReservation(conn.source_port, conn.source_label, conn.bandwidth, conn.start_time, conn.end_time)
+        self._addReservation(conn.dest_port,   conn.dest_label,   conn.bandwidth, conn.start_time, conn.end_time)
+
+        if conn.end_time is not None and conn.end_time < now and conn.lifecycle_state not in (state.PASSED_ENDTIME, state.TERMINATED):
+            log.msg('Connection %s: Immediate end during buildSchedule' % conn.connection_id, system=self.log_system)
+            return self._doEndtime, conn
+
+        elif conn.reservation_state == state.RESERVE_HELD:
+            abort_time = conn.reserve_time + datetime.timedelta(seconds=self.TPC_TIMEOUT)
+            timeout_time = min(abort_time, conn.end_time or abort_time) # or to handle None case
+            if timeout_time < now:
+                # have passed the time when timeout should occur
+                log.msg('Connection %s: Reservation Held, but timeout has passed, doing rollback' % conn.connection_id, system=self.log_system)
+                return self._doReserveRollback, conn # will remove reservation
+            else:
+                td = timeout_time - now
+                log.msg('Connection %s: Reservation Held, scheduling timeout in %i seconds' % (conn.connection_id, td.total_seconds()), system=self.log_system)
+                self.scheduler.scheduleCall(conn.connection_id, timeout_time, self._doReserveTimeout, conn)
+
+        elif conn.start_time is None or conn.start_time < now:
+            # we have passed start time, we must either: activate, schedule deactive, or schedule terminate
+            if conn.provision_state == state.PROVISIONED:
+                if conn.data_plane_active:
                     if conn.end_time is None:
-                        log.msg('Connection %s: Currently released, no end scheduled' % conn.connection_id, system=self.log_system)
+                        log.msg('Connection %s: already active, no scheduled end time' % conn.connection_id, system=self.log_system)
                     else:
                         self.scheduler.scheduleCall(conn.connection_id, conn.end_time, self._doEndtime, conn)
                         td = conn.end_time - now
-                        log.msg('Connection %s: End scheduled for %s UTC (%i seconds) (buildSchedule)' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
+                        log.msg('Connection %s: already active, scheduling end for %s UTC (%i seconds) (buildSchedule)' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
+                else:
+                    log.msg('Connection %s: Immediate activate during buildSchedule' % conn.connection_id, system=self.log_system)
+                    return self._doActivate, conn
+            elif conn.provision_state == state.RELEASED:
+                if conn.end_time is None:
+                    log.msg('Connection %s: Currently released, no end scheduled' % conn.connection_id, system=self.log_system)
                 else:
-                    log.msg('Unhandled provision state %s for connection %s in scheduler building' % (conn.provision_state, conn.connection_id))
-
-            elif conn.start_time > now:
-                # start time has not yet passed, we must schedule activate or schedule terminate depending on state
-                if conn.provision_state == state.PROVISIONED and conn.data_plane_active == False:
-                    self.scheduler.scheduleCall(conn.connection_id, conn.start_time, self._doActivate, conn)
-                    td = conn.start_time - now
-                    log.msg('Connection %s: activate scheduled for %s UTC (%i seconds) (buildSchedule)' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
-                elif conn.provision_state == state.RELEASED:
                     self.scheduler.scheduleCall(conn.connection_id, conn.end_time, self._doEndtime, conn)
                     td = conn.end_time - now
                     log.msg('Connection %s: End scheduled for %s UTC (%i seconds) (buildSchedule)' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
-                else:
-                    log.msg('Unhandled provision state %s for connection %s in scheduler building' % (conn.provision_state, conn.connection_id))
-
             else:
-                log.msg('Unhandled start/end time configuration for connection %s' % conn.connection_id, system=self.log_system)
+                log.msg('Unhandled provision state %s for connection %s in scheduler building' % (conn.provision_state, conn.connection_id))
+
+        elif conn.start_time > now:
+            # start time has not yet passed, we must schedule activate or schedule terminate depending on state
+            if conn.provision_state == state.PROVISIONED and conn.data_plane_active == False:
+                self.scheduler.scheduleCall(conn.connection_id, conn.start_time, self._doActivate, conn)
+                td = conn.start_time - now
+                log.msg('Connection %s: activate scheduled for %s UTC (%i seconds) (buildSchedule)' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
+            elif conn.provision_state == state.RELEASED:
+                self.scheduler.scheduleCall(conn.connection_id, conn.end_time, self._doEndtime, conn)
+                td = conn.end_time - now
+                log.msg('Connection %s: End scheduled for %s UTC (%i seconds) (buildSchedule)' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
+            else:
+                log.msg('Unhandled provision state %s for connection %s in scheduler building' % (conn.provision_state, conn.connection_id))
 
-        log.msg('Scheduled calls restored', system=self.log_system)
-        self.restore_defer.callback(None)
+        else:
+            log.msg('Unhandled start/end time configuration for connection %s' % conn.connection_id, system=self.log_system)
+
+
+
+    def compactCalendars(self):
+        """
+        Removes reservations which have passed their end time from the
+        calendars. These are normally removed when the connection ends, but
+        are left behind if that fails. Returns the number of removed entries.
+        """
+        now = datetime.datetime.utcnow()
+        n_evicted = self.calendar.evictExpired(now) + self.label_calendar.evictExpired(now) + self.capacity_calendar.evictExpired(now)
+        if n_evicted:
+            log.msg('Calendar compaction: Evicted %i expired entries (%i reservations evicted in total)' % (n_evicted, self.calendar.evicted), system=self.log_system)
+        return n_evicted
+
+
+    def _addReservation(self, port, label, bandwidth, start_time, end_time):
+        resource = self.connection_manager.getResource(port, label)
+        self.calendar.addReservation(resource, start_time, end_time)
+        self.label_calendar.addReservation(port, label, start_time, end_time)
+        self.capacity_calendar.addReservation(port, bandwidth, start_time, end_time)
+
+
+    def _removeReservation(self, port, label, bandwidth, start_time, end_time):
+        resource = self.connection_manager.getResource(port, label)
+        expired = end_time is not None and end_time < datetime.datetime.utcnow()
+        for remove, args in ( (self.calendar.removeReservation,          (resource, start_time, end_time)),
+                              (self.label_calendar.removeReservation,    (port, label, start_time, end_time)),
+                              (self.capacity_calendar.removeReservation, (port, bandwidth, start_time, end_time)) ):
+            try:
+                remove(*args)
+            except ValueError:
+                if not expired:
+                    raise
+                # already removed by compaction
+
+
+    def _discardReservations(self, conn):
+        # removes the reservations of a connection from the calendars, if they are there
+        try:
+            self._removeReservation(conn.source_port, conn.source_label, conn.bandwidth, conn.start_time, conn.end_time)
+            self._removeReservation(conn.dest_port,   conn.dest_label,   conn.bandwidth, conn.start_time, conn.end_time)
+        except ValueError:
+            pass # not in the calendars
+
+
+    def _checkCapacity(self, ports, bandwidth, start_time, end_time):
+        # a port used for both ends of a connection, needs the bandwidth twice
+        demand = {}
+        for port in ports:
+            demand[port] = demand.get(port, 0) + (bandwidth or 0)
+        for port, port_demand in demand.items():
+            self.capacity_calendar.checkReservation(port, port_demand, self.nrm_ports[port].bandwidth, start_time, end_time)
+
+
+    def _findLabel(self, ports, label, start_time, end_time):
+        """
+        Finds a label value in the label set, which is available on all the
+        ports in the specified time span. The label calendar is used for
+        finding the candidates, which are then verified against the calendar,
+        as the backend may map labels on different ports to the same resource.
+        The candidates are tried in the order given by the label allocation
+        strategy.
+
+        Returns None if the label is None, i.e., the ports have no labels.
+        Raises STPUnavailableError if no label value is available.
+        """
+        if label is None:
+            candidates = [ None ]
+        else:
+            key = (tuple(ports), label.type_)
+            free_mask = self.label_calendar.freeMask(ports, label, start_time, end_time)
+            candidates = ( nsa.Label(label.type_, lv) for lv in self.label_allocation.candidates(key, free_mask) )
+
+        for lv in candidates:
+            try:
+                for port in ports:
+                    resource = self.connection_manager.getResource(port, lv)
+                    self.calendar.checkReservation(resource, start_time, end_time)
+                if lv is not None:
+                    self.label_allocation.allocated(key, lv.values[0][0])
+                return lv
+            except error.STPUnavailableError:
+                continue
 
+        raise error.STPUnavailableError('No label available on ports %s in specified time span' % ', '.join(ports))
+
+
+    def findFreeWindows(self, port, label, earliest, latest, duration, bandwidth=None):
+        """
+        Finds the time windows where the port is available with the labels in
+        the label set, and has the bandwidth (if specified) available, for at
+        least the specified duration. This is a read-only query, nothing is
+        reserved. Earliest times in the past are moved to now.
+
+        Returns a list of (label, windows) tuples, where windows is a list of
+        (start_time, end_time) tuples, and label has the range of values with
+        these windows. Labels without any free windows are left out. If the
+        label is None, the port is checked without labels.
+
+        Label availability is found in the label calendar of the port, so for
+        backends which map label values on different ports to the same
+        resource, a reservation in a window can still be rejected.
+        """
+        if not port in self.nrm_ports:
+            raise error.STPUnavailableError('No STP named %s (ports: %s)' % (port, str(self.nrm_ports.keys()) ))
+
+        now = datetime.datetime.utcnow()
+        earliest = max(earliest or now, now)
+        if latest <= earliest:
+            raise error.PayloadError('Invalid request: Latest time must be after earliest time (and now)')
+
+        nrm_port = self.nrm_ports[port]
+        if not nsa.Label.canMatch(nrm_port.label, label):
+            raise error.TopologyError('Port %s cannot match label set %s' % (port, label) )
+
+        busy = self.capacity_calendar.findBusy(port, bandwidth, nrm_port.bandwidth, earliest, latest)
+
+        if label is None:
+            resource = self.connection_manager.getResource(port, None)
+            windows = self.calendar.findFreeWindows(resource, earliest, latest, duration, busy)
+            return [ (None, windows) ] if windows else []
+
+        port_label = label.intersect(nrm_port.label)
+        free = self.label_calendar.findFreeWindows(port, port_label, earliest, latest, duration, busy)
+        return [ (nsa.Label(label.type_, '%i-%i' % (first, last)), windows) for (first, last), windows in free ]
 
 
     @defer.inlineCallbacks
@@ -280,35 +567,26 @@ class GenericBackend(service.Service):
         if not nsa.Label.canMatch(nrm_dest_port.label, dest_stp.label):
             raise error.TopologyError('Destination port %s cannot match label set %s' % (nrm_dest_port.name, dest_stp.label) )
 
-        labelEnum = lambda label : [None] if label is None else [ nsa.Label(label.type_, lv) for lv in label.enumerateValues() ]
+        # check schedule before looking for labels, so schedule errors are reported as such
+        self.calendar.checkSchedule(start_time, end_time)
 
         # do the find the label value dance
         if self.connection_manager.canSwapLabel(labelType(source_stp)) and self.connection_manager.canSwapLabel(labelType(dest_stp)):
-            for lv in labelEnum(source_stp.label):
-                src_resource = self.connection_manager.getResource(source_stp.port, lv)
-                try:
-                    self.calendar.checkReservation(src_resource, start_time, end_time)
-                    src_label = lv
-                    break
-                except error.STPUnavailableError:
-                    pass
-            else:
+            try:
+                src_label = self._findLabel([source_stp.port], source_stp.label, start_time, end_time)
+            except error.STPUnavailableError:
                 raise error.STPUnavailableError('STP %s not available in specified time span' % source_stp)
 
-            for lv in labelEnum(dest_stp.label):
-                dst_resource = self.connection_manager.getResource(dest_stp.port, lv)
-                try:
-                    self.calendar.checkReservation(dst_resource, start_time, end_time)
-                    dst_label = lv
-                    break
-                except error.STPUnavailableError:
-                    pass
-            else:
+            try:
+                dst_label = self._findLabel([dest_stp.port], dest_stp.label, start_time, end_time)
+            except error.STPUnavailableError:
                 raise error.STPUnavailableError('STP %s not available in specified time span' % dest_stp)
 
+            self._checkCapacity([source_stp.port, dest_stp.port], sd.capacity, start_time, end_time)
+
             # Only add reservations, when src and dest stps are both available
-            self.calendar.addReservation(  src_resource, start_time, end_time)
-            self.calendar.addReservation(  dst_resource, start_time, end_time)
+            self._addReservation(source_stp.port, src_label, sd.capacity, start_time, end_time)
+            self._addReservation(dest_stp.port,   dst_label, sd.capacity, start_time, end_time)
 
         else:
             if source_stp.label is None:
@@ -321,22 +599,18 @@ class GenericBackend(service.Service):
                 except nsa.EmptyLabelSet:
                     raise error.VLANInterchangeNotSupportedError('VLAN re-write not supported and no possible label intersection')
 
-            for lv in labelEnum(label_candidate):
-                src_resource = self.connection_manager.getResource(source_stp.port, lv)
-                dst_resource = self.connection_manager.getResource(dest_stp.port,   lv)
-                try:
-                    self.calendar.checkReservation(src_resource, start_time, end_time)
-                    self.calendar.checkReservation(dst_resource, start_time, end_time)
-                    self.calendar.addReservation(  src_resource, start_time, end_time)
-                    self.calendar.addReservation(  dst_resource, start_time, end_time)
-                    src_label = lv
-                    dst_label = lv
-                    break
-                except error.STPUnavailableError:
-                    continue
-            else:
+            try:
+                lv = self._findLabel([source_stp.port, dest_stp.port], label_candidate, start_time, end_time)
+            except error.STPUnavailableError:
                 raise error.STPUnavailableError('Link %s and %s not available in specified time span' % (source_stp, dest_stp))
 
+            self._checkCapacity([source_stp.port, dest_stp.port], sd.capacity, start_time, end_time)
+
+            self._addReservation(source_stp.port, lv, sd.capacity, start_time, end_time)
+            self._addReservation(dest_stp.port,   lv, sd.capacity, start_time, end_time)
+            src_label = lv
+            dst_label = lv
+
         now =  datetime.datetime.utcnow()
 
         source_target = self.connection_manager.getTarget(source_stp.port, src_label)
@@ -625,11 +899,8 @@ class GenericBackend(service.Service):
             self.scheduler.cancelCall(conn.connection_id) # we only have this for non-timeout calls, but just cancel
 
             # release the resources
-            src_resource = self.connection_manager.getResource(conn.source_port, conn.source_label)
-            dst_resource = self.connection_manager.getResource(conn.dest_port,   conn.dest_label)
-
-            self.calendar.removeReservation(src_resource, conn.start_time, conn.end_time)
-            self.calendar.removeReservation(dst_resource, conn.start_time, conn.end_time)
+            self._removeReservation(conn.source_port, conn.source_label, conn.bandwidth, conn.start_time, conn.end_time)
+            self._removeReservation(conn.dest_port,   conn.dest_label,   conn.bandwidth, conn.start_time, conn.end_time)
 
             yield state.reserved(conn) # we only log this, when we haven't passed end time, as it looks wonky with start+end together
 
@@ -755,16 +1026,12 @@ class GenericBackend(service.Service):
             try:
                 yield self._doTeardown(conn)
                 # we can only remove resource reservation entry if we succesfully shut down the link :-(
-                src_resource = self.connection_manager.getResource(conn.source_port, conn.source_label)
-                dst_resource = self.connection_manager.getResource(conn.dest_port,   conn.dest_label)
-                self.calendar.removeReservation(src_resource, conn.start_time, conn.end_time)
-                self.calendar.removeReservation(dst_resource, conn.start_time, conn.end_time)
+                self._removeReservation(conn.source_port, conn.source_label, conn.bandwidth, conn.start_time, conn.end_time)
+                self._removeReservation(conn.dest_port,   conn.dest_label,   conn.bandwidth, conn.start_time, conn.end_time)
             except Exception as e:
                 log.msg('Error ending connection: %s' % e)
                 raise e
         elif conn.allocated or conn.reservation_state == state.RESERVE_HELD: # free reservation if it was allocated/held
-            src_resource = self.connection_manager.getResource(conn.source_port, conn.source_label)
-            dst_resource = self.connection_manager.getResource(conn.dest_port,   conn.dest_label)
-            self.calendar.removeReservation(src_resource, conn.start_time, conn.end_time)
-            self.calendar.removeReservation(dst_resource, conn.start_time, conn.end_time)
+            self._removeReservation(conn.source_port, conn.source_label, conn.bandwidth, conn.start_time, conn.end_time)
+            self._removeReservation(conn.dest_port,   conn.dest_label,   conn.bandwidth, conn.start_time, conn.end_time)
 
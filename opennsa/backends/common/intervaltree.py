@@ -0,0 +1,213 @@
+"""
+Interval tree, used for indexing reservations in the backend calendar.
+
+The tree is a treap (randomized binary search tree) ordered on the interval
+(start, end, value) tuple, where each node is augmented with the largest end
+value in its subtree. This gives expected O(log n) insert, remove, and overlap
+checks.
+
+Each interval can carry a value (e.g., a label value), which is returned along
+with the interval. Intervals are closed, i.e., two intervals sharing an end
+point overlap. The same interval can be inserted multiple times, it will then
+have to be removed the same number of times.
+
+Start and end values can be anything that is comparable, but they must not be
+None. Callers have to coalesce open ends into something comparable.
+"""
+
+import random
+
+
+
+class _Node(object):
+
+    __slots__ = ('start', 'end', 'value', 'count', 'priority', 'max_end', 'left', 'right')
+
+    def __init__(self, start, end, value):
+        self.start      = start
+        self.end        = end
+        self.value      = value
+        self.count      = 1
+        self.priority   = random.random()
+        self.max_end    = end
+        self.left       = None
+        self.right      = None
+
+
+
+def _update(node):
+    max_end = node.end
+    if node.left is not None and node.left.max_end > max_end:
+        max_end = node.left.max_end
+    if node.right is not None and node.right.max_end > max_end:
+        max_end = node.right.max_end
+    node.max_end = max_end
+
+
+def _rotateRight(node):
+    top = node.left
+    node.left = top.right
+    top.right = node
+    _update(node)
+    _update(top)
+    return top
+
+
+def _rotateLeft(node):
+    top = node.right
+    node.right = top.left
+    top.left = node
+    _update(node)
+    _update(top)
+    return top
+
+
+def _insert(node, start, end, value):
+
+    if node is None:
+        return _Node(start, end, value)
+
+    key = (start, end, value)
+    node_key = (node.start, node.end, node.value)
+
+    if key == node_key:
+        node.count += 1
+        return node
+
+    if key < node_key:
+        node.left = _insert(node.left, start, end, value)
+        if node.left.priority > node.priority:
+            return _rotateRight(node)
+    else:
+        node.right = _insert(node.right, start, end, value)
+        if node.right.priority > node.priority:
+            return _rotateLeft(node)
+
+    _update(node)
+    return node
+
+
+def _merge(left, right):
+    # all keys in left must be smaller than all keys in right
+    if left is None:
+        return right
+    if right is None:
+        return left
+
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        _update(left)
+        return left
+    else:
+        right.left = _merge(left, right.left)
+        _update(right)
+        return right
+
+
+def _remove(node, start, end, value):
+
+    if node is None:
+        raise KeyError( (start, end, value) )
+
+    key = (start, end, value)
+    node_key = (node.start, node.end, node.value)
+
+    if key == node_key:
+        if node.count > 1:
+            node.count -= 1
+            return node
+        return _merge(node.left, node.right)
+
+    if key < node_key:
+        node.left = _remove(node.left, start, end, value)
+    else:
+        node.right = _remove(node.right, start, end, value)
+
+    _update(node)
+    return node
+
+
+def _collect(node, start, end, result):
+    # in-order collection of intervals overlapping [start, end]
+    if node is None or node.max_end < start:
+        return
+    _collect(node.left, start, end, result)
+    if node.start <= end:
+        if node.end >= start:
+            result.extend( [ (node.start, node.end, node.value) ] * node.count )
+        _collect(node.right, start, end, result)
+
+
+
+class IntervalTree(object):
+
+    def __init__(self):
+        self._root = None
+        self._size = 0
+
+
+    def __len__(self):
+        return self._size
+
+
+    def __iter__(self):
+        # in-order iteration, i.e., sorted on start, then end, then value
+        stack = []
+        node = self._root
+        while stack or node is not None:
+            if node is not None:
+                stack.append(node)
+                node = node.left
+            else:
+                node = stack.pop()
+                for _ in range(node.count):
+                    yield (node.start, node.end, node.value)
+                node = node.right
+
+
+    def insert(self, start, end, value=None):
+        self._root = _insert(self._root, start, end, value)
+        self._size += 1
+
+
+    def remove(self, start, end, value=None):
+        """
+        Remove an interval. Raises KeyError if the interval is not in the tree.
+        """
+        self._root = _remove(self._root, start, end, value)
+        self._size -= 1
+
+
+    def overlaps(self, start, end):
+        """
+        Returns True if any interval in the tree overlaps [start, end].
+        """
+        node = self._root
+        while node is not None:
+            if node.start <= end and node.end >= start:
+                return True
+            if node.left is not None and node.left.max_end >= start:
+                node = node.left
+            else:
+                node = node.right
+        return False
+
+
+    def findOverlapping(self, start, end):
+        """
+        Returns all intervals overlapping [start, end], sorted on start.
+        """
+        result = []
+        _collect(self._root, start, end, result)
+        return result
+
+
+    def removeEndingBefore(self, time):
+        """
+        Remove all intervals ending before the specified time. Returns the
+        removed intervals.
+        """
+        expired = [ interval for interval in self if interval[1] < time ]
+        for start, end, value in expired:
+            self.remove(start, end, value)
+        return expired
@@ -1,19 +1,34 @@
 """
 Call scheduler. Handles one future call per connection.
 
+All scheduled calls are kept in a single heap, which is driven by one timer in
+the reactor (or test clock). This keeps the reactor timer queue small, even
+with a large number of scheduled connection transitions. Transition times are
+rounded up to whole ticks, and calls due in the same tick are fired together.
+
+Cancelled calls are removed from the heap lazily, i.e., they are skipped when
+they come up, and the heap is compacted when it mostly consists of cancelled
+calls.
+
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011)
 """
 
+import math
+import heapq
 import datetime
 
 from twisted.python import log
-from twisted.internet import reactor, defer, task
+from twisted.internet import reactor, defer
 
 
 
 LOG_SYSTEM = 'opennsa.Scheduler'
 
+TICK = 1.0 # seconds, calls due within the same tick are fired together
+
+COMPACT_THRESHOLD = 1000 # minimum number of cancelled calls before compacting the heap
+
 
 
 def deferTaskFailed(err):
@@ -25,11 +40,83 @@ def deferTaskFailed(err):
 
 
 
-class CallScheduler:
+class CallScheduler(object):
 
     def __init__(self):
         self.scheduled_calls = {}
-        self.clock = reactor # this is needed in order to test scheduled calls
+        self.scheduled_info  = {} # connection id -> ( transition time, call, args ), for listing pending calls
+        self._clock = reactor # this is needed in order to test scheduled calls
+        self._heap = []  # ( due time, sequence number, deferred )
+        self._sequence = 0 # keeps calls due at the same time in scheduling order
+        self._cancelled = 0
+        self._timer = None
+
+
+    def _getClock(self):
+        return self._clock
+
+
+    def _setClock(self, clock):
+        # move pending calls to the new clock, keeping the time left until they are due
+        offset = clock.seconds() - self._clock.seconds()
+        self._heap = [ (due + offset, seq, d) for due, seq, d in self._heap ]
+        self._stopTimer()
+        self._clock = clock
+        self._startTimer()
+
+    clock = property(_getClock, _setClock)
+
+
+    def _stopTimer(self):
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+
+
+    def _startTimer(self):
+        # (re)arm the timer for the first call in the heap
+        while self._heap and self._heap[0][2].called:
+            heapq.heappop(self._heap) # cancelled
+            self._cancelled -= 1
+
+        if not self._heap:
+            self._stopTimer()
+            return
+
+        due = self._heap[0][0]
+        if self._timer is not None and self._timer.active() and self._timer.getTime() <= due:
+            return # timer will fire in time
+
+        self._stopTimer()
+        self._timer = self._clock.callLater(max(due - self._clock.seconds(), 0), self._runDueCalls)
+
+
+    def _runDueCalls(self):
+        self._timer = None
+        now = self._clock.seconds()
+
+        due_calls = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, d = heapq.heappop(self._heap)
+            if d.called:
+                self._cancelled -= 1
+            else:
+                due_calls.append(d)
+
+        self._startTimer()
+
+        for d in due_calls:
+            if not d.called: # may have been cancelled by an earlier call in the batch
+                d.callback(None)
+
+
+    def _callCancelled(self, d):
+        self._cancelled += 1
+        if self._cancelled > COMPACT_THRESHOLD and self._cancelled * 2 > len(self._heap):
+            self._heap = [ entry for entry in self._heap if not entry[2].called and entry[2] is not d ]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
 
 
     def scheduleCall(self, connection_id, transition_time, call, *args):
@@ -50,9 +137,22 @@ class CallScheduler:
         transition_delta_seconds = (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10**6.0
         transition_delta_seconds = max(transition_delta_seconds, 0) # if dt_now is passed during calculation
 
-        d = task.deferLater(self.clock, transition_delta_seconds, call, *args)
+        now = self._clock.seconds()
+        if transition_delta_seconds > 0:
+            due = math.ceil( (now + transition_delta_seconds) / TICK ) * TICK
+        else:
+            due = now
+
+        d = defer.Deferred(self._callCancelled)
+        d.addCallback(lambda _ : call(*args))
         d.addErrback(deferTaskFailed)
+
+        self._sequence += 1
+        heapq.heappush(self._heap, (due, self._sequence, d))
+        self._startTimer()
+
         self.scheduled_calls[connection_id] = d
+        self.scheduled_info[connection_id]  = (transition_time, call, args)
         return d
 
 
@@ -60,15 +160,32 @@ class CallScheduler:
         return connection_id in self.scheduled_calls
 
 
+    def pendingCalls(self):
+        """
+        Returns the calls which have not been run yet, as a list of
+        (connection id, transition time, call, args) tuples.
+        """
+        return [ (connection_id, ) + self.scheduled_info[connection_id]
+                 for connection_id, d in self.scheduled_calls.items() if not d.called ]
+
+
     def cancelCall(self, connection_id):
         try:
             sched_call = self.scheduled_calls.pop(connection_id)
+            self.scheduled_info.pop(connection_id)
             sched_call.cancel()
         except KeyError:
             pass
 
 
     def cancelAllCalls(self):
-        for k in self.scheduled_calls.keys():
-            self.scheduled_calls.pop(k).cancel()
+        # drop the heap first, so cancelling does not have to maintain it
+        self._stopTimer()
+        self._heap = []
+        scheduled_calls = self.scheduled_calls
+        self.scheduled_calls = {}
+        self.scheduled_info  = {}
+        for d in scheduled_calls.values():
+            d.cancel()
+        self._cancelled = 0
 
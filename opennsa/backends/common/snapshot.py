@@ -0,0 +1,106 @@
+"""
+Backend connection snapshot.
+
+On a clean shutdown the generic backend writes its calendars and pending
+scheduled transitions (with the connections they are for) to a snapshot file.
+On startup these are used as they are, instead of being rebuilt from every
+connection in the database.
+
+The snapshot also holds a marker for the connection table: the number of rows,
+the highest id, and the highest change sequence number (the change_seq column
+is set to the transaction id on every insert and update). On startup, the
+snapshot is only used if none of the rows have been removed, and only the
+connections which have changed after it are loaded from the database.
+
+The file consists of a magic string, a format version, a CRC32 checksum, and
+a pickled payload. A snapshot which fails any of the checks is rejected, and
+the backend will do a full restore from the database.
+
+Author: Henrik Thostrup Jensen <htj@nordu.net>
+Copyright: NORDUnet (2016)
+"""
+
+import os
+import time
+import zlib
+import struct
+import cPickle as pickle
+
+
+
+MAGIC   = 'ONSASNAP'
+VERSION = 2
+HEADER  = struct.Struct('!8sBI') # magic, version, crc32 of payload
+
+# connection columns in the snapshot
+COLUMNS = ('id', 'connection_id', 'revision', 'global_reservation_id', 'description', 'requester_nsa', 'reserve_time',
+           'reservation_state', 'provision_state', 'lifecycle_state', 'data_plane_active',
+           'source_network', 'source_port', 'source_label', 'dest_network', 'dest_port', 'dest_label',
+           'start_time', 'end_time', 'symmetrical', 'directionality', 'bandwidth', 'parameter', 'allocated')
+
+
+
+class SnapshotError(Exception):
+    pass
+
+
+
+def connectionRecord(conn):
+    return dict( [ (c, getattr(conn, c, None)) for c in COLUMNS ] )
+
+
+def writeSnapshot(filename, network, marker, calendars, transitions):
+    """
+    Writes the snapshot file. marker is the (row count, highest id, highest
+    change sequence number) of the connection table, calendars the calendar
+    objects of the backend, and transitions a list of (transition time, method
+    name, connection record) tuples. The file is written to a temporary file
+    first, and then moved in place.
+    """
+    payload = pickle.dumps( (network, time.time(), marker, calendars, transitions), pickle.HIGHEST_PROTOCOL )
+    header  = HEADER.pack(MAGIC, VERSION, zlib.crc32(payload) & 0xffffffff)
+
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(header)
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_filename, filename)
+
+
+def readSnapshot(filename, network):
+    """
+    Reads a snapshot file. Returns the snapshot time, marker, calendars, and
+    transitions, as given to writeSnapshot. Raises SnapshotError if the
+    snapshot cannot be used.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    except IOError as e:
+        raise SnapshotError('Cannot read snapshot file %s: %s' % (filename, e))
+
+    if len(data) < HEADER.size:
+        raise SnapshotError('Snapshot file %s is truncated' % filename)
+
+    magic, version, checksum = HEADER.unpack(data[:HEADER.size])
+    payload = data[HEADER.size:]
+
+    if magic != MAGIC:
+        raise SnapshotError('File %s is not a snapshot file' % filename)
+    if version != VERSION:
+        raise SnapshotError('Unsupported snapshot version %i (expected %i)' % (version, VERSION))
+    if zlib.crc32(payload) & 0xffffffff != checksum:
+        raise SnapshotError('Checksum mismatch for snapshot file %s' % filename)
+
+    try:
+        snapshot_network, snapshot_time, marker, calendars, transitions = pickle.loads(payload)
+    except Exception as e:
+        raise SnapshotError('Cannot decode snapshot file %s: %s' % (filename, e))
+
+    if snapshot_network != network:
+        raise SnapshotError('Snapshot is for network %s, not %s' % (snapshot_network, network))
+
+    return snapshot_time, marker, calendars, transitions
+
@@ -7,6 +7,8 @@ from twisted.internet import defer, protocol, reactor, endpoints
 from twisted.conch import error as concherror
 from twisted.conch.ssh import transport, keys, userauth, connection, channel
 
+from opennsa import logging
+
 
 LOG_SYSTEM = 'opennsa.SSH'
 
@@ -104,7 +106,7 @@ class SSHChannel(channel.SSHChannel):
 
     def channelOpen(self, data):
         self.channel_open.callback(self)
-        log.msg('SSH channel open.', debug=True, system=LOG_SYSTEM)
+        logging.debug('SSH channel open.', system=LOG_SYSTEM)
 
 
     def request_exit_status(self, data):
@@ -149,7 +151,7 @@ class SSHConnectionCreator:
             self.proto = proto
             return proto.connection_secure_d
 
-        log.msg('Creating new TCP connection for SSH connection.', debug=True, system=LOG_SYSTEM)
+        logging.debug('Creating new TCP connection for SSH connection.', system=LOG_SYSTEM)
         factory = SSHClientFactory(self.fingerprints)
         point = endpoints.TCP4ClientEndpoint(reactor, self.host, self.port)
         d = point.connect(factory)
@@ -0,0 +1,254 @@
+"""
+Step function, used for tracking bandwidth usage over time in the backend
+capacity calendar.
+
+The function is represented as a set of change points, each with a delta,
+such that the value at time t is the sum of the deltas at or before t. The
+change points are kept in a treap ordered on time, where each node is
+augmented with the sum of the deltas in its subtree and the maximum prefix
+sum in the subtree. This gives expected O(log n) insert, remove, value, and
+peak queries, regardless of how many steps overlap.
+
+Time values can be anything that is comparable, but they must not be None.
+"""
+
+import random
+
+
+
+class _Node(object):
+
+    __slots__ = ('key', 'delta', 'refs', 'priority', 'sum', 'max_prefix', 'left', 'right')
+
+    def __init__(self, key, delta):
+        self.key        = key
+        self.delta      = delta
+        self.refs       = 1
+        self.priority   = random.random()
+        self.sum        = delta
+        self.max_prefix = delta
+        self.left       = None
+        self.right      = None
+
+
+
+def _combine(first, second):
+    # combine (sum, max prefix) of two consecutive sequences, max prefix is None for empty sequences
+    s1, m1 = first
+    s2, m2 = second
+    if m1 is None:
+        return second
+    if m2 is None:
+        return first
+    return s1 + s2, max(m1, s1 + m2)
+
+
+def _aggregate(node):
+    if node is None:
+        return 0, None
+    return node.sum, node.max_prefix
+
+
+def _update(node):
+    agg = _combine( _combine(_aggregate(node.left), (node.delta, node.delta)), _aggregate(node.right) )
+    node.sum, node.max_prefix = agg
+
+
+def _rotateRight(node):
+    top = node.left
+    node.left = top.right
+    top.right = node
+    _update(node)
+    _update(top)
+    return top
+
+
+def _rotateLeft(node):
+    top = node.right
+    node.right = top.left
+    top.left = node
+    _update(node)
+    _update(top)
+    return top
+
+
+def _insert(node, key, delta):
+
+    if node is None:
+        return _Node(key, delta)
+
+    if key == node.key:
+        node.delta += delta
+        node.refs += 1
+    elif key < node.key:
+        node.left = _insert(node.left, key, delta)
+        if node.left.priority > node.priority:
+            return _rotateRight(node)
+    else:
+        node.right = _insert(node.right, key, delta)
+        if node.right.priority > node.priority:
+            return _rotateLeft(node)
+
+    _update(node)
+    return node
+
+
+def _merge(left, right):
+    # all keys in left must be smaller than all keys in right
+    if left is None:
+        return right
+    if right is None:
+        return left
+
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        _update(left)
+        return left
+    else:
+        right.left = _merge(left, right.left)
+        _update(right)
+        return right
+
+
+def _remove(node, key, delta):
+
+    if node is None:
+        raise KeyError(key)
+
+    if key == node.key:
+        if node.refs == 1:
+            return _merge(node.left, node.right)
+        node.delta -= delta
+        node.refs -= 1
+    elif key < node.key:
+        node.left = _remove(node.left, key, delta)
+    else:
+        node.right = _remove(node.right, key, delta)
+
+    _update(node)
+    return node
+
+
+def _queryAbove(node, low):
+    # (sum, max prefix) of the change points with key > low
+    parts = []
+    while node is not None:
+        if node.key <= low:
+            node = node.right
+        else:
+            parts.append(node) # node and its right subtree are above low
+            node = node.left
+    result = (0, None)
+    for node in reversed(parts): # last found part has the lowest keys
+        result = _combine(result, _combine( (node.delta, node.delta), _aggregate(node.right) ))
+    return result
+
+
+def _queryBelow(node, high):
+    # (sum, max prefix) of the change points with key < high
+    result = (0, None)
+    while node is not None:
+        if node.key >= high:
+            node = node.left
+        else:
+            # node and its left subtree are below high, and come before the rest
+            result = _combine(result, _combine( _aggregate(node.left), (node.delta, node.delta) ))
+            node = node.right
+    return result
+
+
+def _query(node, low, high):
+    # (sum, max prefix) of the change points with low < key < high
+    while node is not None:
+        if node.key <= low:
+            node = node.right
+        elif node.key >= high:
+            node = node.left
+        else:
+            return _combine( _combine(_queryAbove(node.left, low), (node.delta, node.delta)), _queryBelow(node.right, high) )
+    return 0, None
+
+
+
+def _collect(node, low, high, result):
+    # in-order collection of (key, delta) for the change points with low < key < high
+    if node is None:
+        return
+    if node.key > low:
+        _collect(node.left, low, high, result)
+    if low < node.key < high:
+        result.append( (node.key, node.delta) )
+    if node.key < high:
+        _collect(node.right, low, high, result)
+
+
+
+class StepFunction(object):
+
+    def __init__(self):
+        self._root = None
+        self._size = 0
+
+
+    def __len__(self):
+        # number of steps added
+        return self._size
+
+
+    def addStep(self, start, end, amount):
+        """
+        Add amount to the function in the half-open interval [start, end).
+        """
+        assert start < end, 'Step must start before it ends'
+        self._root = _insert(self._root, start,  amount)
+        self._root = _insert(self._root, end,   -amount)
+        self._size += 1
+
+
+    def removeStep(self, start, end, amount):
+        """
+        Remove a previously added step. Raises KeyError if the step change
+        points are not in the function.
+        """
+        self._root = _remove(self._root, start,  amount)
+        self._root = _remove(self._root, end,   -amount)
+        self._size -= 1
+
+
+    def value(self, time):
+        """
+        Returns the value of the function at the specified time.
+        """
+        total = 0
+        node = self._root
+        while node is not None:
+            if node.key <= time:
+                total += node.delta
+                if node.left is not None:
+                    total += node.left.sum
+                node = node.right
+            else:
+                node = node.left
+        return total
+
+
+    def peak(self, start, end):
+        """
+        Returns the maximum value of the function in the interval [start, end).
+        """
+        base = self.value(start)
+        _, max_prefix = _query(self._root, start, end)
+        if max_prefix is None:
+            return base
+        return max(base, base + max_prefix)
+
+
+    def changes(self, start, end):
+        """
+        Returns the change points in the open interval (start, end), as a list
+        of (time, delta) tuples, sorted on time.
+        """
+        result = []
+        _collect(self._root, start, end, result)
+        return result
+
@@ -55,7 +55,7 @@ from twisted.python import log
 from twisted.internet import defer
 from twisted.conch.ssh import session
 
-from opennsa import constants as cnt, config
+from opennsa import constants as cnt, config, logging
 from opennsa.backends.common import ssh, genericbackend
 
 LOG_SYSTEM = 'Force10'
@@ -134,51 +134,51 @@ class SSHChannel(ssh.SSHChannel):
         LT = '\r' # line termination
 
         try:
-            log.msg('Requesting shell for sending commands', debug=True, system=LOG_SYSTEM)
+            logging.debug('Requesting shell for sending commands', system=LOG_SYSTEM)
             term = os.environ.get('TERM', 'xterm')
 	    winSize = (25,80,0,0)
 	    ptyReqData = session.packRequest_pty_req(term, winSize, '')
             yield self.conn.sendRequest(self, 'pty-req', ptyReqData, wantReply=1)
             yield self.conn.sendRequest(self, 'shell', '', wantReply=1)
-            log.msg('Got shell', system=LOG_SYSTEM, debug=True)
+            logging.debug('Got shell', system=LOG_SYSTEM)
 
             d = self.waitForData('>')
             yield d
-            log.msg('Got shell ready', system=LOG_SYSTEM, debug=True)
+            logging.debug('Got shell ready', system=LOG_SYSTEM)
 
             # so far so good
 
             d = self.waitForData(':')
             self.write(COMMAND_ENABLE + LT) # This one fails for some reason
             yield d
-            log.msg('Got enable password prompt', system=LOG_SYSTEM, debug=True)
+            logging.debug('Got enable password prompt', system=LOG_SYSTEM)
 
             d = self.waitForData('#')
             self.write(enable_password + LT)
             yield d
 
-            log.msg('Entered enabled mode', debug=True, system=LOG_SYSTEM)
+            logging.debug('Entered enabled mode', system=LOG_SYSTEM)
 
             d = self.waitForData('#')
             self.write(COMMAND_CONFIGURE + LT) # This one fails for some reason
             yield d
 
-            log.msg('Entered configure mode', debug=True, system=LOG_SYSTEM)
+            logging.debug('Entered configure mode', system=LOG_SYSTEM)
 
             for cmd in commands:
-                log.msg('CMD> %s' % cmd, debug=True, system=LOG_SYSTEM)
+                logging.debug('CMD> %s', cmd, system=LOG_SYSTEM)
                 d = self.waitForData('#')
                 self.write(cmd + LT)
                 yield d
 
             # Superfluous COMMAND_END has been removed by hopet
 
-            log.msg('Configuration done, writing configuration.', debug=True, system=LOG_SYSTEM)
+            logging.debug('Configuration done, writing configuration.', system=LOG_SYSTEM)
             d = self.waitForData('#')
             self.write(COMMAND_WRITE + LT)
             yield d
 
-            log.msg('Configuration written. Exiting.', debug=True, system=LOG_SYSTEM)
+            logging.debug('Configuration written. Exiting.', system=LOG_SYSTEM)
             self.write(COMMAND_EXIT + LT)
             # Waiting for the prompt removed by hopet - we could wait forever here! :(
 
@@ -198,7 +198,7 @@ class SSHChannel(ssh.SSHChannel):
 
 
     def dataReceived(self, data):
-        log.msg("DATA:" + data, system=LOG_SYSTEM, debug=True)
+        logging.debug("DATA:%s", data, system=LOG_SYSTEM)
         if len(data) == 0:
             pass
         else:
@@ -230,16 +230,16 @@ class Force10CommandSender:
         # The "correct" solution for this would be to create a connection pool,
         # but that won't happen just now.
 
-        log.msg('Creating new SSH connection', debug=True, system=LOG_SYSTEM)
+        logging.debug('Creating new SSH connection', system=LOG_SYSTEM)
         ssh_connection = yield self.ssh_connection_creator.getSSHConnection()
 
         try:
             channel = SSHChannel(conn=ssh_connection)
             ssh_connection.openChannel(channel)
-            log.msg("Opening channel", system=LOG_SYSTEM, debug=True)
+            logging.debug("Opening channel", system=LOG_SYSTEM)
 
             yield channel.channel_open
-            log.msg("Channel open, sending commands", system=LOG_SYSTEM, debug=True)
+            logging.debug("Channel open, sending commands", system=LOG_SYSTEM)
             yield channel.sendCommands(commands, self.enable_password)
 
         finally:
@@ -25,7 +25,7 @@ import random
 from twisted.python import log
 from twisted.internet import defer
 
-from opennsa import constants as cnt, config
+from opennsa import constants as cnt, config, logging
 from opennsa.backends.common import genericbackend, ssh
 
 
@@ -89,7 +89,7 @@ class SSHChannel(ssh.SSHChannel):
             self.write(COMMAND_CONFIGURE + LT)
             yield d
 
-            log.msg('Entered configure mode', debug=True, system=LOG_SYSTEM)
+            logging.debug('Entered configure mode', system=LOG_SYSTEM)
 
             for cmd in commands:
                 log.msg('CMD> %s' % cmd, system=LOG_SYSTEM)
@@ -112,7 +112,7 @@ class SSHChannel(ssh.SSHChannel):
             log.msg('Error sending commands: %s' % str(e))
             raise e
 
-        log.msg('Commands successfully committed', debug=True, system=LOG_SYSTEM)
+        logging.debug('Commands successfully committed', system=LOG_SYSTEM)
         self.sendEOF()
         self.closeIt()
 
@@ -171,7 +171,7 @@ class JuniperEXCommandSender:
             return channel.channel_open
 
         if self.ssh_connection and not self.ssh_connection.transport.factory.stopped:
-            log.msg('Reusing SSH connection', debug=True, system=LOG_SYSTEM)
+            logging.debug('Reusing SSH connection', system=LOG_SYSTEM)
             return gotSSHConnection(self.ssh_connection)
         else:
             # since creating a new connection should be uncommon, we log it
@@ -71,7 +71,7 @@ Copyright: NORDUnet (2017)
 from twisted.python import log
 from twisted.internet import defer, reactor
 
-from opennsa import constants as cnt, config
+from opennsa import constants as cnt, config, logging
 from opennsa.backends.common import genericbackend, ssh
 
 
@@ -171,7 +171,7 @@ class SSHChannel(ssh.SSHChannel):
             self.write(CONFIGURE + LT)
             yield d
 
-            log.msg('Entered configure mode', debug=True, system=LOG_SYSTEM)
+            logging.debug('Entered configure mode', system=LOG_SYSTEM)
 
             for cmd in commands:
                 log.msg('CMD> %s' % cmd, system=LOG_SYSTEM)
@@ -187,7 +187,7 @@ class SSHChannel(ssh.SSHChannel):
             log.msg('Error sending commands: %s' % str(e))
             raise e
 
-        log.msg('Commands successfully committed', debug=True, system=LOG_SYSTEM)
+        logging.debug('Commands successfully committed', system=LOG_SYSTEM)
         self.sendEOF()
         self.closeIt()
 
@@ -215,7 +215,7 @@ class SSHChannel(ssh.SSHChannel):
     def matchLine(self, line):
 
         if self.wait_line is None and self.wait_defer is None:
-            log.msg('Nothing to wait for line:: ' + line, debug=True, system=LOG_SYSTEM)
+            logging.debug('Nothing to wait for line:: %s', line, system=LOG_SYSTEM)
             return
 
         if self.wait_line and self.wait_defer:
@@ -229,7 +229,7 @@ class SSHChannel(ssh.SSHChannel):
                 d.callback(self)
 
             else:
-                log.msg('Discarding wait line: ' + line, debug=True, system=LOG_SYSTEM)
+                logging.debug('Discarding wait line: %s', line, system=LOG_SYSTEM)
 
         else:
             log.msg('Weird wait configuration: ' + str(self.wait_line) + ' / ' + str(self.wait_defer), system=LOG_SYSTEM)
@@ -273,7 +273,7 @@ class JuniperVPLSCommandSender:
             return channel.channel_open
 
         if self.ssh_connection and not self.ssh_connection.transport.factory.stopped:
-            log.msg('Reusing SSH connection', debug=True, system=LOG_SYSTEM)
+            logging.debug('Reusing SSH connection', system=LOG_SYSTEM)
             return gotSSHConnection(self.ssh_connection)
         else:
             # since creating a new connection should be uncommon, we log it
@@ -15,7 +15,7 @@ import random
 from twisted.python import log
 from twisted.internet import defer
 
-from opennsa import constants as cnt, config
+from opennsa import constants as cnt, config, logging
 from opennsa.backends.common import genericbackend, ssh
 
 
@@ -78,7 +78,7 @@ class SSHChannel(ssh.SSHChannel):
             self.write(COMMAND_CONFIGURE + LT)
             yield d
 
-            log.msg('Entered configure mode', debug=True, system=LOG_SYSTEM)
+            logging.debug('Entered configure mode', system=LOG_SYSTEM)
 
             for cmd in commands:
                 log.msg('CMD> %s' % cmd, system=LOG_SYSTEM)
@@ -101,7 +101,7 @@ class SSHChannel(ssh.SSHChannel):
             log.msg('Error sending commands: %s' % str(e))
             raise e
 
-        log.msg('Commands successfully committed', debug=True, system=LOG_SYSTEM)
+        logging.debug('Commands successfully committed', system=LOG_SYSTEM)
         self.sendEOF()
         self.closeIt()
 
@@ -161,7 +161,7 @@ class JunosEx4550CommandSender:
             return channel.channel_open
 
         if self.ssh_connection:
-            log.msg('Reusing SSH connection', debug=True, system=LOG_SYSTEM)
+            logging.debug('Reusing SSH connection', system=LOG_SYSTEM)
             return gotSSHConnection(self.ssh_connection)
         else:
             # since creating a new connection should be uncommon, we log it
@@ -177,16 +177,16 @@ class JunosEx4550CommandSender:
     def _sendCommands(self, commands):
 
         channel = yield self._getSSHChannel()
-        log.msg('Acquiring ssh session lock', debug=True, system=LOG_SYSTEM)
+        logging.debug('Acquiring ssh session lock', system=LOG_SYSTEM)
         yield self.connection_lock.acquire()
-        log.msg('Got ssh session lock', debug=True, system=LOG_SYSTEM)
+        logging.debug('Got ssh session lock', system=LOG_SYSTEM)
 
         try:
             yield channel.sendCommands(commands)
         finally:
-            log.msg('Releasing ssh session lock', debug=True, system=LOG_SYSTEM)
+            logging.debug('Releasing ssh session lock', system=LOG_SYSTEM)
             self.connection_lock.release()
-            log.msg('Released ssh session lock', debug=True, system=LOG_SYSTEM)
+            logging.debug('Released ssh session lock', system=LOG_SYSTEM)
 
 
     def setupLink(self, connection_id, source_port, dest_port, bandwidth):
@@ -287,8 +287,8 @@ class JunosEx4550CommandGenerator(object):
         self.dest_port = dest_port
         self.bandwidth = bandwidth
         self.network_name = network_name
-        log.msg('Initialised with params src %s dst %s bandwidth %s connectionid %s' %
-                (src_port,dest_port,bandwidth,connection_id), debug=True, system=LOG_SYSTEM)
+        logging.debug('Initialised with params src %s dst %s bandwidth %s connectionid %s',
+                src_port, dest_port, bandwidth, connection_id, system=LOG_SYSTEM)
 
 
     def generateActivateCommand(self):
@@ -297,9 +297,9 @@ class JunosEx4550CommandGenerator(object):
         source_port = self.src_port.port
         dest_port   = self.dest_port.port
         log.msg("%s %s " % (source_port,dest_port))
-        log.msg("Activate commands between %s:%s:%s and %s:%s:%s " % 
-                (source_port.remote_network, source_port.interface, source_port.label.type_,
-                    dest_port.remote_network, dest_port.interface, dest_port.label.type_), debug=True,
+        logging.debug("Activate commands between %s:%s:%s and %s:%s:%s ",
+                source_port.remote_network, source_port.interface, source_port.label.type_,
+                    dest_port.remote_network, dest_port.interface, dest_port.label.type_,
                 system=LOG_SYSTEM)
 
         # Local connection
@@ -319,9 +319,9 @@ class JunosEx4550CommandGenerator(object):
 
         source_port = self.src_port.port
         dest_port   = self.dest_port.port
-        log.msg("Deactivate commands between %s:%s#%s=%s and %s:%s#%s=%s " % 
-                (source_port.remote_network, source_port.interface, source_port.label.type_,self.src_port.value,
-                    dest_port.remote_network, dest_port.interface, dest_port.label.type_,self.dest_port.value), debug=True,
+        logging.debug("Deactivate commands between %s:%s#%s=%s and %s:%s#%s=%s ",
+                source_port.remote_network, source_port.interface, source_port.label.type_,self.src_port.value,
+                    dest_port.remote_network, dest_port.interface, dest_port.label.type_,self.dest_port.value,
                 system=LOG_SYSTEM)
 
         # Local connection 
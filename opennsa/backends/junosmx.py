@@ -12,7 +12,7 @@ import random
 from twisted.python import log
 from twisted.internet import defer
 
-from opennsa import constants as cnt, config
+from opennsa import constants as cnt, config, logging
 from opennsa.backends.common import genericbackend, ssh
 
 
@@ -76,7 +76,7 @@ class SSHChannel(ssh.SSHChannel):
             self.write(COMMAND_CONFIGURE + LT)
             yield d
 
-            log.msg('Entered configure mode', debug=True, system=LOG_SYSTEM)
+            logging.debug('Entered configure mode', system=LOG_SYSTEM)
 
             for cmd in commands:
                 log.msg('CMD> %s' % cmd, system=LOG_SYSTEM)
@@ -99,7 +99,7 @@ class SSHChannel(ssh.SSHChannel):
             log.msg('Error sending commands: %s' % str(e))
             raise e
 
-        log.msg('Commands successfully committed', debug=True, system=LOG_SYSTEM)
+        logging.debug('Commands successfully committed', system=LOG_SYSTEM)
         self.sendEOF()
         self.closeIt()
 
@@ -160,7 +160,7 @@ class JUNOSCommandSender:
             return channel.channel_open
 
         if self.ssh_connection:
-            log.msg('Reusing SSH connection', debug=True, system=LOG_SYSTEM)
+            logging.debug('Reusing SSH connection', system=LOG_SYSTEM)
             return gotSSHConnection(self.ssh_connection)
         else:
             # since creating a new connection should be uncommon, we log it
@@ -176,16 +176,16 @@ class JUNOSCommandSender:
     def _sendCommands(self, commands):
 
         channel = yield self._getSSHChannel()
-        log.msg('Acquiring ssh session lock', debug=True, system=LOG_SYSTEM)
+        logging.debug('Acquiring ssh session lock', system=LOG_SYSTEM)
         yield self.connection_lock.acquire()
-        log.msg('Got ssh session lock', debug=True, system=LOG_SYSTEM)
+        logging.debug('Got ssh session lock', system=LOG_SYSTEM)
 
         try:
             yield channel.sendCommands(commands)
         finally:
-            log.msg('Releasing ssh session lock', debug=True, system=LOG_SYSTEM)
+            logging.debug('Releasing ssh session lock', system=LOG_SYSTEM)
             self.connection_lock.release()
-            log.msg('Released ssh session lock', debug=True, system=LOG_SYSTEM)
+            logging.debug('Released ssh session lock', system=LOG_SYSTEM)
 
 
     def setupLink(self, connection_id, source_port, dest_port, bandwidth):
@@ -320,8 +320,8 @@ class JUNOSCommandGenerator(object):
         self.bandwidth = bandwidth
         self.junos_routers = junos_routers
         self.network_name = network_name
-        log.msg('Initialised with params src %s dst %s bandwidth %s connectionid %s' %
-                (src_port,dest_port,bandwidth,connection_id), debug=True, system=LOG_SYSTEM)
+        logging.debug('Initialised with params src %s dst %s bandwidth %s connectionid %s',
+                src_port, dest_port, bandwidth, connection_id, system=LOG_SYSTEM)
 
 
     def generateActivateCommand(self):
@@ -329,7 +329,7 @@ class JUNOSCommandGenerator(object):
 
         source_port = self.src_port.port
         dest_port   = self.dest_port.port
-        log.msg("Activate commands between %s and %s " %  (source_port,dest_port), debug=True, system=LOG_SYSTEM)
+        logging.debug("Activate commands between %s and %s ", source_port, dest_port, system=LOG_SYSTEM)
 
         # Local connection 
         if source_port.remote_network is None and dest_port.remote_network is None:
@@ -347,7 +347,7 @@ class JUNOSCommandGenerator(object):
 
         source_port = self.src_port.port
         dest_port   = self.dest_port.port
-        log.msg("Deactivate commands between %s and %s " %  (source_port,dest_port), debug=True, system=LOG_SYSTEM)
+        logging.debug("Deactivate commands between %s and %s ", source_port, dest_port, system=LOG_SYSTEM)
 
         # Local connection 
         if source_port.remote_network is None and dest_port.remote_network is None:
@@ -49,7 +49,7 @@ from twisted.internet.defer import succeed
 from twisted.web.iweb import IBodyProducer
 from twisted.internet.ssl import ClientContextFactory
 
-from opennsa import constants as cnt, config
+from opennsa import constants as cnt, config, logging
 from opennsa.backends.common import genericbackend
 
 
@@ -118,7 +118,7 @@ class JUNOSSPACECommandSender:
     @defer.inlineCallbacks
     def _sendCommands(self, configlet_payload):
 
-        log.msg('Sending junosspace command', debug=True, system=LOG_SYSTEM)
+        logging.debug('Sending junosspace command', system=LOG_SYSTEM)
         authorization_string = b64encode(b"{}:{}".format(self.space_user,self.space_password))
         payload = JUNOSSPACEPayloadProducer(configlet_payload)
         api_configlet_url = "{}/configuration-management/cli-configlets/{}/apply-configlet".format(self.space_api_url,configlet_payload['configlet_id'])
@@ -146,24 +146,24 @@ class JUNOSSPACECommandSender:
         return d
 
     def _cbError(self,failure):
-        log.msg("{}".format(failure.value.reasons[0].printTraceback()),debug=True, system=LOG_SYSTEM)
+        logging.debug("%s", failure.value.reasons[0].printTraceback(), system=LOG_SYSTEM)
         print type(failure.value), failure # catch error here
 
     def printBody(self,body):
-        log.msg('Received body from junosspace {}'.format(body), debug=True, system=LOG_SYSTEM)
+        logging.debug('Received body from junosspace %s', body, system=LOG_SYSTEM)
 
 
     def setupLink(self, connection_id, source_port, dest_port, bandwidth):
         cg = JUNOSSPACECommandGenerator(connection_id,source_port,dest_port,self.gts_routers,self.network_name,bandwidth)
         commands = cg.generateActivateCommand() 
-        log.msg('Commands {}'.format(commands), debug=True, system=LOG_SYSTEM)
+        logging.debug('Commands %s', commands, system=LOG_SYSTEM)
         return self._sendCommands(commands)
 
 
     def teardownLink(self, connection_id, source_port, dest_port, bandwidth):
         cg = JUNOSSPACECommandGenerator(connection_id,source_port,dest_port,self.gts_routers,self.network_name,bandwidth)
         commands = cg.generateDeactivateCommand() 
-        log.msg('Commands {}'.format(commands), debug=True, system=LOG_SYSTEM)
+        logging.debug('Commands %s', commands, system=LOG_SYSTEM)
         return self._sendCommands(commands)
 
 
@@ -276,10 +276,10 @@ def JUNOSSPACEBackend(network_name, nrm_ports , parent_requester, cfg):
         log.msg("%s" % (junosspace_router))
         space_routers[r] = junosspace_router
     cm = JUNOSSPACEConnectionManager(port_map,space_user,space_password,space_api_url,space_routers,network_name)
-    log.msg("Junosspace local activate configlet id {}".format(LOCAL_ACTIVATE_CONFIGLET_ID),debug=True,system=LOG_SYSTEM)
-    log.msg("Junosspace remote activate configlet id {}".format(REMOTE_ACTIVATE_CONFIGLET_ID),debug=True,system=LOG_SYSTEM)
-    log.msg("Junosspace local deactivate configlet id {}".format(LOCAL_DEACTIVATE_CONFIGLET_ID),debug=True,system=LOG_SYSTEM)
-    log.msg("Junosspace remote deactivate configlet id {}".format(REMOTE_DEACTIVATE_CONFIGLET_ID),debug=True,system=LOG_SYSTEM)
+    logging.debug("Junosspace local activate configlet id %s", LOCAL_ACTIVATE_CONFIGLET_ID, system=LOG_SYSTEM)
+    logging.debug("Junosspace remote activate configlet id %s", REMOTE_ACTIVATE_CONFIGLET_ID, system=LOG_SYSTEM)
+    logging.debug("Junosspace local deactivate configlet id %s", LOCAL_DEACTIVATE_CONFIGLET_ID, system=LOG_SYSTEM)
+    logging.debug("Junosspace remote deactivate configlet id %s", REMOTE_DEACTIVATE_CONFIGLET_ID, system=LOG_SYSTEM)
 
     return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name)
 
@@ -293,8 +293,8 @@ class JUNOSSPACECommandGenerator(object):
         self.bandwidth = bandwidth
         self.space_routers = space_routers
         self.network_name = network_name
-        log.msg('Initialised with params src %s dst %s bandwidth %s connectionid %s' %
-                (src_port,dest_port,bandwidth,connection_id), debug=True, system=LOG_SYSTEM)
+        logging.debug('Initialised with params src %s dst %s bandwidth %s connectionid %s',
+                src_port, dest_port, bandwidth, connection_id, system=LOG_SYSTEM)
 
 
     def generateActivateCommand(self):
@@ -302,7 +302,7 @@ class JUNOSSPACECommandGenerator(object):
         source_port = self.src_port.port
         dest_port   = self.dest_port.port
         log.msg("%s %s " % (self.src_port,self.dest_port))
-        log.msg("Activate commands between %s and %s " %  (source_port,dest_port), debug=True, system=LOG_SYSTEM)
+        logging.debug("Activate commands between %s and %s ", source_port, dest_port, system=LOG_SYSTEM)
 
         # Local connection 
         if source_port.remote_network is None and dest_port.remote_network is None:
@@ -320,7 +320,7 @@ class JUNOSSPACECommandGenerator(object):
 
         source_port = self.src_port.port
         dest_port   = self.dest_port.port
-        log.msg("Deactivate commands between %s and %s " %  (source_port,dest_port), debug=True, system=LOG_SYSTEM)
+        logging.debug("Deactivate commands between %s and %s ", source_port, dest_port, system=LOG_SYSTEM)
 
         # Local connection 
         if source_port.remote_network is None and dest_port.remote_network is None:
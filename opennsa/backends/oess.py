@@ -21,7 +21,7 @@ from twisted.web.client import Agent, readBody
 from twisted.web.http_headers import Headers
 
 from opennsa.backends.common import genericbackend
-from opennsa import constants as cnt, config
+from opennsa import constants as cnt, config, logging
 
 
 LOG_SYSTEM = 'opennsa.OESS'
@@ -43,7 +43,7 @@ def http_query(conn, sub_path):
     """
     full_url = conn.url + sub_path
     full_url = full_url.encode('latin-1')
-    log.msg("http_query: %r" % full_url, debug=True, system=LOG_SYSTEM)
+    logging.debug("http_query: %r", full_url, system=LOG_SYSTEM)
 
     context_factory = WebClientContextFactory()
     agent = Agent(reactor, context_factory)
@@ -241,60 +241,60 @@ class OessSetup(object):
     def oess_provisioning(self, src_interface, dst_interface):
         log.msg("Provisioning OESS circuit... ", system=LOG_SYSTEM)
         try:
-            log.msg("01 - Getting All OESS Workgroup' Workgroup_IDs",
-                    debug=True, system=LOG_SYSTEM)
+            logging.debug("01 - Getting All OESS Workgroup' Workgroup_IDs",
+                    system=LOG_SYSTEM)
             wg_ids = yield oess_get_workgroups(self.conn)
 
-            log.msg("02 - Getting our Group's ID",
-                    debug = True, system=LOG_SYSTEM)
+            logging.debug("02 - Getting our Group's ID",
+                    system=LOG_SYSTEM)
             self.workgroup_id = oess_get_workgroup_id(wg_ids, self.workgroup)
 
-            log.msg("03 - Getting source switch, interface and VLAN from src_interface",
-                    debug=True, system=LOG_SYSTEM)
+            logging.debug("03 - Getting source switch, interface and VLAN from src_interface",
+                    system=LOG_SYSTEM)
             s_sw, s_int, s_vlan = oess_get_port_vlan(src_interface)
 
-            log.msg("04 - Querying for all interfaces of the source switch",
-                    debug=True, system=LOG_SYSTEM)
+            logging.debug("04 - Querying for all interfaces of the source switch",
+                    system=LOG_SYSTEM)
             s_switch_interfaces = yield oess_get_switch_ports(self.conn, s_sw)
 
-            log.msg("05 - Validating switch_interfaces with interface provided",
-                    debug=True, system=LOG_SYSTEM)
+            logging.debug("05 - Validating switch_interfaces with interface provided",
+                    system=LOG_SYSTEM)
             oess_validate_ports(s_switch_interfaces, s_int)
 
-            log.msg("06 - Verifying if source VLAN is available",
-                    debug=True, system=LOG_SYSTEM)
+            logging.debug("06 - Verifying if source VLAN is available",
+                    system=LOG_SYSTEM)
             is_available = yield oess_query_vlan_availability(self.conn, s_sw, s_int, s_vlan)
             oess_confirm_vlan_availability(is_available, s_vlan)
 
-            log.msg("07 - Get destination switch, interface and VLAN from dst_interface",
-                    debug=True, system=LOG_SYSTEM)
+            logging.debug("07 - Get destination switch, interface and VLAN from dst_interface",
+                    system=LOG_SYSTEM)
             d_sw, d_int, d_vlan = oess_get_port_vlan(dst_interface)
 
-            log.msg("08 - Querying for all interfaces of the destination switch",
-                    debug=True, system=LOG_SYSTEM)
+            logging.debug("08 - Querying for all interfaces of the destination switch",
+                    system=LOG_SYSTEM)
             d_switch_interfaces = yield oess_get_switch_ports(self.conn, d_sw)
 
-            log.msg("09 - Validating switch_interfaces with interface provided",
-                    debug=True, system=LOG_SYSTEM)
+            logging.debug("09 - Validating switch_interfaces with interface provided",
+                    system=LOG_SYSTEM)
             oess_validate_ports(d_switch_interfaces, d_int)
 
-            log.msg("10 - Verifying if destination VLAN is available",
-                    debug=True, system=LOG_SYSTEM)
+            logging.debug("10 - Verifying if destination VLAN is available",
+                    system=LOG_SYSTEM)
             is_available = yield oess_query_vlan_availability(self.conn, d_sw, d_int, d_vlan)
             oess_confirm_vlan_availability(is_available, d_vlan)
 
-            log.msg("11 - Querying for primary path",
-                    debug=True, system=LOG_SYSTEM)
+            logging.debug("11 - Querying for primary path",
+                    system=LOG_SYSTEM)
             p_path = yield oess_get_path(self.conn, s_sw, d_sw)
             primary = oess_process_path(p_path)
 
-            log.msg("12 - Querying for backup path",
-                    debug=True, system=LOG_SYSTEM)
+            logging.debug("12 - Querying for backup path",
+                    system=LOG_SYSTEM)
             b_path = yield oess_get_path(self.conn, s_sw, d_sw, primary)
             backup = oess_process_path(b_path)
 
-            log.msg("13 - Provisioning circuit...",
-                    debug=True, system=LOG_SYSTEM)
+            logging.debug("13 - Provisioning circuit...",
+                    system=LOG_SYSTEM)
             result = yield oess_provision_circuit(self.conn, self.workgroup_id,
                                                   s_sw, s_int, s_vlan,
                                                   d_sw, d_int, d_vlan,
@@ -313,16 +313,16 @@ class OessSetup(object):
     def oess_circuit_removal(self, src_interface, dst_interface):
         log.msg("Removing OESS circuit", system=LOG_SYSTEM)
         try:
-            log.msg("01 - Getting list of circuits", debug=True, system=LOG_SYSTEM)
+            logging.debug("01 - Getting list of circuits", system=LOG_SYSTEM)
             circuits = yield oess_get_circuits(self.conn, self.workgroup_id)
 
-            log.msg("02 - Getting Circuit ID", debug=True, system=LOG_SYSTEM)
+            logging.debug("02 - Getting Circuit ID", system=LOG_SYSTEM)
             circuit_id = oess_get_circuit_id(circuits, src_interface, dst_interface)
 
             if not circuit_id:
-                log.msg("OESS circuit not found!", debug=True, system=LOG_SYSTEM)
+                logging.debug("OESS circuit not found!", system=LOG_SYSTEM)
             else:
-                log.msg("03 - Cancelling Circuit ID", debug=True, system=LOG_SYSTEM)
+                logging.debug("03 - Cancelling Circuit ID", system=LOG_SYSTEM)
                 result = yield oess_cancel_circuit(self.conn, str(circuit_id),
                                                    self.workgroup_id)
                 try:
@@ -386,7 +386,7 @@ class OESSConnectionManager:
         return True
 
     def setupLink(self, connection_id, source_target, dest_target, bandwidth):
-        log.msg('OESS: setupLink', debug=True, system=self.log_system)
+        logging.debug('OESS: setupLink', system=self.log_system)
         self.oess_conn.setupLink(source_target, dest_target)
         log.msg('Link %s -> %s up' % (source_target, dest_target),
                 system=self.log_system)
@@ -410,7 +410,7 @@ def OESSBackend(network_name, nrm_ports, parent_requester, cfg):
     """
     OESS Backend definition
     """
-    log.msg('OESS: OESSBackend', debug=True, system=LOG_SYSTEM)
+    logging.debug('OESS: OESSBackend', system=LOG_SYSTEM)
     name = 'OESS NRM %s' % network_name
     # for the generic backend
     nrm_map = dict([(p.name, p) for p in nrm_ports])
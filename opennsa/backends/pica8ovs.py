@@ -10,7 +10,7 @@ import random
 from twisted.python import log
 from twisted.internet import defer
 
-from opennsa import constants as cnt, config
+from opennsa import constants as cnt, config, logging
 from opennsa.backends.common import ssh, genericbackend
 
 LOG_SYSTEM = 'opennsa.pica8ovs'
@@ -82,7 +82,7 @@ class SSHChannel(ssh.SSHChannel):
             self.write(COMMAND_ECHO + LT)
             yield d
 
-            log.msg('Ready', debug=True, system=LOG_SYSTEM)
+            logging.debug('Ready', system=LOG_SYSTEM)
 
             for cmd in commands:
                 log.msg('CMD> %s' % cmd, system=LOG_SYSTEM)
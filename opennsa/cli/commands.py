@@ -45,6 +45,10 @@ def _handleEvent(event):
     if notification_type == 'errorEvent':
         log.msg('Error event: %s' % str(entry))
         return True
+    elif notification_type == 'messageDeliveryTimeout':
+        cid, nid, timestamp, correlation_id = entry
+        log.msg('Connection %s: Provider could not deliver message with correlation id %s' % (cid, correlation_id))
+        return True
     elif notification_type == 'dataPlaneStateChange':
         cid, nid, timestamp, dps = entry
         active, version, consistent = dps
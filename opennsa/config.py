@@ -21,6 +21,11 @@ DEFAULT_TCP_PORT        = 9080
 DEFAULT_TLS_PORT        = 9443
 DEFAULT_VERIFY          = True
 DEFAULT_CERTIFICATE_DIR = '/etc/ssl/certs' # This will work on most mordern linux distros
+DEFAULT_HTTP_MAX_CONNECTIONS = 4    # persistent connections per peer
+DEFAULT_HTTP_IDLE_TIMEOUT    = 60   # seconds
+DEFAULT_CALLBACK_QUEUE       = False # requires the outbound_messages table, which existing installations do not have
+DEFAULT_SOAP_MAX_SIZE        = 16 * 1024 * 1024 # bytes, requests from peers only
+DEFAULT_SOAP_MAX_DEPTH       = 100
 
 
 # config blocks and options
@@ -50,6 +55,11 @@ PEERS            = 'peers'
 POLICY           = 'policy'
 PLUGIN           = 'plugin'
 SERVICE_ID_START = 'serviceid_start'
+HTTP_MAX_CONNECTIONS = 'httpmaxconnections'
+HTTP_IDLE_TIMEOUT    = 'httpidletimeout'
+CALLBACK_QUEUE       = 'callbackqueue'
+SOAP_MAX_SIZE        = 'soapmaxsize'
+SOAP_MAX_DEPTH       = 'soapmaxdepth'
 
 # database
 DATABASE                = 'database'    # mandatory
@@ -75,6 +85,10 @@ _SSH_PRIVATE_KEY        = 'privatekey'
 
 AS_NUMBER              = 'asnumber'
 
+# generic backend
+SNAPSHOT_FILE           = 'snapshot'    # optional, connection snapshot file for fast restarts
+LABEL_ALLOCATION        = 'labelallocation' # optional, label allocation strategy: firstfit (default), lastfit, roundrobin, lru, random
+
 # TODO: Don't do backend specifics for everything, it causes confusion, and doesn't really solve anything
 
 # juniper block - same for mx / ex backends
@@ -267,6 +281,31 @@ def readVerifyConfig(cfg):
     except ConfigParser.NoOptionError:
         vc[SERVICE_ID_START] = None
 
+    try:
+        vc[HTTP_MAX_CONNECTIONS] = cfg.getint(BLOCK_SERVICE, HTTP_MAX_CONNECTIONS)
+    except ConfigParser.NoOptionError:
+        vc[HTTP_MAX_CONNECTIONS] = DEFAULT_HTTP_MAX_CONNECTIONS
+
+    try:
+        vc[HTTP_IDLE_TIMEOUT] = cfg.getint(BLOCK_SERVICE, HTTP_IDLE_TIMEOUT)
+    except ConfigParser.NoOptionError:
+        vc[HTTP_IDLE_TIMEOUT] = DEFAULT_HTTP_IDLE_TIMEOUT
+
+    try:
+        vc[CALLBACK_QUEUE] = cfg.getboolean(BLOCK_SERVICE, CALLBACK_QUEUE)
+    except ConfigParser.NoOptionError:
+        vc[CALLBACK_QUEUE] = DEFAULT_CALLBACK_QUEUE
+
+    try:
+        vc[SOAP_MAX_SIZE] = cfg.getint(BLOCK_SERVICE, SOAP_MAX_SIZE)
+    except ConfigParser.NoOptionError:
+        vc[SOAP_MAX_SIZE] = DEFAULT_SOAP_MAX_SIZE
+
+    try:
+        vc[SOAP_MAX_DEPTH] = cfg.getint(BLOCK_SERVICE, SOAP_MAX_DEPTH)
+    except ConfigParser.NoOptionError:
+        vc[SOAP_MAX_DEPTH] = DEFAULT_SOAP_MAX_DEPTH
+
     # we always extract certdir and verify as we need that for performing https requests
     try:
         certdir = cfg.get(BLOCK_SERVICE, CERTIFICATE_DIR)
@@ -3,13 +3,25 @@ SSL/TLS context definition.
 
 Most of this code is borrowed from the SGAS 3.X LUTS codebase.
 NORDUnet holds the copyright for SGAS 3.X LUTS and OpenNSA.
+
+Outbound connections resume TLS sessions (session ids or tickets), so only
+the first connection to a peer pays for a full handshake and certificate
+chain verification. The last connection with a completed handshake, i.e.,
+where the certificate chain passed the verify callback, is kept per peer
+(host, port), and its session is taken when connecting to the peer again.
+The session is taken late, as TLS 1.3 sends session tickets after the
+handshake. If the peer does not accept a session, OpenSSL falls back to a
+full handshake.
 """
 
 import os
 
+from zope.interface import implementer
+
 from OpenSSL import SSL
 
 from twisted.python import log
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
 
 LOG_SYSTEM = 'CTXFactory'
 
@@ -20,12 +32,14 @@ class RequestContextFactory:
     Context Factory for issuing requests to SSL/TLS services without having
     a client certificate.
     """
-    def __init__(self, certificate_dir, verify):
+    def __init__(self, certificate_dir, verify, resume_sessions=True):
 
         self.certificate_dir    = certificate_dir
         self.verify             = verify
+        self.resume_sessions    = resume_sessions
 
         self.ctx = None
+        self.connections = {} # (host, port) -> SSL.Connection, last connection with a completed handshake
 
 
     def getContext(self):
@@ -37,6 +51,33 @@ class RequestContextFactory:
             return self.ctx
 
 
+    def creatorForNetloc(self, hostname, port):
+        """
+        Returns a connection creator for outbound connections to a peer
+        (see IPolicyForHTTPS), which resumes the TLS session for the peer.
+        """
+        return PeerConnectionCreator(self, (hostname, port))
+
+
+    def getSession(self, peer):
+        """
+        Returns the session to resume for the peer, or None.
+        """
+        if not self.resume_sessions:
+            return None
+        conn = self.connections.get(peer)
+        if conn is None:
+            return None
+        return conn.get_session()
+
+
+    def _infoCallback(self, conn, where, ret):
+        if where & SSL.SSL_CB_HANDSHAKE_DONE:
+            peer = conn.get_app_data()
+            if isinstance(peer, tuple): # outbound connection from PeerConnectionCreator
+                self.connections[peer] = conn
+
+
     def _createContext(self):
 
         def verify_callback(conn, x509, error_number, error_depth, allowed):
@@ -53,9 +94,9 @@ class RequestContextFactory:
         ctx.set_options(SSL.OP_NO_SSLv2)
         ctx.set_options(SSL.OP_NO_SSLv3)
 
-        # disable tls session id, as the twisted tls protocol seems to break on them
-        ctx.set_session_cache_mode(SSL.SESS_CACHE_OFF)
-        ctx.set_options(SSL.OP_NO_TICKET)
+        # sessions are resumed explicitly per peer (see PeerConnectionCreator), the cache mode just marks us as client
+        ctx.set_session_cache_mode(SSL.SESS_CACHE_CLIENT)
+        ctx.set_info_callback(self._infoCallback)
 
         ctx.set_verify(SSL.VERIFY_PEER, verify_callback)
 
@@ -92,5 +133,36 @@ class ContextFactory(RequestContextFactory):
         ctx.use_certificate_chain_file(self.public_key_path)
         ctx.check_privatekey() # sanity check
 
+        # the context is also used for the service, which needs a session id context
+        # for resuming sessions of clients with certificates (handshakes fail without it)
+        ctx.set_session_cache_mode(SSL.SESS_CACHE_BOTH)
+        ctx.set_session_id(b'opennsa')
+
         return ctx
 
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class PeerConnectionCreator:
+    """
+    Creates outbound TLS connections to a single peer, resuming the last
+    session with the peer, if there is one.
+    """
+    def __init__(self, ctx_factory, peer):
+
+        self.ctx_factory    = ctx_factory
+        self.peer           = peer
+
+
+    def clientConnectionForTLS(self, tls_protocol):
+
+        conn = SSL.Connection(self.ctx_factory.getContext(), None)
+        conn.set_app_data(self.peer)
+        conn.set_connect_state()
+
+        session = self.ctx_factory.getSession(self.peer)
+        if session is not None:
+            conn.set_session(session)
+
+        return conn
+
@@ -26,6 +26,16 @@ from opennsa.ext.iso8601 import iso8601
 
 LOG_SYSTEM = 'opennsa.Database'
 
+# columns added to the schema after release, which are required, and the file which adds them to an existing database
+REQUIRED_UPGRADES = [
+    ('service_connections', 'sub_connection_count', 'datafiles/schema-upgrade-dataplane-counters.sql')
+]
+
+
+
+class DatabaseSchemaError(Exception):
+    pass
+
 
 # psycopg2 plumming to get automatic adaption
 def adaptLabel(label):
@@ -74,6 +84,13 @@ def setupDatabase(database, user, password=None, host=None, connection_id_start=
     DT = psycopg2.extensions.new_type((timestamptz_oid,), "timestamptz", castDatetime)
     psycopg2.extensions.register_type(DT)
 
+    # fail on startup, rather than on the first request using the column
+    for table, column, upgrade_file in REQUIRED_UPGRADES:
+        cur.execute("SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = %s", (table, column))
+        if cur.fetchone() is None:
+            conn.close()
+            raise DatabaseSchemaError('Database schema is out of date (no column %s in %s). Upgrade it with %s' % (column, table, upgrade_file))
+
     if connection_id_start:
         r = cur.execute("INSERT INTO backend_connection_id (connection_id) VALUES (%s) ON CONFLICT DO NOTHING;", (connection_id_start,) )
         conn.commit()
@@ -97,10 +114,28 @@ class SubConnection(DBObject):
     BELONGSTO = ['ServiceConnection']
 
 
+def dataPlaneStatus(conn):
+    """
+    Returns the aggregated data plane status (active, version, consistent) of
+    a service connection, computed from the counters on the connection.
+    """
+    if conn.sub_connection_count == 0: # apparently this can happen
+        return (False, 0, False)
+
+    active      = conn.data_plane_active_count == conn.sub_connection_count
+    version     = conn.data_plane_max_version
+    consistent  = conn.data_plane_inconsistent_count == 0
+    return (active, version, consistent)
+
+
 class STPAuthz(DBObject):
     TABLENAME = 'stp_authz'
 
 
+class OutboundMessage(DBObject):
+    TABLENAME = 'outbound_messages'
+
+
 # Not really needed
 class BackendConnectionID(DBObject):
     TABLENAME = 'backend_connection_id'
@@ -4,7 +4,7 @@ from twisted.python import log
 from twisted.internet import defer, task, reactor
 from twisted.application import service
 
-from opennsa import nsa, constants as cnt
+from opennsa import nsa, constants as cnt, logging
 from opennsa.protocols.shared import httpclient
 from opennsa.discovery.bindings import discovery
 from opennsa.topology.nmlxml import _baseName # nasty but I need it
@@ -49,7 +49,7 @@ class FetcherService(service.Service):
 
         defs = []
         for peer in self.peers:
-            log.msg('Fetching %s' % peer.url, debug=True, system=LOG_SYSTEM)
+            logging.debug('Fetching %s', peer.url, system=LOG_SYSTEM)
             d = httpclient.httpRequest(peer.url, '', {}, 'GET', timeout=10, ctx_factory=self.ctx_factory)
             d.addCallbacks(self.gotDocument, self.retrievalFailed, callbackArgs=(peer,), errbackArgs=(peer,))
             defs.append(d)
@@ -68,7 +68,7 @@ class FetcherService(service.Service):
             log.msg('Got empty NSA discovery document (URL: %s)' % peer.url, system=LOG_SYSTEM)
             return
 
-        log.msg('Got NSA description from %s (%i bytes)' % (peer.url, len(result)), debug=True, system=LOG_SYSTEM)
+        logging.debug('Got NSA description from %s (%i bytes)', peer.url, len(result), system=LOG_SYSTEM)
         try:
             nsa_description = discovery.parse(result)
 
@@ -1,6 +1,12 @@
 """
 Logging functionality.
 
+Debug, profile, and payload messages are only written if asked for. The
+debug, profile, and payload functions check this before the message is
+formatted, so call sites pay nothing for messages which would be thrown
+away (payload messages contain full SOAP bodies). The message is formatted
+with the arguments, like: logging.debug('Got %s', value, system=LOG_SYSTEM)
+
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2012)
 """
@@ -15,6 +21,41 @@ from twisted.python import log
 # almost iso, we dump the T in the middle (makes it more tricky to read imho)
 TIME_FORMAT = "%Y-%m-%d %H:%M:%SZ"
 
+# what is logged, set by the DebugLogObserver (without it, everything is logged, as with plain log.msg)
+debug_enabled   = True
+profile_enabled = True
+payload_enabled = True
+
+# twisted log namespaces which are not written, the http client connection pool logs a factory start and stop for every connection
+QUIET_NAMESPACES = ( 'twisted.web.client._HTTP11ClientFactory', )
+
+
+
+def setEnabled(debug=True, profile=True, payload=True):
+    global debug_enabled, profile_enabled, payload_enabled
+    debug_enabled   = debug
+    profile_enabled = profile
+    payload_enabled = payload
+
+
+def _format(message, args):
+    return message % args if args else message
+
+
+def debug(message, *args, **kw):
+    if debug_enabled:
+        log.msg(_format(message, args), debug=True, **kw)
+
+
+def profile(message, *args, **kw):
+    if profile_enabled:
+        log.msg(_format(message, args), profile=True, **kw)
+
+
+def payload(message, *args, **kw):
+    if payload_enabled:
+        log.msg(_format(message, args), payload=True, **kw)
+
 
 
 class DebugLogObserver(log.FileLogObserver):
@@ -26,6 +67,7 @@ class DebugLogObserver(log.FileLogObserver):
         self.debug = debug
         self.profile = profile
         self.payload = payload
+        setEnabled(debug, profile, payload)
 
 
     def formatTime(self, when):
@@ -43,6 +85,8 @@ class DebugLogObserver(log.FileLogObserver):
             pass # don't print profile messages if we didn't ask for it
         elif self.payload is False and eventDict.get('payload', False):
             pass # don't print payload message if we didn't ask for it
+        elif eventDict.get('log_namespace') in QUIET_NAMESPACES:
+            pass
         else:
             log.FileLogObserver.emit(self, eventDict)
 
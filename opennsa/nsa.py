@@ -165,10 +165,14 @@ class Label(object):
         lv = [ range(lr[0], lr[1]+1) for lr in self.values ]
         return list(itertools.chain.from_iterable( lv ) )
 
-    def randomLabel(self):
+    def randomLabel(self, strategy=None, key=None):
+        # strategy is a label allocation strategy (see opennsa.backends.common.allocation)
+        # key is the allocation key, for strategies keeping state between selections
+        if strategy is not None:
+            return strategy.select(self, key)
         # not evenly distributed, but that isn't promised anyway
         label_range = random.choice(self.values)
-        return random.randint(label_range[0], label_range[1]+1)
+        return random.randint(label_range[0], label_range[1])
 
     @staticmethod
     def canMatch(l1, l2):
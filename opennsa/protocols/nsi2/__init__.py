@@ -14,11 +14,12 @@ from opennsa.protocols.nsi2 import providerservice, providerclient, provider, \
 
 
 
-def setupProvider(child_provider, top_resource, tls=False, ctx_factory=None, allowed_hosts=None):
+def setupProvider(child_provider, top_resource, tls=False, ctx_factory=None, allowed_hosts=None, outbound_queue=None, max_payload_size=None):
 
-    soap_resource = soapresource.setupSOAPResource(top_resource, 'CS2', allowed_hosts=allowed_hosts)
+    # only requests from peers are size limited, not confirmations and notifications to the requester
+    soap_resource = soapresource.setupSOAPResource(top_resource, 'CS2', allowed_hosts=allowed_hosts, max_payload_size=max_payload_size)
 
-    provider_client = providerclient.ProviderClient(ctx_factory)
+    provider_client = providerclient.ProviderClient(ctx_factory, outbound_queue)
 
     nsi2_provider = provider.Provider(child_provider, provider_client)
 
@@ -3,10 +3,18 @@ Web Service protocol for OpenNSA.
 
 Note: This is the provider client, i.e. it speak to requester services
 
+If an outbound queue is given, messages are stored and delivered by the
+queue, which retries until the message is delivered or expires. For an
+expired message, a messageDeliveryTimeout notification is queued.
+
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2013)
 """
 
+import datetime
+
+from twisted.python import log
+
 from opennsa import constants as cnt
 from opennsa.shared import xmlhelper
 from opennsa.protocols.shared import minisoap, httpclient
@@ -15,11 +23,39 @@ from opennsa.protocols.nsi2.bindings import actions, nsiconnection, p2pservices
 
 
 
+LOG_SYSTEM = 'nsi2.ProviderClient'
+
+
+
 class ProviderClient:
 
-    def __init__(self, ctx_factory=None):
+    def __init__(self, ctx_factory=None, outbound_queue=None):
 
         self.ctx_factory = ctx_factory
+        self.outbound_queue = outbound_queue
+        if outbound_queue is not None:
+            outbound_queue.expired = self._messageExpired
+        self.notification_id = 0
+
+
+    def _send(self, requester_url, action, payload, connection_id, correlation_id, requester_nsa, provider_nsa):
+
+        if self.outbound_queue is None:
+            return httpclient.soapRequest(requester_url, action, payload, ctx_factory=self.ctx_factory)
+        else:
+            return self.outbound_queue.enqueue(requester_url, action, payload, connection_id, correlation_id, requester_nsa, provider_nsa)
+
+
+    def _messageExpired(self, msg):
+
+        if msg.action == actions.MESSAGE_DELIVERY_TIMEOUT:
+            return # don't notify about notifications about timeouts
+
+        self.notification_id += 1
+        log.msg('Sending messageDeliveryTimeout for %s to %s (connection id: %s)' % (msg.action, msg.destination, msg.connection_id), system=LOG_SYSTEM)
+        d = self.messageDeliveryTimeout(msg.destination, msg.requester_nsa, msg.provider_nsa, msg.correlation_id,
+                                        msg.connection_id, self.notification_id, datetime.datetime.utcnow())
+        d.addErrback(log.err, 'Error queuing messageDeliveryTimeout', system=LOG_SYSTEM)
 
 
     def _genericConfirm(self, element_name, requester_url, action, correlation_id, requester_nsa, provider_nsa, connection_id):
@@ -35,7 +71,7 @@ class ProviderClient:
             # for now we just ignore this, as long as we get an okay
             return
 
-        d = httpclient.soapRequest(requester_url, action, payload, ctx_factory=self.ctx_factory)
+        d = self._send(requester_url, action, payload, connection_id, correlation_id, requester_nsa, provider_nsa)
         d.addCallbacks(gotReply) #, errReply)
         return d
 
@@ -61,7 +97,7 @@ class ProviderClient:
             # for now we just ignore this, as long as we get an okay
             return
 
-        d = httpclient.soapRequest(requester_url, action, payload, ctx_factory=self.ctx_factory)
+        d = self._send(requester_url, action, payload, connection_id, correlation_id, requester_nsa, provider_nsa)
         d.addCallbacks(gotReply) #, errReply)
         return d
 
@@ -91,7 +127,8 @@ class ProviderClient:
             # we don't really do anything about these
             return ""
 
-        d = httpclient.soapRequest(nsi_header.reply_to, actions.RESERVE_CONFIRMED, payload, ctx_factory=self.ctx_factory)
+        d = self._send(nsi_header.reply_to, actions.RESERVE_CONFIRMED, payload, connection_id,
+                       nsi_header.correlation_id, nsi_header.requester_nsa, nsi_header.provider_nsa)
         d.addCallbacks(gotReply) #, errReply)
         return d
 
@@ -152,7 +189,7 @@ class ProviderClient:
 
         payload = minisoap.createSoapPayload(body_element, header_element)
 
-        d = httpclient.soapRequest(requester_url, actions.RESERVE_TIMEOUT, payload, ctx_factory=self.ctx_factory)
+        d = self._send(requester_url, actions.RESERVE_TIMEOUT, payload, connection_id, correlation_id, requester_nsa, provider_nsa)
         return d
 
 
@@ -168,7 +205,7 @@ class ProviderClient:
 
         payload = minisoap.createSoapPayload(body_element, header_element)
 
-        d = httpclient.soapRequest(requester_url, actions.DATA_PLANE_STATE_CHANGE, payload, ctx_factory=self.ctx_factory)
+        d = self._send(requester_url, actions.DATA_PLANE_STATE_CHANGE, payload, connection_id, correlation_id, requester_nsa, provider_nsa)
         return d
 
 
@@ -193,7 +230,22 @@ class ProviderClient:
 
         payload = minisoap.createSoapPayload(body_element, header_element)
 
-        d = httpclient.soapRequest(requester_url, actions.ERROR_EVENT, payload, ctx_factory=self.ctx_factory)
+        d = self._send(requester_url, actions.ERROR_EVENT, payload, connection_id, correlation_id, requester_nsa, provider_nsa)
+        return d
+
+
+    def messageDeliveryTimeout(self, requester_url, requester_nsa, provider_nsa, correlation_id,
+                               connection_id, notification_id, timestamp):
+
+        header_element = helper.createRequesterHeader(requester_nsa, provider_nsa, correlation_id=correlation_id)
+
+        mdt = nsiconnection.MessageDeliveryTimeoutRequestType(connection_id, notification_id, xmlhelper.createXMLTime(timestamp), correlation_id)
+
+        body_element = mdt.xml(nsiconnection.messageDeliveryTimeout)
+
+        payload = minisoap.createSoapPayload(body_element, header_element)
+
+        d = self._send(requester_url, actions.MESSAGE_DELIVERY_TIMEOUT, payload, connection_id, correlation_id, requester_nsa, provider_nsa)
         return d
 
 
@@ -205,7 +257,7 @@ class ProviderClient:
         qsct = nsiconnection.QuerySummaryConfirmedType(qs_reservations)
 
         payload = minisoap.createSoapPayload(qsct.xml(nsiconnection.querySummaryConfirmed), header_element)
-        d = httpclient.soapRequest(requester_url, actions.QUERY_SUMMARY_CONFIRMED, payload, ctx_factory=self.ctx_factory)
+        d = self._send(requester_url, actions.QUERY_SUMMARY_CONFIRMED, payload, None, correlation_id, requester_nsa, provider_nsa)
         return d
 
 
@@ -217,7 +269,7 @@ class ProviderClient:
         qrct = nsiconnection.QueryRecursiveConfirmedType(qr_reservations)
 
         payload = minisoap.createSoapPayload(qrct.xml(nsiconnection.queryRecursiveConfirmed), header_element)
-        d = httpclient.soapRequest(requester_url, actions.QUERY_RECURSIVE_CONFIRMED, payload, ctx_factory=self.ctx_factory)
+        d = self._send(requester_url, actions.QUERY_RECURSIVE_CONFIRMED, payload, None, correlation_id, requester_nsa, provider_nsa)
         return d
 
 
@@ -11,7 +11,7 @@ import time
 
 from twisted.python import log, failure
 
-from opennsa import nsa, error
+from opennsa import nsa, error, logging
 from opennsa.shared import xmlhelper
 from opennsa.protocols.shared import minisoap, soapresource
 from opennsa.protocols.nsi2 import helper, queryhelper
@@ -115,7 +115,7 @@ class ProviderService:
         crt = nsa.Criteria(criteria.version, schedule, sd)
 
         t_delta = time.time() - t_start
-        log.msg('Profile: Reserve request parse time: %s' % round(t_delta, 3), profile=True, system=LOG_SYSTEM)
+        logging.profile('Profile: Reserve request parse time: %s', round(t_delta, 3), system=LOG_SYSTEM)
 
         d = self.provider.reserve(header, reservation.connectionId, reservation.globalReservationId, reservation.description, crt, request_info)
 
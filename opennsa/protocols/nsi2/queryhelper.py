@@ -37,8 +37,7 @@ def buildConnectionStatesType(states):
 
 
 def buildQuerySummaryResultType(connection_infos):
-
-    query_results = []
+    # generator, so no list of result types is built next to the response (the response xml still holds them all)
     for ci in connection_infos:
 
         criterias = []
@@ -56,9 +55,7 @@ def buildQuerySummaryResultType(connection_infos):
 
         qsrt = nsiconnection.QuerySummaryResultType(ci.connection_id, ci.global_reservation_id, ci.description, criterias,
                                                     ci.requester_nsa, connection_states, ci.notification_id, ci.result_id)
-        query_results.append(qsrt)
-
-    return query_results
+        yield qsrt
 
 
 
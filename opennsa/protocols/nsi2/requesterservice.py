@@ -226,5 +226,12 @@ class RequesterService:
 
 
     def messageDeliveryTimeout(self, soap_data, request_info):
-        raise NotImplementedError('messageDeliveryTimeout not yet implemented in requester service')
+
+        header, message_delivery_timeout = helper.parseRequest(soap_data)
+
+        mdt = message_delivery_timeout
+        timestamp = xmlhelper.parseXMLTimestamp(mdt.timeStamp)
+        self.requester.messageDeliveryTimeout(header, mdt.connectionId, mdt.notificationId, timestamp, mdt.correlationId)
+
+        return helper.createGenericRequesterAcknowledgement(header)
 
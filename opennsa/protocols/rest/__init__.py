@@ -1,12 +1,16 @@
-
 from . import resource
 
 CONNECTIONS = 'connections'
 PATH = '/' + CONNECTIONS
 
-def setupService(provider, top_resource, allowed_hosts=None):
+AVAILABILITY = 'availability'
+
+def setupService(provider, top_resource, allowed_hosts=None, backend=None):
 
     r = resource.P2PBaseResource(provider, PATH, allowed_hosts)
 
     top_resource.putChild(CONNECTIONS, r)
 
+    # availability queries go directly to the backend calendar
+    if backend is not None:
+        top_resource.putChild(AVAILABILITY, resource.AvailabilityResource(backend, allowed_hosts))
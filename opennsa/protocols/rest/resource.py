@@ -7,12 +7,13 @@ Copyright: NORDUnet (2015)
 
 import time
 import json
+import datetime
 
 from twisted.python import log, failure
 from twisted.internet import defer
 from twisted.web import resource, server
 
-from opennsa import nsa, error, state, constants as cnt, database
+from opennsa import nsa, error, state, constants as cnt, database, logging
 from opennsa.shared import xmlhelper
 from opennsa.protocols.shared import requestauthz
 from opennsa.protocols.nsi2 import helper
@@ -63,7 +64,6 @@ def _createErrorResponse(err, request):
 
 
 
-@defer.inlineCallbacks
 def conn2dict(conn):
 
     def label(label):
@@ -85,23 +85,11 @@ def conn2dict(conn):
     d['provision_state']   = conn.provision_state
     d['lifecycle_state']   = conn.lifecycle_state
 
-    # this really needs to be in the database module (aggregator uses this too)
-    df = database.SubConnection.findBy(service_connection_id=conn.id)
-    sub_conns = yield df
-
-    # copied from aggregator, refactor sometime
-    if len(sub_conns) == 0: # apparently this can happen
-        data_plane_status = (False, 0, False)
-    else:
-        aggr_active     = all( [ sc.data_plane_active     for sc in sub_conns ] )
-        aggr_version    = max( [ sc.data_plane_version    for sc in sub_conns ] ) or 0 # can be None otherwise
-        aggr_consistent = all( [ sc.data_plane_consistent for sc in sub_conns ] )
-        data_plane_status = (aggr_active, aggr_version, aggr_consistent)
+    data_plane_status = database.dataPlaneStatus(conn)
 
     d['data_plane_active'] = conn.data_plane = data_plane_status[0]
 
-    #return d
-    defer.returnValue(d)
+    return d
 
 
 
@@ -124,12 +112,11 @@ class P2PBaseResource(resource.Resource):
         # this should return a list of authZed connections with some usefull information
         # we cannot really do any meaningfull authz at the moment though...
 
-        @defer.inlineCallbacks
         def gotConnections(conns):
             res = []
 
             for conn in conns:
-                d = yield conn2dict(conn)
+                d = conn2dict(conn)
                 res.append(d)
 
             payload = json.dumps(res) + RN
@@ -232,7 +219,7 @@ class P2PBaseResource(resource.Resource):
                     conn = yield self.provider.getConnection(conn_id)
 
                     def stateUpdate():
-                        log.msg('stateUpdate reservation_state: %s, provision_state: %s' % (str(conn.reservation_state), str(conn.provision_state)), debug=True, system=LOG_SYSTEM)
+                        logging.debug('stateUpdate reservation_state: %s, provision_state: %s', str(conn.reservation_state), str(conn.provision_state), system=LOG_SYSTEM)
                         if conn.reservation_state == state.RESERVE_HELD:
                             self.provider.reserveCommit(header, conn_id, request_info)
                         if conn.reservation_state == state.RESERVE_START and conn.provision_state == state.RELEASED and auto_provision:
@@ -280,9 +267,8 @@ class P2PConnectionResource(resource.Resource):
 
         d = self.provider.getConnection(self.connection_id)
 
-        @defer.inlineCallbacks
         def gotConnection(conn):
-            d = yield conn2dict(conn)
+            d = conn2dict(conn)
 
             payload = json.dumps(d) + RN
             _finishRequest(request, 200, payload, {'Content-Type': 'application/json'})
@@ -388,3 +374,69 @@ class P2PStatusResource(resource.Resource):
         d.addCallbacks(commandDone, commandError)
         return server.NOT_DONE_YET
 
+
+
+class AvailabilityResource(resource.Resource):
+    """
+    Resource for finding free time windows for an STP, without reserving
+    anything. Query parameters:
+
+    stp      : STP with optional label set, e.g., aruba:topology:ps?vlan=1780-1789
+    start    : Earliest start time (xsd:dateTime). Optional, defaults to now.
+    end      : Latest end time (xsd:dateTime).
+    duration : Minimum duration of a window in seconds.
+    bandwidth: Bandwidth (Mbps) which must be available in the windows. Optional.
+    """
+    isLeaf = 1
+
+    def __init__(self, backend, allowed_hosts=None):
+        resource.Resource.__init__(self)
+        self.backend = backend
+        self.allowed_hosts = allowed_hosts
+
+
+    def render_GET(self, request):
+
+        allowed, msg, request_info = requestauthz.checkAuthz(request, self.allowed_hosts)
+        if not allowed:
+            payload = msg + RN
+            return _requestResponse(request, 401, payload) # Not Authorized
+
+        def arg(name):
+            values = request.args.get(name)
+            return values[0] if values else None
+
+        try:
+            stp_id   = arg('stp')
+            end      = arg('end')
+            duration = arg('duration')
+            if stp_id is None or end is None or duration is None:
+                raise error.MissingParameterError('Parameters stp, end, and duration must be specified')
+
+            if not stp_id.startswith(cnt.URN_OGF_PREFIX):
+                stp_id = cnt.URN_OGF_PREFIX + stp_id
+            stp = helper.createSTP(stp_id)
+            if stp.network != self.backend.network:
+                raise error.ConnectionCreateError('Network %s is not managed by this NSA' % stp.network)
+
+            earliest = xmlhelper.parseXMLTimestamp(arg('start')) if arg('start') is not None else None
+            latest   = xmlhelper.parseXMLTimestamp(end)
+            try:
+                duration = datetime.timedelta(seconds=int(duration))
+                bandwidth = int(arg('bandwidth')) if arg('bandwidth') is not None else None
+            except ValueError:
+                raise error.PayloadError('Duration and bandwidth must be integers')
+
+            free_windows = self.backend.findFreeWindows(stp.port, stp.label, earliest, latest, duration, bandwidth)
+
+        except Exception as e:
+            log.msg('Error finding available windows: %s' % str(e), system=LOG_SYSTEM)
+            return _requestResponse(request, _errorCode(e), str(e) + RN)
+
+        res = []
+        for label, windows in free_windows:
+            res.append( { 'label'  : '%s=%s' % (label.type_, label.labelValue()) if label is not None else None,
+                          'windows': [ { START_TIME: xmlhelper.createXMLTime(st), END_TIME: xmlhelper.createXMLTime(et) } for st, et in windows ] } )
+
+        payload = json.dumps(res) + RN
+        return _requestResponse(request, 200, payload, {'Content-Type': 'application/json'})
@@ -1,20 +1,38 @@
 """
 A nice handy HTTP client.
 
+Requests are sent over persistent (HTTP/1.1 keep-alive) connections, which
+are kept in a pool per destination, so messages to the same peer do not pay
+for a TCP (and TLS) handshake every time.
+
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2012)
 """
 
-from twisted.python import log
+from zope.interface import implementer
+
+from twisted.python import log, failure
 from twisted.internet import reactor, defer
 from twisted.web import client as twclient, http as twhttp
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IPolicyForHTTPS, IBodyProducer
 from twisted.web.error import Error as WebError
 from twisted.internet.error import ConnectionClosed, ConnectionRefusedError
 
+from opennsa import logging
+
 
 LOG_SYSTEM = 'HTTPClient'
 
 DEFAULT_TIMEOUT = 30 # seconds
+DEFAULT_MAX_CONNECTIONS = 4 # persistent connections per destination, 0 disables keep-alive
+DEFAULT_IDLE_TIMEOUT = 60 # seconds before an idle connection is closed
+
+max_connections = DEFAULT_MAX_CONNECTIONS
+idle_timeout    = DEFAULT_IDLE_TIMEOUT
+
+_agents = {} # ctx_factory -> ( Agent, HTTPConnectionPool ), each agent has its own pool, so connections are not shared between tls contexts
+_requests = set() # deferreds fired when each request in progress is done
 
 
 
@@ -24,6 +42,90 @@ class HTTPRequestError(Exception):
     """
 
 
+
+@implementer(IPolicyForHTTPS)
+class ContextFactoryPolicy(object):
+    """
+    Use a context factory (see ctxfactory) for all https requests of an agent.
+    The context factory creates the connections per peer, so it can resume
+    tls sessions with the peer.
+    """
+    def __init__(self, ctx_factory):
+        self.ctx_factory = ctx_factory
+
+    def creatorForNetloc(self, hostname, port):
+        if hasattr(self.ctx_factory, 'creatorForNetloc'):
+            return self.ctx_factory.creatorForNetloc(hostname, port)
+        return self.ctx_factory # plain context factory, twisted wraps it
+
+
+
+@implementer(IBodyProducer)
+class StringBodyProducer(object):
+    """
+    Writes the payload in one go. Unlike FileBodyProducer, this does not
+    complain if the connection is lost after the payload has been written.
+    """
+    def __init__(self, body):
+        self.body = body
+        self.length = len(body)
+
+    def startProducing(self, consumer):
+        consumer.write(self.body)
+        return defer.succeed(None)
+
+    def pauseProducing(self):
+        pass
+
+    def resumeProducing(self):
+        pass
+
+    def stopProducing(self):
+        pass
+
+
+
+def configurePool(max_connections_per_host=DEFAULT_MAX_CONNECTIONS, idle_timeout_seconds=DEFAULT_IDLE_TIMEOUT):
+    """
+    Sets the connection pool parameters. Requests made afterwards use new pools with the parameters.
+    """
+    global max_connections, idle_timeout
+    max_connections = max_connections_per_host
+    idle_timeout    = idle_timeout_seconds
+    closeConnections() # connections in use are closed when their request is done
+
+
+
+def getAgent(ctx_factory=None):
+
+    try:
+        return _agents[ctx_factory][0]
+    except KeyError:
+        pool = twclient.HTTPConnectionPool(reactor, persistent=max_connections > 0)
+        pool.maxPersistentPerHost = max_connections
+        pool.cachedConnectionTimeout = idle_timeout
+
+        policy = ContextFactoryPolicy(ctx_factory) if ctx_factory is not None else twclient.BrowserLikePolicyForHTTPS()
+        agent = twclient.Agent(reactor, policy, pool=pool)
+        _agents[ctx_factory] = (agent, pool)
+        return agent
+
+
+
+def closeConnections():
+    """
+    Closes all pooled connections, once the requests in progress are done
+    (their connections are returned to the pool before that). Returns a
+    deferred, which fires when the connections are closed.
+    """
+    pools = [ pool for _, pool in _agents.values() ]
+    _agents.clear()
+    d = defer.DeferredList(list(_requests))
+    d.addCallback(lambda _ : defer.DeferredList( [ pool.closeCachedConnections() for pool in pools ] ))
+    return d
+
+
+
 def soapRequest(url, soap_action, soap_envelope, timeout=DEFAULT_TIMEOUT, ctx_factory=None, headers=None):
 
     if not headers:
@@ -32,13 +134,13 @@ def soapRequest(url, soap_action, soap_envelope, timeout=DEFAULT_TIMEOUT, ctx_fa
     headers['Content-Type'] = 'text/xml; charset=utf-8' # CXF will complain if this is not set
     headers['soapaction'] = soap_action
 
-    return httpRequest(url, soap_envelope, headers, ctx_factory=ctx_factory)
+    return httpRequest(url, soap_envelope, headers, timeout=timeout, ctx_factory=ctx_factory)
 
 
 
 def httpRequest(url, payload, headers, method='POST', timeout=DEFAULT_TIMEOUT, ctx_factory=None):
-    # copied from twisted.web.client in order to get access to the
-    # factory (which contains response codes, headers, etc)
+    # fires with the body of the reply, or errbacks with web.error.Error (with the body as response)
+    # for non 2xx replies, same as the twisted.web.client.getPage did
 
     if type(url) is not str:
         e = HTTPRequestError('URL must be string, not %s' % type(url))
@@ -48,7 +150,7 @@ def httpRequest(url, payload, headers, method='POST', timeout=DEFAULT_TIMEOUT, c
         e = HTTPRequestError('URL does not start with http (URL %s)' % (url))
         return defer.fail(e)
 
-    log.msg(" -- Sending Payload to %s --\n%s\n -- END. Sending Payload --" % (url, payload), system=LOG_SYSTEM, payload=True)
+    logging.payload(" -- Sending Payload to %s --\n%s\n -- END. Sending Payload --", url, payload, system=LOG_SYSTEM)
 
     scheme, netloc, _ , _, _, _ = twhttp.urlparse(url)
     if not ':' in netloc:
@@ -58,30 +160,56 @@ def httpRequest(url, payload, headers, method='POST', timeout=DEFAULT_TIMEOUT, c
         host, s_port = netloc.split(':',1)
         port = int(s_port)
 
-    factory = twclient.HTTPClientFactory(url, method, postdata=payload, timeout=timeout)
-    factory.noisy = False # stop spewing about factory start/stop
-    factory.protocol.handleStatus_204 = lambda _ : None # 204 is an ok reply, needed by NCS VPN backend
-
-    # fix missing port in header (bug in twisted.web.client)
-    factory.headers['host'] = host + ':' + str(port)
-    factory.headers['User-Agent'] = 'OpenNSA/Twisted'
+    if scheme == 'https' and ctx_factory is None:
+        return defer.fail(HTTPRequestError('Cannot perform https request without context factory'))
 
+    request_headers = Headers( { 'User-Agent' : [ 'OpenNSA/Twisted' ] } )
     for header, value in headers.items():
-        factory.headers[header] = value
+        request_headers.setRawHeaders(header, [ value ] )
 
-    if scheme == 'https':
-        if ctx_factory is None:
-            return defer.fail(HTTPRequestError('Cannot perform https request without context factory'))
-        reactor.connectSSL(host, port, factory, ctx_factory)
-    else:
-        reactor.connectTCP(host, port, factory)
+    body = StringBodyProducer(payload) if payload else None
+
+    d = getAgent(ctx_factory).request(method, url, request_headers, body)
+
+    done = defer.Deferred()
+    _requests.add(done)
+
+    def gotResponse(response):
+        rd = twclient.readBody(response)
+        if 200 <= response.code < 300:
+            return rd
+        # same error as twisted.web.client.getPage, callers look at the status and response (body)
+        def httpError(data):
+            raise WebError(str(response.code), response.phrase, data)
+        rd.addCallback(httpError)
+        return rd
+
+    d.addCallback(gotResponse)
+
+    # timeout covers the whole request, including connection setup
+    timeout_call = reactor.callLater(timeout, d.cancel)
+
+    def requestDone(result):
+        _requests.discard(done)
+        done.callback(None)
+        if timeout_call.active():
+            timeout_call.cancel()
+        if isinstance(result, failure.Failure):
+            if result.check(twclient.ResponseFailed, twclient.RequestTransmissionFailed, twclient.ResponseNeverReceived):
+                # unwrap, so callers see the actual reason (typically ConnectionClosed), like when not using a pool
+                result = result.value.reasons[0]
+            if result.check(defer.CancelledError):
+                result = failure.Failure(defer.TimeoutError('Getting %s took longer than %s seconds.' % (url, timeout)))
+        return result
+
+    d.addBoth(requestDone)
 
     def invocationError(err):
         if isinstance(err.value, ConnectionClosed): # note: this also includes ConnectionDone and ConnectionLost
             pass # these are pretty common when the remote shuts down
         elif isinstance(err.value, WebError):
             data = err.value.response
-            log.msg(' -- Received Reply (fault) --\n%s\n -- END. Received Reply (fault) --' % data, system=LOG_SYSTEM, payload=True)
+            logging.payload(' -- Received Reply (fault) --\n%s\n -- END. Received Reply (fault) --', data, system=LOG_SYSTEM)
             return err
         elif isinstance(err.value, ConnectionRefusedError):
             log.msg('Connection refused for %s:%i. Request URL: %s' % (host, port, url), system=LOG_SYSTEM)
@@ -90,10 +218,10 @@ def httpRequest(url, payload, headers, method='POST', timeout=DEFAULT_TIMEOUT, c
             return err
 
     def logReply(data):
-        log.msg(" -- Received Reply --\n%s\n -- END. Received Reply --" % data, system=LOG_SYSTEM, payload=True)
+        logging.payload(" -- Received Reply --\n%s\n -- END. Received Reply --", data, system=LOG_SYSTEM)
         return data
 
-    factory.deferred.addCallbacks(logReply, invocationError)
+    d.addCallbacks(logReply, invocationError)
 
-    return factory.deferred
+    return d
 
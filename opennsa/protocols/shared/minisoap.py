@@ -5,11 +5,18 @@ Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2012)
 """
 
+import StringIO
+
 from xml.etree import ElementTree as ET
 
 
 LOG_SYSTEM = 'opennsa.protocols.soap'
 
+DEFAULT_MAX_DEPTH       = 100 # element nesting
+
+# nesting limit for parsed payloads, can be changed with setMaxDepth
+max_depth               = DEFAULT_MAX_DEPTH
+
 SOAP_ENVELOPE_NS        = "http://schemas.xmlsoap.org/soap/envelope/"
 
 SOAP_ENV                = ET.QName("{%s}Envelope"   % SOAP_ENVELOPE_NS)
@@ -102,31 +109,101 @@ def createSoapFault(fault_msg, detail_element=None):
 
 
 
-def parseSoapPayload(payload):
+def setMaxDepth(depth=DEFAULT_MAX_DEPTH):
+    """
+    Sets the maximum element nesting of parsed payloads.
+    """
+    global max_depth
+    max_depth = depth
+
+
+
+class _LimitedReader:
+    # file-like wrapper, which fails when more than limit bytes are read from the source
+
+    def __init__(self, source, limit):
+        self.source = source
+        self.limit = limit
+        self.count = 0
+
+    def read(self, size=-1):
+        # read at most one byte over the limit, so oversized payloads are caught without reading them
+        remaining = self.limit - self.count + 1
+        data = self.source.read(remaining if size < 0 else min(size, remaining))
+        self.count += len(data)
+        if self.count > self.limit:
+            raise ValueError('SOAP payload is larger than %i bytes' % self.limit)
+        return data
+
+
 
-    envelope = ET.fromstring(payload)
+def _rejectDoctype(*args):
+    raise ValueError('Document type declarations (and entities) are not allowed in SOAP payloads')
 
-    assert envelope.tag == SOAP_ENV, 'Top element in soap payload is not SOAP:Envelope (got %s)' % envelope.tag
 
+def _createParser():
+    # entity declarations can only be made in a document type declaration, so rejecting
+    # those avoids entity expansion attacks (and SOAP does not allow them anyway)
+    parser = ET.XMLParser(target=ET.TreeBuilder())
+    parser.parser.StartDoctypeDeclHandler = _rejectDoctype
+    parser.parser.EntityDeclHandler = _rejectDoctype
+    return parser
+
+
+
+def parseSoapPayload(payload, size_limit=None, depth_limit=None):
+    """
+    Parses a SOAP payload, given as a string or a file-like object (e.g., the
+    content of a http request), into the header elements (None if there is no
+    header) and the body elements.
+
+    The payload is read and parsed incrementally, and parsing stops at the end
+    of the body. Payloads larger than size_limit bytes (if given), with elements
+    nested deeper than depth_limit, or with a document type declaration are
+    rejected as soon as that is found. If depth_limit is not given, the one set
+    with setMaxDepth is used.
+    """
+    if depth_limit is None:
+        depth_limit = max_depth
+
+    if isinstance(payload, basestring):
+        if size_limit is not None and len(payload) > size_limit:
+            raise ValueError('SOAP payload is larger than %i bytes' % size_limit)
+        payload = StringIO.StringIO(payload)
+
+    source = _LimitedReader(payload, size_limit) if size_limit is not None else payload
+
+    depth = 0
     header_elements = None
 
-    for ec in envelope:
-        if ec.tag == SOAP_HEADER:
-            if header_elements is not None:
-                raise ValueError('SOAP Payload has multiple header elements')
-            header_elements = list(ec)
+    for event, element in ET.iterparse(source, ('start', 'end'), _createParser()):
+
+        if event == 'start':
+            depth += 1
+            if depth > depth_limit:
+                raise ValueError('SOAP payload has elements nested deeper than %i' % depth_limit)
+            if depth == 1:
+                assert element.tag == SOAP_ENV, 'Top element in soap payload is not SOAP:Envelope (got %s)' % element.tag
+            elif depth == 2 and not element.tag in (SOAP_HEADER, SOAP_BODY):
+                raise ValueError('Invalid entry in SOAP payload: %s' % (element.tag))
             continue
-        elif ec.tag == SOAP_BODY:
-            return header_elements, list(ec)
-        else:
-            raise ValueError('Invalid entry in SOAP payload: %s' % (ec.tag))
+
+        depth -= 1
+        if depth == 1:
+            if element.tag == SOAP_HEADER:
+                if header_elements is not None:
+                    raise ValueError('SOAP Payload has multiple header elements')
+                header_elements = list(element)
+            else:
+                # anything after the body is not read
+                return header_elements, list(element)
 
     raise ValueError('SOAP Payload does not have a body')
 
 
 def parseFault(payload):
 
-    envelope = ET.fromstring(payload)
+    envelope = ET.XML(payload, _createParser())
 
     if envelope.tag != SOAP_ENV:
         raise ValueError('Top element in soap payload is not SOAP:Envelope')
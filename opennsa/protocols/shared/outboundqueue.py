@@ -0,0 +1,328 @@
+"""
+Durable queue for outbound messages (callbacks to requesters).
+
+Messages are stored in the database before they are sent, and deleted once
+they have been delivered, so messages survive temporary network errors and
+restarts. Messages with the same destination and ordering key (typically
+the connection id) are delivered in order, i.e., a message is only sent
+once the previous one has been delivered or has expired. Failed deliveries
+are retried with exponential backoff, and the number of messages being sent
+to a single destination at the same time is limited.
+
+Messages which have not been delivered before their expiry time are
+dropped, and the expired function of the queue is called with them, so the
+sender can notify about it. A SOAP fault reply counts as delivered, as the
+requester got the message, and sending it again will not change the reply.
+Other error replies (e.g., 502/503 from a proxy in front of a restarting
+requester) are retried.
+
+Author: Henrik Thostrup Jensen <htj@nordu.net>
+Copyright: NORDUnet (2016)
+"""
+
+import bisect
+import datetime
+import collections
+
+from twisted.python import log
+from twisted.internet import reactor, defer, task
+from twisted.application import service
+from twisted.web.error import Error as WebError
+
+from opennsa import database
+from opennsa.protocols.shared import minisoap, httpclient
+
+
+LOG_SYSTEM = 'OutboundQueue'
+
+DEFAULT_MAX_IN_FLIGHT   = 4     # messages being sent to a destination at the same time
+DEFAULT_INITIAL_BACKOFF = 2     # seconds before the first retry, doubled for each retry
+DEFAULT_MAX_BACKOFF     = 300   # seconds
+DEFAULT_MESSAGE_TTL     = 3600  # seconds before an undelivered message expires
+
+STATS_INTERVAL          = 900   # seconds between logging delivery statistics
+
+LATENCY_BUCKETS = (0.1, 0.5, 1, 5, 30, 60, 300, 1800) # upper bounds (seconds), last bucket is everything above
+
+
+
+def _isFaultReply(err):
+    # a client error or internal server error with a soap fault as body
+    try:
+        status = int(err.status)
+    except (TypeError, ValueError):
+        return False
+    if not (400 <= status < 500 or status == 500):
+        return False
+    try:
+        minisoap.parseFault(err.response or '')
+        return True
+    except (ValueError, SyntaxError): # not a soap fault
+        return False
+
+
+
+class OutboundQueue(service.Service):
+
+    def __init__(self, ctx_factory=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT, initial_backoff=DEFAULT_INITIAL_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF, message_ttl=DEFAULT_MESSAGE_TTL, sender=None, clock=None):
+
+        self.ctx_factory        = ctx_factory
+        self.max_in_flight      = max_in_flight
+        self.initial_backoff    = initial_backoff
+        self.max_backoff        = max_backoff
+        self.message_ttl        = message_ttl
+        self.sender             = sender or self._soapRequest
+        self.clock              = clock or reactor
+
+        self.expired = None # function called with messages which expired without being delivered
+
+        self.queues         = {} # ( destination, ordering key ) -> deque of messages, oldest first
+        self.destinations   = {} # destination -> OrderedDict of keys with queued messages
+        self.in_flight      = collections.Counter() # destination -> number of messages being sent
+        self.sending        = set() # keys with a message being sent
+        self.saving         = set() # id() of messages not yet stored in the database
+        self.timers         = {} # key -> delayed call for retry
+        self.attempts       = {} # key -> failed attempts of the first message
+        self.db_calls       = set() # deferreds of message saves / deletes in progress
+
+        self.delivered      = 0
+        self.retries        = 0
+        self.expirations    = 0
+        self.latencies      = [ 0 ] * (len(LATENCY_BUCKETS) + 1)
+        self.reported       = 0 # delivered count at last stats report
+
+        self.stats_call = task.LoopingCall(self._logStats)
+        self.stats_call.clock = self.clock
+
+
+    def _soapRequest(self, destination, action, payload):
+        return httpclient.soapRequest(destination, action, payload, ctx_factory=self.ctx_factory)
+
+
+    def startService(self):
+        service.Service.startService(self)
+        self.stats_call.start(STATS_INTERVAL, now=False)
+        d = self.loadMessages()
+        d.addErrback(log.err, 'Error loading undelivered messages', system=LOG_SYSTEM)
+        return d
+
+
+    @defer.inlineCallbacks
+    def loadMessages(self):
+        # messages which were not delivered before a shutdown / crash
+        messages = yield database.OutboundMessage.find(orderby='created ASC, id ASC')
+        if messages:
+            log.msg('Loaded %i undelivered messages' % len(messages), system=LOG_SYSTEM)
+        for msg in messages:
+            self._add(msg)
+        for destination in self.destinations.keys():
+            self._dispatch(destination)
+
+
+    def stopService(self):
+        if self.stats_call.running:
+            self.stats_call.stop()
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+        service.Service.stopService(self)
+        # wait for saves and deletes, so messages are not lost or sent again after a restart
+        return defer.DeferredList(list(self.db_calls))
+
+
+    def _now(self):
+        return datetime.datetime.utcfromtimestamp(self.clock.seconds())
+
+
+    def enqueue(self, destination, action, payload, connection_id=None, correlation_id=None, requester_nsa=None, provider_nsa=None):
+        """
+        Stores a message, and sends it when the messages before it with the
+        same destination and connection id have been delivered. Returns a
+        deferred, which fires when the message has been stored (not when it
+        has been delivered).
+        """
+        now = self._now()
+        msg = database.OutboundMessage(destination=destination, connection_id=connection_id, action=action, payload=payload,
+                                       correlation_id=correlation_id, requester_nsa=requester_nsa, provider_nsa=provider_nsa,
+                                       created=now, expires=now + datetime.timedelta(seconds=self.message_ttl))
+
+        # queue immediately, so messages are in the order they are enqueued, but only send it once stored
+        self.saving.add(id(msg))
+        self._add(msg)
+
+        def saved(_):
+            self.saving.discard(id(msg))
+            self._dispatch(destination)
+
+        def saveFailed(err):
+            self.saving.discard(id(msg))
+            self._remove(self._key(msg), msg)
+            self._dispatch(destination)
+            return err
+
+        d = msg.save()
+        d.addCallbacks(saved, saveFailed)
+        self._trackCall(d)
+        return d
+
+
+    def _key(self, msg):
+        # messages without a connection id (query replies) are not ordered with anything
+        return (msg.destination, msg.connection_id or 'message-%s' % id(msg))
+
+
+    def _add(self, msg):
+        key = self._key(msg)
+        self.queues.setdefault(key, collections.deque()).append(msg)
+        self.destinations.setdefault(msg.destination, collections.OrderedDict())[key] = None
+
+
+    def _remove(self, key, msg=None):
+        # removes a message for the key, the first one if not specified
+        queue = self.queues[key]
+        if msg is None:
+            msg = queue.popleft()
+            self.attempts.pop(key, None)
+        else:
+            # not deque.remove, orm objects compare by id, which unsaved messages do not have
+            queue = self.queues[key] = collections.deque( m for m in queue if m is not msg )
+        if not queue:
+            del self.queues[key]
+            keys = self.destinations[msg.destination]
+            del keys[key]
+            if not keys:
+                del self.destinations[msg.destination]
+        return msg
+
+
+    def _dispatch(self, destination):
+        # send the first message of each key for the destination, as long as the destination has room for it
+        for key in list(self.destinations.get(destination, ())):
+            if self.in_flight[destination] >= self.max_in_flight:
+                break
+            self._dispatchKey(key)
+
+
+    def _dispatchKey(self, key):
+
+        while key in self.queues and not (key in self.sending or key in self.timers):
+            msg = self.queues[key][0]
+            if id(msg) in self.saving:
+                return
+            if msg.expires <= self._now():
+                self._expire(key)
+                continue
+
+            self.sending.add(key)
+            self.in_flight[msg.destination] += 1
+            d = self.sender(msg.destination, msg.action, msg.payload)
+            d.addCallbacks(self._sent, self._sendFailed, callbackArgs=(key, msg), errbackArgs=(key, msg))
+            return
+
+
+    def _sent(self, _, key, msg):
+        self._sendDone(key, msg)
+        self._delivered(key, msg)
+
+
+    def _sendFailed(self, err, key, msg):
+        self._sendDone(key, msg)
+
+        if err.check(WebError) and _isFaultReply(err.value):
+            # the requester got the message, but didn't like it, sending it again won't change that
+            log.msg('Error reply (%s) for %s message to %s, not resending' % (err.value.status, msg.action, msg.destination), system=LOG_SYSTEM)
+            self._delivered(key, msg)
+            return
+
+        attempts = self.attempts.get(key, 0) + 1
+        self.attempts[key] = attempts
+        self.retries += 1
+
+        backoff = min(self.initial_backoff * 2 ** (attempts - 1), self.max_backoff)
+        # no point in waiting beyond the expiry time
+        until_expiry = (msg.expires - self._now()).total_seconds()
+        delay = max(0, min(backoff, until_expiry))
+        log.msg('Delivery of %s message to %s failed (%s), retry %i in %i seconds' % \
+                (msg.action, msg.destination, err.getErrorMessage(), attempts, delay), system=LOG_SYSTEM)
+
+        self.timers[key] = self.clock.callLater(delay, self._retry, key)
+        self._dispatch(msg.destination)
+
+
+    def _sendDone(self, key, msg):
+        self.sending.discard(key)
+        self.in_flight[msg.destination] -= 1
+        if self.in_flight[msg.destination] == 0:
+            del self.in_flight[msg.destination]
+
+
+    def _retry(self, key):
+        del self.timers[key]
+        if key in self.queues:
+            self._dispatch(key[0])
+
+
+    def _delivered(self, key, msg):
+        self._remove(key)
+        self.delivered += 1
+
+        latency = (self._now() - msg.created).total_seconds()
+        self.latencies[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+        self._deleteMessage(msg)
+        self._dispatch(msg.destination)
+
+
+    def _expire(self, key):
+        msg = self._remove(key)
+        self.expirations += 1
+        log.msg('Message %s to %s expired (created %s), dropping it' % (msg.action, msg.destination, msg.created), system=LOG_SYSTEM)
+
+        self._deleteMessage(msg)
+        if self.expired is not None:
+            try:
+                self.expired(msg)
+            except Exception:
+                log.err(None, 'Error handling expired message', system=LOG_SYSTEM)
+
+
+    def _deleteMessage(self, msg):
+        d = msg.delete()
+        d.addErrback(log.err, 'Error deleting message %s' % msg.id, system=LOG_SYSTEM)
+        self._trackCall(d)
+
+
+    def _trackCall(self, d):
+        td = defer.Deferred()
+        self.db_calls.add(td)
+        def done(result):
+            self.db_calls.discard(td)
+            td.callback(None)
+            return result
+        d.addBoth(done)
+
+
+    def latencyHistogram(self):
+        """
+        Returns the delivery latency histogram, as a list of (upper bound, count) tuples.
+        The upper bound of the last bucket is None (everything above).
+        """
+        return zip(LATENCY_BUCKETS + (None,), self.latencies)
+
+
+    def stats(self):
+        return { 'queued': sum( len(q) for q in self.queues.values() ), 'in_flight': sum(self.in_flight.values()),
+                 'delivered': self.delivered, 'retries': self.retries, 'expired': self.expirations,
+                 'latency': self.latencyHistogram() }
+
+
+    def _logStats(self):
+        if self.delivered == self.reported and not self.queues:
+            return
+        self.reported = self.delivered
+        buckets = ', '.join( '%s: %i' % ('<=%ss' % bound if bound is not None else '>%ss' % LATENCY_BUCKETS[-1], count)
+                             for bound, count in self.latencyHistogram() )
+        s = self.stats()
+        log.msg('Queued: %i, in flight: %i, delivered: %i, retries: %i, expired: %i. Delivery latency: %s' % \
+                (s['queued'], s['in_flight'], s['delivered'], s['retries'], s['expired'], buckets), system=LOG_SYSTEM)
@@ -7,8 +7,9 @@ Copyright: NORDUnet (2011-2016)
 
 from twisted.python import log
 from twisted.internet import defer
-from twisted.web import resource, server
+from twisted.web import resource, server, http
 
+from opennsa import logging
 from opennsa.shared.requestinfo import RequestInfo
 from opennsa.protocols.shared import minisoap
 
@@ -31,14 +32,101 @@ class SOAPFault(Exception):
 
 
 
+class SizeLimitedRequest(server.Request):
+    """
+    Request which rejects request bodies larger than max_payload_size (set by
+    SizeLimitedChannel), without buffering them. The limit is checked against
+    the content length when the headers have been received, and against the
+    received data for requests without content length (chunked encoding).
+    """
+    max_payload_size = None
+
+    def __init__(self, *args, **kwargs):
+        server.Request.__init__(self, *args, **kwargs)
+        self.received_length = 0
+        self.rejected = False
+
+
+    def gotLength(self, length):
+        if self.max_payload_size is not None and length is not None and length > self.max_payload_size:
+            self._reject(length)
+            length = None # keep the (empty) content in memory
+        server.Request.gotLength(self, length)
+
+
+    def handleContentChunk(self, data):
+        if self.rejected:
+            return
+        self.received_length += len(data)
+        if self.max_payload_size is not None and self.received_length > self.max_payload_size:
+            self._reject(self.received_length)
+            return
+        server.Request.handleContentChunk(self, data)
+
+
+    def requestReceived(self, command, path, version):
+        if not self.rejected:
+            server.Request.requestReceived(self, command, path, version)
+
+
+    def _reject(self, length):
+        self.rejected = True
+        log.msg('Rejecting request, content length %i is above limit (%i)' % (length, self.max_payload_size), system=LOG_SYSTEM)
+        # the request has not been processed, so respond directly, like twisted does for bad requests
+        self.channel.transport.write(b'HTTP/1.1 413 Request Entity Too Large\r\n\r\n')
+        self.channel.loseConnection()
+
+
+
+class SizeLimitedChannel(http.HTTPChannel):
+    """
+    HTTP channel which looks up the resource of a request when the request
+    line is received, and gives the request the payload size limit of the
+    resource, if it is a SOAPResource with one. Other resources are not limited.
+    """
+    def lineReceived(self, line):
+        n_requests = len(self.requests)
+        http.HTTPChannel.lineReceived(self, line)
+        if len(self.requests) > n_requests:
+            # request line, the headers and body have not been received yet
+            parts = line.split()
+            if len(parts) == 3:
+                self.requests[-1].max_payload_size = _findPayloadLimit(self.site.resource, parts[1])
+
+
+
+class SizeLimitedSite(server.Site):
+    """
+    Site which rejects requests to size limited SOAP resources, when the request
+    body is larger than the limit of the resource.
+    """
+    protocol = SizeLimitedChannel
+    requestFactory = SizeLimitedRequest
+
+
+
+def _findPayloadLimit(top_resource, path):
+    # follows the static children (as setupSOAPResource creates them) to the resource of the path
+    res = top_resource
+    for segment in path.split('?')[0].split('/')[1:]:
+        if isinstance(res, SOAPResource):
+            break
+        res = getattr(res, 'children', {}).get(segment)
+        if res is None:
+            return None
+    return res.max_payload_size if isinstance(res, SOAPResource) else None
+
+
+
 class SOAPResource(resource.Resource):
 
     isLeaf = True
 
-    def __init__(self, allowed_hosts=None):
+    def __init__(self, allowed_hosts=None, max_payload_size=None):
         resource.Resource.__init__(self)
         self.soap_actions = {}
         self.allowed_hosts = allowed_hosts # certificate dns
+        self.max_payload_size = max_payload_size # bytes, enforced when served by SizeLimitedSite
 
 
     def registerDecoder(self, soap_action, decoder):
@@ -87,15 +175,17 @@ class SOAPResource(resource.Resource):
 
         soap_action = request.requestHeaders.getRawHeaders('soapaction',[None])[0]
 
-        soap_data = request.content.read()
-        log.msg(" -- Received payload --\n%s\n -- END. Received payload --" % soap_data, system=LOG_SYSTEM, payload=True)
+        # decoders get the content stream, so the payload can be parsed without reading all of it into memory first
+        soap_data = request.content
+        if logging.payload_enabled:
+            logging.payload(" -- Received payload --\n%s\n -- END. Received payload --", _readContent(soap_data), system=LOG_SYSTEM)
 
         if not soap_action in self.soap_actions:
             log.msg('Got request with unknown SOAP action: %s' % soap_action, system=LOG_SYSTEM)
             request.setResponseCode(406) # Not acceptable
             return 'Invalid SOAP Action for this resource\r\n'
 
-        log.msg('Received SOAP request. Action: %s. Length: %i' % (soap_action, len(soap_data)), system=LOG_SYSTEM, debug=True)
+        logging.debug('Received SOAP request. Action: %s. Length: %s', soap_action, request.getHeader('content-length'), system=LOG_SYSTEM)
 
         def reply(reply_data):
 
@@ -106,7 +196,7 @@ class SOAPResource(resource.Resource):
             if reply_data is None or len(reply_data) == 0:
                 log.msg('None/empty reply data supplied for SOAPResource. This is probably wrong', system=LOG_SYSTEM)
             else:
-                log.msg(" -- Sending response --\n%s\n -- END: Sending response --" % reply_data, system=LOG_SYSTEM, payload=True)
+                logging.payload(" -- Sending response --\n%s\n -- END: Sending response --", reply_data, system=LOG_SYSTEM)
 
             request.setHeader('Content-Type', 'text/xml') # Keeps some SOAP implementations happy
             request.write(reply_data)
@@ -116,10 +206,10 @@ class SOAPResource(resource.Resource):
 
             log.msg('Failure during SOAP decoding/dispatch: %s' % err.getErrorMessage(), system=LOG_SYSTEM)
             log.err(err)
-            log.msg('SOAP Payload that caused error:\n%s\n' % soap_data)
+            log.msg('SOAP Payload that caused error:\n%s\n' % _readContent(soap_data))
             error_payload = SOAPFault(err.getErrorMessage()).createPayload()
 
-            log.msg(" -- Sending response (fault) --\n%s\n -- END: Sending response (fault) --" % error_payload, system=LOG_SYSTEM, payload=True)
+            logging.payload(" -- Sending response (fault) --\n%s\n -- END: Sending response (fault) --", error_payload, system=LOG_SYSTEM)
 
             request.setResponseCode(500) # Internal server error
             request.setHeader('Content-Type', 'text/xml')
@@ -134,7 +224,16 @@ class SOAPResource(resource.Resource):
 
 
 
-def setupSOAPResource(top_resource, resource_name, subpath=None, allowed_hosts=None):
+def _readContent(content):
+    # reads all of the content stream, leaving it at the start
+    content.seek(0, 0)
+    data = content.read()
+    content.seek(0, 0)
+    return data
+
+
+
+def setupSOAPResource(top_resource, resource_name, subpath=None, allowed_hosts=None, max_payload_size=None):
 
     # Default path: NSI/services/{resource_name}
     if subpath is None:
@@ -153,7 +252,7 @@ def setupSOAPResource(top_resource, resource_name, subpath=None, allowed_hosts=N
     if resource_name in ir.children:
         raise AssertionError, 'Trying to insert several SOAP resource in same leaf. Go away.'
 
-    soap_resource = SOAPResource(allowed_hosts=allowed_hosts)
+    soap_resource = SOAPResource(allowed_hosts=allowed_hosts, max_payload_size=max_payload_size)
     ir.putChild(resource_name, soap_resource)
     return soap_resource
 
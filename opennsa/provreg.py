@@ -10,7 +10,7 @@ The class ProviderRegistry tries to keep it a bit sane.
 
 from twisted.python import log
 
-from opennsa import error
+from opennsa import error, logging
 
 LOG_SYSTEM = 'providerregistry'
 
@@ -22,6 +22,7 @@ class ProviderRegistry(object):
         self.providers = providers.copy()
         self.provider_factories = provider_factories # { provider_type : provider_spawn_func }
         self.provider_networks = {} # { provider_urn : [ network ] }
+        self.network_providers = {} # { network : provider_urn } ; reverse index, a network has one provider, first claim wins
 
 
     def getProvider(self, nsi_agent_urn):
@@ -38,10 +39,9 @@ class ProviderRegistry(object):
         """
         Get the provider urn by specifying network.
         """
-        for provider, networks in self.provider_networks.items():
-            if network_id in networks:
-                return provider
-        else:
+        try:
+            return self.network_providers[network_id]
+        except KeyError:
             raise error.STPResolutionError('Could not resolve a provider for %s' % network_id)
 
 
@@ -53,8 +53,30 @@ class ProviderRegistry(object):
             log.msg('Creating new provider for %s' % nsi_agent_urn, system=LOG_SYSTEM)
 
         self.providers[ nsi_agent_urn ] = provider
+        self._updateNetworks(nsi_agent_urn, network_ids)
+
+
+    def _updateNetworks(self, nsi_agent_urn, network_ids):
+
+        old_network_ids = self.provider_networks.get(nsi_agent_urn, [])
         self.provider_networks[ nsi_agent_urn ] = network_ids
 
+        # release networks which are no longer claimed, another provider may have claimed them as well
+        for network_id in old_network_ids:
+            if network_id in network_ids or self.network_providers.get(network_id) != nsi_agent_urn:
+                continue
+            self.network_providers.pop(network_id)
+            for provider_urn, provider_network_ids in self.provider_networks.items():
+                if network_id in provider_network_ids:
+                    log.msg('Network %s moved from %s to %s' % (network_id, nsi_agent_urn, provider_urn), system=LOG_SYSTEM)
+                    self.network_providers[network_id] = provider_urn
+                    break
+
+        for network_id in network_ids:
+            provider_urn = self.network_providers.setdefault(network_id, nsi_agent_urn)
+            if provider_urn != nsi_agent_urn:
+                log.msg('Network %s is claimed by both %s and %s, keeping %s as provider' % (network_id, provider_urn, nsi_agent_urn, provider_urn), system=LOG_SYSTEM)
+
 
     def spawnProvider(self, nsi_agent, network_ids):
         """
@@ -62,7 +84,7 @@ class ProviderRegistry(object):
         ServiceType must exist on the NSI agent, and a factory for the type available.
         """
         if nsi_agent.urn() in self.providers and self.provider_networks[nsi_agent.urn()] == network_ids:
-            log.msg('Skipping provider spawn for %s (no change)' % nsi_agent, debug=True, system=LOG_SYSTEM)
+            logging.debug('Skipping provider spawn for %s (no change)', nsi_agent, system=LOG_SYSTEM)
             return self.providers[nsi_agent.urn()]
 
         factory = self.provider_factories[ nsi_agent.getServiceType() ]
@@ -7,7 +7,7 @@ import datetime
 import importlib
 
 from twisted.python import log
-from twisted.web import resource, server
+from twisted.web import resource
 from twisted.application import internet, service as twistedservice
 
 from opennsa import __version__ as version
@@ -15,7 +15,7 @@ from opennsa import __version__ as version
 from opennsa import config, logging, constants as cnt, nsa, provreg, database, aggregator, viewresource
 from opennsa.topology import nrm, nml, linkvector, service as nmlservice
 from opennsa.protocols import rest, nsi2
-from opennsa.protocols.shared import httplog
+from opennsa.protocols.shared import httplog, httpclient, outboundqueue, minisoap, soapresource
 from opennsa.discovery import service as discoveryservice, fetcher
 
 
@@ -81,6 +81,18 @@ def setupBackend(backend_cfg, network_name, nrm_ports, parent_requester):
         raise config.ConfigurationError('No backend specified')
 
     b = BackendConstructer(network_name, nrm_ports, parent_requester, bc)
+
+    # the schedule is restored when the reactor starts, so this is in time for it
+    if config.SNAPSHOT_FILE in bc and hasattr(b, 'snapshot_file'):
+        b.snapshot_file = bc[config.SNAPSHOT_FILE]
+
+    if config.LABEL_ALLOCATION in bc and hasattr(b, 'label_allocation'):
+        from opennsa.backends.common import allocation
+        try:
+            b.label_allocation = allocation.createStrategy(bc[config.LABEL_ALLOCATION])
+        except ValueError as e:
+            raise config.ConfigurationError(str(e))
+
     return b
 
 
@@ -170,6 +182,12 @@ class OpenNSAService(twistedservice.MultiService):
         # database
         database.setupDatabase(vc[config.DATABASE], vc[config.DATABASE_USER], vc[config.DATABASE_PASSWORD], vc[config.DATABASE_HOST], vc[config.SERVICE_ID_START])
 
+        # outbound http connection pool
+        httpclient.configurePool(vc[config.HTTP_MAX_CONNECTIONS], vc[config.HTTP_IDLE_TIMEOUT])
+
+        # soap payload element nesting
+        minisoap.setMaxDepth(vc[config.SOAP_MAX_DEPTH])
+
         service_endpoints = []
 
         # base names
@@ -212,11 +230,23 @@ class OpenNSAService(twistedservice.MultiService):
 
         requester_creator.aggregator = aggr
 
-        pc = nsi2.setupProvider(aggr, top_resource, ctx_factory=ctx_factory, allowed_hosts=vc.get(config.ALLOWED_HOSTS))
+        # periodic logging of the aggregator orm cache statistics
+        cache_stats_service = internet.TimerService(aggregator.CACHE_STATS_INTERVAL, aggr.logCacheStats)
+        cache_stats_service.setServiceParent(self)
+
+        # durable delivery of callbacks to requesters
+        if vc[config.CALLBACK_QUEUE]:
+            outbound_queue = outboundqueue.OutboundQueue(ctx_factory)
+            outbound_queue.setServiceParent(self)
+        else:
+            outbound_queue = None
+
+        pc = nsi2.setupProvider(aggr, top_resource, ctx_factory=ctx_factory, allowed_hosts=vc.get(config.ALLOWED_HOSTS), outbound_queue=outbound_queue, max_payload_size=vc[config.SOAP_MAX_SIZE])
         aggr.parent_requester = pc
 
         # setup backend(s) - for now we only support one
         backend_configs = vc['backend']
+        backend_service = None
         if len(backend_configs) == 0:
             log.msg('No backend specified. Running in aggregator-only mode')
             if not cnt.AGGREGATOR in vc[config.POLICY]:
@@ -261,7 +291,8 @@ class OpenNSAService(twistedservice.MultiService):
         if vc[config.REST]:
             rest_url = base_url + '/connections'
 
-            rest.setupService(aggr, top_resource, vc.get(config.ALLOWED_HOSTS))
+            rest_backend = backend_service if hasattr(backend_service, 'findFreeWindows') else None
+            rest.setupService(aggr, top_resource, vc.get(config.ALLOWED_HOSTS), rest_backend)
 
             service_endpoints.append( ('REST', rest_url) )
             interfaces.append( (cnt.OPENNSA_REST, rest_url, None) )
@@ -293,7 +324,7 @@ class OpenNSAService(twistedservice.MultiService):
         for service_name, url in service_endpoints:
             log.msg('{:<12} URL: {}'.format(service_name, url))
 
-        factory = server.Site(top_resource)
+        factory = soapresource.SizeLimitedSite(top_resource)
         factory.log = httplog.logRequest # default logging is weird, so we do our own
 
         if vc[config.TLS]:
@@ -309,6 +340,8 @@ class OpenNSAService(twistedservice.MultiService):
 
     def stopService(self):
         twistedservice.Service.stopService(self)
+        # close the pooled outbound connections, instead of leaving them for the peers to time out
+        return httpclient.closeConnections()
 
 
 
@@ -0,0 +1,143 @@
+"""
+Identity cache for database objects.
+
+Keeps a single instance of each database object in memory, so concurrent
+updates of the same row work on the same object instead of stepping on each
+other. Entries are kept in least recently used order and evicted when they
+have been idle for too long, when the cache is above its size limit, or
+shortly after the object has reached a final state (e.g., terminated).
+
+An entry which is in flight (an operation on it is still in progress) is
+never evicted, as someone is likely to hold a reference to it, and loading
+a second instance of the object would break the single instance guarantee.
+For the same reason, entries are never evicted before they have been idle
+for a grace period.
+
+Author: Henrik Thostrup Jensen <htj@nordu.net>
+Copyright: NORDUnet (2016)
+"""
+
+import collections
+
+from twisted.internet import reactor
+
+
+
+class IdentityCache(object):
+
+    def __init__(self, max_size=10000, ttl=3600, grace=60, in_flight=None, final=None, clock=None):
+        """
+        max_size:   Number of entries above which idle entries are evicted.
+        ttl:        Idle time (seconds) after which an entry is evicted.
+        grace:      Minimum idle time (seconds) before an entry can be evicted.
+        in_flight:  Function telling if an object is in flight, i.e. must not be evicted.
+        final:      Function telling if an object is in a final state, and can be evicted after the grace period.
+        """
+        self.max_size   = max_size
+        self.ttl        = ttl
+        self.grace      = grace
+        self.in_flight  = in_flight or (lambda obj : False)
+        self.final      = final     or (lambda obj : False)
+        self.clock      = clock     or reactor
+
+        self.entries = collections.OrderedDict() # key -> ( object, last access time ), least recently used first
+        self.last_sweep = self.clock.seconds()
+
+        self.hits       = 0
+        self.misses     = 0
+        self.evictions  = 0
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def __contains__(self, key):
+        return key in self.entries
+
+
+    def get(self, key):
+        """
+        Returns the object for the key, or None if the key is not in the cache.
+        """
+        try:
+            obj, _ = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries[key] = (obj, self.clock.seconds())
+        return obj
+
+
+    def add(self, key, obj):
+        """
+        Adds an object to the cache, and returns the cached object for the
+        key. If the key is already in the cache (e.g., from a concurrent
+        lookup), the existing object is returned, and the new one is dropped.
+        """
+        try:
+            obj, _ = self.entries.pop(key)
+        except KeyError:
+            pass
+
+        self.entries[key] = (obj, self.clock.seconds())
+        self.evict()
+        return obj
+
+
+    def remove(self, key):
+        """
+        Removes an entry from the cache, e.g., when the object has been deleted.
+        """
+        self.entries.pop(key, None)
+
+
+    def evict(self):
+        """
+        Evicts idle, final, and least recently used entries. Returns the
+        number of evicted entries.
+        """
+        now = self.clock.seconds()
+        n_evicted = 0
+
+        # least recently used entries first, until reaching one which should stay
+        while self.entries:
+            key = next(iter(self.entries))
+            obj, last_access = self.entries[key]
+            idle = now - last_access
+            if idle < self.grace:
+                break
+            elif self.in_flight(obj):
+                # keep it, but move it out of the way
+                del self.entries[key]
+                self.entries[key] = (obj, now)
+            elif idle >= self.ttl or len(self.entries) > self.max_size or self.final(obj):
+                del self.entries[key]
+                n_evicted += 1
+            else:
+                break
+
+        # final entries further back, this requires a full scan, so only once per grace period
+        if now - self.last_sweep >= self.grace:
+            self.last_sweep = now
+            final_keys = [ key for key, (obj, last_access) in self.entries.iteritems()
+                           if now - last_access >= self.grace and self.final(obj) and not self.in_flight(obj) ]
+            for key in final_keys:
+                del self.entries[key]
+            n_evicted += len(final_keys)
+
+        self.evictions += n_evicted
+        return n_evicted
+
+
+    def hitRate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+
+    def stats(self):
+        return { 'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                 'evictions': self.evictions, 'hit_rate': self.hitRate() }
+
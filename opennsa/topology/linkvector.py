@@ -4,38 +4,62 @@ OpenNSA Link vector path finder.
 For each demarcation port in the network, a vector is kept of remote networks
 that can be reached from the link. Somewhat BGP like.
 
+For each remote network, the cheapest ports are kept (more than one, so
+alternative paths can be tried and load can be spread over parallel links).
+Ports with equal cost are ordered by their load, least loaded first.
+
+Updates only recalculate the networks affected by the change, and are no-ops
+if nothing changed. Subscribers are notified once for all updates within a
+short window, as peers are typically updated in bursts (one fetch cycle).
+
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 
 Copyright: NORDUnet (2011-2015)
 """
 
 from twisted.python import log
+from twisted.internet import reactor
+
+from opennsa import logging
 
 
 
 LOG_SYSTEM = 'topology.linkvector'
 
 DEFAULT_MAX_COST = 5
+DEFAULT_MAX_PATHS = 4
+DEFAULT_NOTIFY_DELAY = 5 # seconds
 
 
 
 class LinkVector:
 
-    def __init__(self, local_networks, blacklist_networks=None, max_cost=DEFAULT_MAX_COST):
+    def __init__(self, local_networks, blacklist_networks=None, max_cost=DEFAULT_MAX_COST, max_paths=DEFAULT_MAX_PATHS,
+                 notify_delay=DEFAULT_NOTIFY_DELAY, clock=None):
 
         # networks hosted by the local nsa, we want these in the vectors (though not used),
         # but don't want to export/use them in reachability
         self.local_networks = local_networks
         self.blacklist_networks = blacklist_networks if not blacklist_networks is None else []
         self.max_cost = max_cost
+        self.max_paths = max_paths
+        self.notify_delay = notify_delay
+        self.clock = clock or reactor
 
         # this is a set of vectors we keep for each peer
-        self.vectors = {} # port name -> { network : cost }
+        self.port_vectors = {} # port name -> { network : cost }
+
+        # the same vectors, indexed by network, so a network can be recalculated without looking at all ports
+        self.network_costs = {} # network -> { port name : cost }
+
+        # load of the ports, e.g., number of connections, used for ordering ports with equal cost
+        self.port_load = {} # port name -> load
 
         # this is the calculated shortest paths, should be recalculated when new information gets available
-        self._shortest_paths = {} # network -> ( port name, cost)
+        self._shortest_paths = {} # network -> [ ( port name, cost ) ], cheapest first
 
         self.subscribers = []
+        self.notify_call = None
 
     # -- updates
 
@@ -44,6 +68,13 @@ class LinkVector:
 
 
     def updated(self):
+        # coalesce updates, so a burst of them only notifies subscribers once
+        if self.subscribers and self.notify_call is None:
+            self.notify_call = self.clock.callLater(self.notify_delay, self._notifySubscribers)
+
+
+    def _notifySubscribers(self):
+        self.notify_call = None
         for f in self.subscribers:
             f()
 
@@ -51,59 +82,97 @@ class LinkVector:
 
     def updateVector(self, port, vectors):
 
-        if port in self.vectors:
-            self.vectors[port].update(vectors)
-        else:
-            self.vectors[port] = vectors
+        port_vectors = self.port_vectors.setdefault(port, {})
+        changed = [ network for network, cost in vectors.items() if port_vectors.get(network) != cost ]
+        if not changed:
+            return # nothing new
+
+        for network in changed:
+            port_vectors[network] = vectors[network]
+            self.network_costs.setdefault(network, {})[port] = vectors[network]
 
-        self._calculateVectors()
+        self._calculateVectors(changed)
         self.updated()
 
 
     def deleteVector(self, port):
         try:
-            self.vectors.pop(port)
-            self._calculateVectors()
+            port_vectors = self.port_vectors.pop(port)
         except KeyError:
             log.msg('Tried to delete non-existing vector for %s' % port)
+            return
+
+        for network in port_vectors:
+            costs = self.network_costs[network]
+            costs.pop(port)
+            if not costs:
+                self.network_costs.pop(network)
 
+        self._calculateVectors(port_vectors.keys())
+        self.updated()
 
-    def _calculateVectors(self):
 
-        log.msg('* Calculating shortest-path vectors', debug=True, system=LOG_SYSTEM)
-        paths = {}
-        for port, vectors in self.vectors.items():
+    def _calculateVectors(self, networks):
 
-            for network, cost in vectors.items():
-                if network in self.local_networks:
-                    continue # skip local networks
-                if network in self.blacklist_networks:
-                    log.msg('Skipping network %s in vector calculation, is blacklisted' % network, system=LOG_SYSTEM)
-                    continue
+        logging.debug('* Calculating shortest-path vectors for %i network(s)', len(networks), system=LOG_SYSTEM)
+        for network in networks:
+
+            if network in self.local_networks:
+                continue # skip local networks
+            if network in self.blacklist_networks:
+                log.msg('Skipping network %s in vector calculation, is blacklisted' % network, system=LOG_SYSTEM)
+                continue
+
+            candidates = []
+            for port, cost in self.network_costs.get(network, {}).items():
                 if cost > self.max_cost:
-                    log.msg('Skipping network %s in vector calculation, cost %i exceeds max cost %i' % (network, cost, self.max_cost), system=LOG_SYSTEM)
+                    log.msg('Skipping network %s via %s in vector calculation, cost %i exceeds max cost %i' % (network, port, cost, self.max_cost), system=LOG_SYSTEM)
                     continue
-                if not network in paths:
-                    paths[network] = (port, cost)
-                    log.msg('Added path to %s via %s. Cost %i' % (network, port, cost), debug=True, system=LOG_SYSTEM)
-                elif cost < paths[network][1]:
-                    paths[network] = (port, cost) # overwrite
-                    log.msg('Updated path to %s via %s. Cost %i' % (network, port, cost), debug=True, system=LOG_SYSTEM)
-                # no else, it means we have a cheaper path
+                candidates.append( (port, cost) )
+
+            if not candidates:
+                self._shortest_paths.pop(network, None)
+                continue
+
+            # cheapest first, sort is stable, so the first seen port wins on equal cost (until load is taken into account)
+            candidates.sort(key=lambda (port, cost) : cost)
+            if len(candidates) > self.max_paths:
+                # keep ports with the same cost as the last one, so they can still be picked by load
+                cutoff_cost = candidates[self.max_paths-1][1]
+                candidates = [ (port, cost) for port, cost in candidates if cost <= cutoff_cost ]
+            logging.debug('Path to %s via %s. Cost %i (%i alternatives)', network, candidates[0][0], candidates[0][1], len(candidates)-1, system=LOG_SYSTEM)
 
-        self._shortest_paths = paths
+            self._shortest_paths[network] = candidates
 
 
     def vector(self, network):
         # typical usage for path finding
-        try:
-            port, cost = self._shortest_paths[network]
-            return port
-        except KeyError:
-            return None # or do we need an exception here?
+        ports = self.vectors(network, 1)
+        return ports[0] if ports else None # or do we need an exception here?
+
+
+    def vectors(self, network, k=None):
+        """
+        Returns the (at most k) best ports to reach the network through. Ports
+        are ordered by cost, and then by load.
+        """
+        # the lists are short, so ordering by load when asked is cheaper than keeping it ordered
+        candidates = sorted(self._shortest_paths.get(network, []), key=lambda (port, cost) : (cost, self.port_load.get(port, 0)))
+        return [ port for port, _ in candidates[:k] ]
+
+
+    # -- load
+
+    def portLoad(self, port):
+        return self.port_load.get(port, 0)
+
+
+    def addPortLoad(self, port, load):
+        # use negative load to decrease, load from before a restart is not known, so never go below zero
+        self.port_load[port] = max(0, self.port_load.get(port, 0) + load)
 
 
     def listVectors(self):
         # needed for exporting topologies
-        return { network : cost for (network, (_, cost) ) in self._shortest_paths.items() }
+        return { network : candidates[0][1] for (network, candidates) in self._shortest_paths.items() }
 
@@ -6,6 +6,7 @@ Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2013)
 """
 
+import heapq
 import itertools
 import datetime
 
@@ -19,6 +20,9 @@ LOG_SYSTEM = 'opennsa.topology'
 INGRESS = 'ingress'
 EGRESS  = 'egress'
 
+DEFAULT_MAX_HOPS  = 6 # networks in a path
+DEFAULT_MAX_PATHS = 3 # same as the number of path candidates the aggregator tries
+
 
 
 class Port(object):
@@ -37,7 +41,7 @@ class Port(object):
 
 
     def canMatchLabel(self, label):
-        return nsa.Label.canMatch(self, label)
+        return nsa.Label.canMatch(self._label, label)
 
 
     def isBidirectional(self):
@@ -142,19 +146,35 @@ class Network(object):
         self.bidirectional_ports = bidirectional_ports or []
         self.version             = version or datetime.datetime.utcnow().replace(microsecond=0)
 
+        # indexes, the port lists are not changed after creation
+        self._ports = {} # port id -> port
+        for port in itertools.chain(self.inbound_ports, self.outbound_ports, self.bidirectional_ports):
+            self._ports[port.id_] = port
+        self._bidirectional_ports = { (bp.inbound_port.id_, bp.outbound_port.id_) : bp for bp in self.bidirectional_ports }
+
+
+    def portIds(self):
+        return self._ports.keys()
+
 
     def getPort(self, port_id):
-        for port in itertools.chain(self.inbound_ports, self.outbound_ports, self.bidirectional_ports):
-            if port.id_ == port_id:
-                return port
-        # better error message
-        ports = [ p.id_ for p in list(itertools.chain(self.inbound_ports, self.outbound_ports, self.bidirectional_ports)) ]
-        raise error.STPUnavailableError('No port named %s for network %s (ports: %s)' %(port_id, self.id_, str(ports)))
+        try:
+            return self._ports[port_id]
+        except KeyError:
+            # better error message
+            ports = [ p.id_ for p in list(itertools.chain(self.inbound_ports, self.outbound_ports, self.bidirectional_ports)) ]
+            raise error.STPUnavailableError('No port named %s for network %s (ports: %s)' %(port_id, self.id_, str(ports)))
+
+
+    def getBidirectionalPort(self, inbound_port_id, outbound_port_id):
+        # returns the bidirectional port of the unidirectional ports, or None if they are not paired
+        return self._bidirectional_ports.get( (inbound_port_id, outbound_port_id) )
 
 
     def findPorts(self, bidirectionality, label=None, exclude=None):
         matching_ports = []
-        for port in itertools.chain(self.inbound_ports, self.outbound_ports, self.bidirectional_ports):
+        ports = self.bidirectional_ports if bidirectionality else itertools.chain(self.inbound_ports, self.outbound_ports)
+        for port in ports:
             if port.isBidirectional() == bidirectionality and (label is None or port.canMatchLabel(label)):
                 if exclude and port.id_ == exclude:
                     continue
@@ -171,6 +191,7 @@ class Topology(object):
 
     def __init__(self):
         self.networks = {} # network_name -> ( Network, nsa.NetworkServiceAgent)
+        self.port_networks = {} # port id -> network id
 
 
     def addNetwork(self, network, managing_nsa):
@@ -181,17 +202,27 @@ class Topology(object):
             raise error.TopologyError('Entry for network with id %s already exists' % network.id_)
 
         self.networks[network.id_] = (network, managing_nsa)
+        for port_id in network.portIds():
+            self.port_networks[port_id] = network.id_
+
+
+    def _removeNetwork(self, network_id):
+        network, managing_nsa = self.networks.pop(network_id)
+        for port_id in network.portIds():
+            if self.port_networks.get(port_id) == network_id:
+                self.port_networks.pop(port_id)
+        return network, managing_nsa
 
 
     def updateNetwork(self, network, managing_nsa):
         # update an existing network entry
-        existing_entry = self.networks.pop(network.id_, None) # note - we may get none here (for new network)
+        existing_entry = self._removeNetwork(network.id_) if network.id_ in self.networks else None # note - we may get none here (for new network)
         try:
             self.addNetwork(network, managing_nsa)
         except error.TopologyError as e:
             log.msg('Error updating network entry for %s. Reason: %s' % (network.id_, str(e)))
             if existing_entry:
-                self.networks[network.id_] = existing_entry # restore old entry
+                self.addNetwork(*existing_entry) # restore old entry
             raise e
 
 
@@ -203,14 +234,11 @@ class Topology(object):
 
 
     def getNetworkPort(self, port_id):
-        for network_id, (network,_) in self.networks.items():
-            try:
-                port = network.getPort(port_id)
-                return network_id, port
-            except error.TopologyError:
-                continue
-        else:
+        try:
+            network_id = self.port_networks[port_id]
+        except KeyError:
             raise error.TopologyError('Cannot find port with id %s in topology' % port_id)
+        return network_id, self.getNetwork(network_id).getPort(port_id)
 
 
     def getNSA(self, network_id):
@@ -240,16 +268,23 @@ class Topology(object):
 
         remote_network = self.getNetwork(remote_network_in)
 
-        for rp in remote_network.findPorts(True):
-            if isinstance(rp, BidirectionalPort) and rp.inbound_port.id_ == remote_port_in.id_ and rp.outbound_port.id_ == remote_port_out.id_:
-                return remote_network.id_, rp.id_
-        return None
+        rp = remote_network.getBidirectionalPort(remote_port_in.id_, remote_port_out.id_)
+        if rp is None:
+            return None
+        return remote_network.id_, rp.id_
 
 
-    def findPaths(self, source_stp, dest_stp, bandwidth, exclude_networks=None):
+    def findPaths(self, source_stp, dest_stp, bandwidth, exclude_networks=None, max_paths=DEFAULT_MAX_PATHS, max_hops=DEFAULT_MAX_HOPS):
+        """
+        Finds paths between two STPs, shortest (fewest networks) first. At
+        most max_paths paths are returned, and paths through more than
+        max_hops networks are not considered.
 
-        source_port = self.getNetwork(source_stp.network).getPort(source_stp.port)
-        dest_port   = self.getNetwork(dest_stp.network).getPort(dest_stp.port)
+        Labels are not swapped in the path, i.e., the same label is used
+        through all networks (see Network.canSwapLabel).
+        """
+        source_port = self.getNetwork(source_stp.network).getPort(source_stp.network + ':' + source_stp.port)
+        dest_port   = self.getNetwork(dest_stp.network).getPort(dest_stp.network + ':' + dest_stp.port)
 
         if source_port.isBidirectional() or dest_port.isBidirectional():
             # at least one of the stps are bidirectional
@@ -258,9 +293,7 @@ class Topology(object):
             if not dest_port.isBidirectional():
                 raise error.TopologyError('Cannot connect bidirectional destination with unidirectional source')
         else:
-            # both ports are unidirectional
-            if not (source_port.orientation, dest_port.orientation) in ( (INGRESS, EGRESS), (EGRESS, INGRESS) ):
-                raise error.TopologyError('Cannot connect STPs of same unidirectional direction (%s -> %s)' % (source_port.orientation, dest_port.orientation))
+            raise error.TopologyError('Unidirectional path-finding not implemented yet')
 
         # these are only really interesting for the initial call, afterwards they just prune
         if not source_port.canMatchLabel(source_stp.label):
@@ -272,77 +305,88 @@ class Topology(object):
 #        if not dest_port.canProvideBandwidth(bandwidth):
 #            raise error.BandwidthUnavailableError('Destination port cannot provide enough bandwidth (%i)' % bandwidth)
 
-        return self._findPathsRecurse(source_stp, dest_stp, bandwidth)
+        try:
+            label = _intersectLabels(source_stp.label, dest_stp.label)
+        except nsa.EmptyLabelSet:
+            return [] # no label can be used end to end
+
+        return self._findPaths(source_port, dest_port, label, exclude_networks or [], max_paths, max_hops)
 
 
-    def _findPathsRecurse(self, source_stp, dest_stp, bandwidth, exclude_networks=None):
+    def _findPaths(self, source_port, dest_port, label, exclude_networks, max_paths, max_hops):
+        # best-first search over ( network, ingress port ), with the fewest networks first
+        # as all networks have the same cost, this finds the shortest paths first, and the search can stop after max_paths
 
-        source_network = self.getNetwork(source_stp.network)
-        dest_network   = self.getNetwork(dest_stp.network)
-        source_port    = source_network.getPort(source_stp.port)
-        dest_port      = dest_network.getPort(dest_stp.port)
+        source_network_id = self.port_networks[source_port.id_]
+        dest_network_id   = self.port_networks[dest_port.id_]
 
-        if not (source_port.canMatchLabel(source_stp.label) or dest_port.canMatchLabel(dest_stp.label)):
-            return []
-#        if not (source_port.canProvideBandwidth(bandwidth) and dest_port.canProvideBandwidth(bandwidth)):
-#            return []
+        port_labels = {} # ( port id, port id ) -> label both ports can carry, memoised as the same port pairs are tried from many branches
 
-        if source_port.isBidirectional() and dest_port.isBidirectional():
-            # bidirectional path finding, easy case first
-            if source_stp.network == dest_stp.network:
-                # while it is possible to cross other network in order to connect to intra-network STPs
-                # it is not something we really want to do in the real world, so we don't
+        def pairLabel(port1, port2):
+            key = (port1.id_, port2.id_)
+            if not key in port_labels:
                 try:
-                    if source_network.canSwapLabel(source_stp.label.type_):
-                        source_label = source_port.label().intersect(source_stp.label)
-                        dest_label   = dest_port.label().intersect(dest_stp.label)
-                    else:
-                        source_label = source_port.label().intersect(dest_port.label()).intersect(source_stp.label).intersect(dest_stp.label)
-                        dest_label   = source_label
-                    link = nsa.Link(source_stp.network, source_stp.port, dest_stp.port, source_label, dest_label)
-                    return [ [ link ] ]
+                    port_labels[key] = ( True, _intersectLabels(port1.label(), port2.label()) )
                 except nsa.EmptyLabelSet:
-                    return [] # no path
-            else:
-                # ok, time for real pathfinding
-                link_ports = source_network.findPorts(True, source_stp.label, source_stp.port)
-                link_ports = [ port for port in link_ports if port.hasRemote() ] # filter out termination ports
-                links = []
-                for lp in link_ports:
-                    demarcation = self.findDemarcationPort(lp)
-                    if demarcation is None:
-                        continue
-
-                    d_network_id, d_port_id = demarcation
-
-                    if exclude_networks is not None and demarcation[0] in exclude_networks:
-                        continue # don't do loops in path finding
-
-                    demarcation_label = lp.label() if source_network.canSwapLabel(source_stp.label.type_) else source_stp.label.intersect(lp.label())
-                    demarcation_stp = nsa.STP(demarcation[0], demarcation[1], demarcation_label)
-                    sub_exclude_networks = [ source_network.id_ ] + (exclude_networks or [])
-                    sub_links = self._findPathsRecurse(demarcation_stp, dest_stp, bandwidth, sub_exclude_networks)
-                    # if we didn't find any sub paths, just continue
-                    if not sub_links:
-                        continue
-
-                    for sl in sub_links:
-                        # --
-                        if source_network.canSwapLabel(source_stp.label.type_):
-                            source_label = source_port.label().intersect(source_stp.label)
-                            dest_label   = lp.label().intersect(sl[0].src_stp.label)
-                        else:
-                            source_label = source_port.label().intersect(source_stp.label).intersect(lp.label()).intersect(sl[0].src_stp.label)
-                            dest_label   = source_label
-
-                        first_link = nsa.Link(source_stp.network, source_stp.port, lp.id_, source_label, dest_label)
-                        path = [ first_link ] + sl
-                        links.append(path)
-
-                return sorted(links, key=len) # sort by length, shortest first
+                    port_labels[key] = ( False, None )
+            return port_labels[key]
 
-        else:
-            raise error.TopologyError('Unidirectional path-finding not implemented yet')
+        def restrictLabel(label, port1, port2):
+            # raises EmptyLabelSet if the ports cannot carry the label
+            feasible, port_label = pairLabel(port1, port2)
+            if not feasible:
+                raise nsa.EmptyLabelSet()
+            return _intersectLabels(label, port_label)
+
+        paths = []
+        sequence = itertools.count() # tie breaker, so paths are found in the order they are explored
+        queue = [ (1, next(sequence), source_network_id, source_port, label, (), frozenset([ source_network_id ] + exclude_networks)) ]
+
+        while queue and len(paths) < max_paths:
+            hops, _, network_id, in_port, label, hop_ports, visited = heapq.heappop(queue)
+
+            if network_id == dest_network_id:
+                # we don't go through other networks to connect ports in the same network
+                try:
+                    label = restrictLabel(label, in_port, dest_port)
+                except nsa.EmptyLabelSet:
+                    continue
+                hop_ports += ( (network_id, in_port, dest_port), )
+                paths.append( [ nsa.Link( nsa.STP(nid, p1.name, label), nsa.STP(nid, p2.name, label) ) for nid, p1, p2 in hop_ports ] )
+                continue
+
+            if hops >= max_hops:
+                continue
+
+            network = self.getNetwork(network_id)
+            for lp in network.findPorts(True, label, in_port.id_):
+                if not lp.hasRemote():
+                    continue # termination port
+                demarcation = self.findDemarcationPort(lp)
+                if demarcation is None or demarcation[0] in visited:
+                    continue # no loops
+
+                d_network_id, d_port_id = demarcation
+                d_port = self.getNetwork(d_network_id).getPort(d_port_id)
+                try:
+                    link_label = restrictLabel(restrictLabel(label, in_port, lp), lp, d_port)
+                except nsa.EmptyLabelSet:
+                    continue
+
+                heapq.heappush(queue, (hops+1, next(sequence), d_network_id, d_port, link_label,
+                                       hop_ports + ( (network_id, in_port, lp), ), visited | frozenset([ d_network_id ])) )
+
+        return paths
+
+
+
+def _intersectLabels(label1, label2):
+    # like Label.intersect, but ports and stps without labels can be matched with each other (and nothing else)
+    if label1 is None and label2 is None:
+        return None
+    if label1 is None or label2 is None:
+        raise nsa.EmptyLabelSet()
+    return label1.intersect(label2)
 
 
 
@@ -15,6 +15,7 @@ class DUDRequester:
         self.reserve_timeout_defer   = defer.Deferred()
         self.data_plane_change_defer = defer.Deferred()
         self.error_event_defer       = defer.Deferred()
+        self.message_delivery_timeout_defer = defer.Deferred()
 
     def reserveConfirmed(self, *args):
         self.reserve_defer.callback(args)
@@ -58,3 +59,6 @@ class DUDRequester:
     def errorEvent(self, *args):
         self.error_event_defer.callback(args)
 
+    def messageDeliveryTimeout(self, *args):
+        self.message_delivery_timeout_defer.callback(args)
+
@@ -0,0 +1,87 @@
+import random
+
+from twisted.trial import unittest
+
+from opennsa import nsa
+from opennsa.backends.common import allocation, calendar
+
+
+
+class AllocationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mask = calendar.labelMask( nsa.Label('vlan', '10-13,20') )
+
+
+    def allocate(self, strategy, key, mask):
+        for value in strategy.candidates(key, mask):
+            strategy.allocated(key, value)
+            return value
+
+
+    def testFirstLastFit(self):
+
+        self.failUnlessEqual(list(allocation.FirstFit().candidates('k', self.mask)), [10, 11, 12, 13, 20])
+        self.failUnlessEqual(list(allocation.LastFit().candidates('k', self.mask)),  [20, 13, 12, 11, 10])
+        self.failUnlessEqual(list(allocation.LastFit().candidates('k', 0)), [])
+
+
+    def testRoundRobin(self):
+
+        rr = allocation.RoundRobin()
+        values = [ self.allocate(rr, 'k', self.mask) for _ in range(6) ]
+        self.failUnlessEqual(values, [10, 11, 12, 13, 20, 10])
+
+        # cursor continues after the last allocated value, wrapping around
+        self.allocate(rr, 'k', self.mask)
+        self.failUnlessEqual(list(rr.candidates('k', self.mask)), [12, 13, 20, 10, 11])
+
+        # other keys have their own cursor
+        self.failUnlessEqual(self.allocate(rr, 'k2', self.mask), 10)
+
+
+    def testLeastRecentlyUsed(self):
+
+        lru = allocation.LeastRecentlyUsed()
+        self.allocate(lru, 'k', self.mask) # 10
+        self.allocate(lru, 'k', self.mask) # 11
+
+        # unused values come first, then the least recently used
+        self.failUnlessEqual(list(lru.candidates('k', self.mask)), [12, 13, 20, 10, 11])
+
+        lru.allocated('k', 10)
+        self.failUnlessEqual(list(lru.candidates('k', calendar.labelMask( nsa.Label('vlan', '10-11') ))), [11, 10])
+
+
+    def testRandom(self):
+
+        strategy = allocation.Random(random.Random(42))
+        values = list(strategy.candidates('k', self.mask))
+        self.failUnlessEqual(sorted(values), [10, 11, 12, 13, 20])
+
+        # sparse mask, most samples miss, all values are still candidates
+        sparse = (1 << 4000) | (1 << 2)
+        self.failUnlessEqual(sorted(strategy.candidates('k', sparse)), [2, 4000])
+
+        # picking a value from a big range takes a few samples, not all values
+        full = calendar.labelMask( nsa.Label('vlan', '1-4094') )
+        self.failUnless(1 <= strategy.candidates('k', full).next() <= 4094)
+
+
+    def testCreateStrategy(self):
+
+        self.failUnless(isinstance(allocation.createStrategy('LastFit'), allocation.LastFit))
+        self.failUnlessRaises(ValueError, allocation.createStrategy, 'bestfit')
+
+
+    def testLabelSelect(self):
+
+        label = nsa.Label('vlan', '1780-1782')
+        self.failUnlessEqual(label.randomLabel(allocation.LastFit()), 1782)
+
+        rr = allocation.RoundRobin()
+        self.failUnlessEqual([ label.randomLabel(rr, 'port') for _ in range(4) ], [1780, 1781, 1782, 1780])
+
+        for _ in range(20):
+            self.failUnless(1780 <= label.randomLabel() <= 1782)
+
@@ -2,7 +2,7 @@ import datetime
 
 from twisted.trial import unittest
 
-from opennsa import error
+from opennsa import nsa, error
 from opennsa.backends.common import calendar
 
 
@@ -87,3 +87,226 @@ class CalendarTest(unittest.TestCase):
         self.failUnlessRaises(error.STPUnavailableError, self.c.checkReservation, 'r1', ds2, de2)
 
 
+
+
+    def testRemoveReservation(self):
+
+        ds = datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+        de = datetime.datetime.utcnow() + datetime.timedelta(seconds=3)
+
+        self.c.addReservation('r1', ds, de)
+        self.failUnlessRaises(error.STPUnavailableError, self.c.checkReservation, 'r1', ds, de)
+
+        self.c.removeReservation('r1', ds, de)
+        self.c.checkReservation('r1', ds, de)
+
+        self.failUnlessRaises(ValueError, self.c.removeReservation, 'r1', ds, de)
+
+
+    def testResourceSeparation(self):
+
+        ds = datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+        de = datetime.datetime.utcnow() + datetime.timedelta(seconds=3)
+
+        self.c.addReservation('r1', ds, de)
+        self.c.checkReservation('r2', ds, de)
+        self.c.addReservation('r2', ds, de)
+
+        self.failUnlessRaises(error.STPUnavailableError, self.c.checkReservation, 'r1', ds, de)
+        self.failUnlessRaises(error.STPUnavailableError, self.c.checkReservation, 'r2', ds, de)
+
+
+    def testManyReservations(self):
+
+        now = datetime.datetime.utcnow()
+        for i in range(1, 200, 2):
+            self.c.addReservation('r1', now + datetime.timedelta(seconds=i*10), now + datetime.timedelta(seconds=i*10+5))
+
+        # gaps between the reservations are free, the reservations themselves are not
+        self.c.checkReservation('r1', now + datetime.timedelta(seconds=506), now + datetime.timedelta(seconds=509))
+        self.failUnlessRaises(error.STPUnavailableError, self.c.checkReservation, 'r1',
+                              now + datetime.timedelta(seconds=506), now + datetime.timedelta(seconds=511))
+        self.failUnlessRaises(error.STPUnavailableError, self.c.checkReservation, 'r1',
+                              now + datetime.timedelta(seconds=1), None)
+
+
+    def testEvictExpired(self):
+
+        now = datetime.datetime.utcnow()
+        past   = now - datetime.timedelta(seconds=100)
+        future = now + datetime.timedelta(seconds=100)
+
+        self.c.addReservation('r1', past - datetime.timedelta(seconds=10), past)
+        self.c.addReservation('r1', past, future)
+        self.c.addReservation('r2', None, past)
+        self.c.addReservation('r3', past, None)
+
+        self.failUnlessEqual(self.c.evictExpired(now), 2)
+        self.failUnlessEqual(self.c.evicted, 2)
+        self.failUnlessEqual(sorted(self.c.reservations.keys()), ['r1', 'r3'])
+
+        self.failUnlessEqual(self.c.evictExpired(now), 0)
+        self.failUnlessEqual(self.c.evicted, 2)
+
+
+    def testFindFreeWindows(self):
+
+        now = datetime.datetime.utcnow()
+        t = lambda seconds : now + datetime.timedelta(seconds=seconds)
+        one_sec = datetime.timedelta(seconds=1)
+
+        self.c.addReservation('r1', t(100), t(200))
+        self.c.addReservation('r1', t(150), t(250))
+        self.c.addReservation('r1', t(400), None)
+
+        windows = self.c.findFreeWindows('r1', t(0), t(1000), datetime.timedelta(seconds=60))
+        self.failUnlessEqual(windows, [ (t(0), t(100) - one_sec), (t(250) + one_sec, t(400) - one_sec) ])
+
+        # windows must be long enough
+        windows = self.c.findFreeWindows('r1', t(0), t(1000), datetime.timedelta(seconds=120))
+        self.failUnlessEqual(windows, [ (t(250) + one_sec, t(400) - one_sec) ])
+
+        # free resource
+        self.failUnlessEqual(self.c.findFreeWindows('r2', t(0), t(10), datetime.timedelta(seconds=5)), [ (t(0), t(10)) ])
+
+        # windows can be used for reservations
+        for start_time, end_time in self.c.findFreeWindows('r1', t(10), t(1000), datetime.timedelta(seconds=60)):
+            self.c.checkReservation('r1', start_time, end_time)
+
+
+
+class CapacityCalendarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cc = calendar.CapacityCalendar()
+
+
+    def testEvictExpired(self):
+
+        now = datetime.datetime.utcnow()
+        past   = now - datetime.timedelta(seconds=100)
+        future = now + datetime.timedelta(seconds=100)
+
+        self.cc.addReservation('p1', 100, past - datetime.timedelta(seconds=10), past)
+        self.cc.addReservation('p1', 200, past, future)
+        self.cc.addReservation('p2', 300, None, past)
+
+        self.failUnlessEqual(self.cc.evictExpired(now), 2)
+        self.failUnlessEqual(self.cc.evicted, 2)
+        self.failUnlessEqual(self.cc.usage.keys(), ['p1'])
+        self.failUnlessEqual(self.cc.peakUsage('p1', None, None), 200)
+
+        self.cc.removeReservation('p1', 200, past, future)
+        self.failUnlessEqual(self.cc.usage, {})
+        self.failUnlessRaises(ValueError, self.cc.removeReservation, 'p1', 200, past, future)
+
+
+    def testFindBusy(self):
+
+        now = datetime.datetime.utcnow()
+        t = lambda seconds : now + datetime.timedelta(seconds=seconds)
+
+        self.cc.addReservation('p1', 400, t(100), t(200))
+        self.cc.addReservation('p1', 400, t(150), t(300))
+
+        self.failUnlessEqual(self.cc.findBusy('p1', 100, 1000, t(0), t(1000)), [])
+        self.failUnlessEqual(self.cc.findBusy('p1', 300, 1000, t(0), t(1000)), [ (t(150), t(200)) ])
+        self.failUnlessEqual(self.cc.findBusy('p1', 700, 1000, t(0), t(1000)), [ (t(100), t(300)) ])
+        self.failUnlessEqual(self.cc.findBusy('p1', 700, 1000, t(120), t(250)), [ (t(120), t(250)) ])
+        self.failUnlessEqual(self.cc.findBusy('p1', 2000, 1000, t(0), t(1000)), [ (t(0), t(1000)) ])
+        self.failUnlessEqual(self.cc.findBusy('p2', 700, 1000, t(0), t(1000)), [])
+
+
+
+class LabelCalendarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lc = calendar.LabelCalendar()
+
+
+    def testLabelMask(self):
+
+        label = nsa.Label('vlan', '1-3,7')
+        self.failUnlessEqual(calendar.labelMask(label), 0b10001110)
+        self.failUnlessEqual(list(calendar.maskValues(calendar.labelMask(label))), [1, 2, 3, 7])
+
+
+    def testFindFreeValues(self):
+
+        ds = datetime.datetime.utcnow() + datetime.timedelta(seconds=10)
+        de = datetime.datetime.utcnow() + datetime.timedelta(seconds=20)
+
+        self.lc.addReservation('p1', nsa.Label('vlan', '100'), ds, de)
+        self.lc.addReservation('p2', nsa.Label('vlan', '101'), ds, de)
+        self.lc.addReservation('p1', nsa.Label('mpls', '102'), ds, de)
+
+        request = nsa.Label('vlan', '100-103')
+        self.failUnlessEqual(list(self.lc.findFreeValues(['p1'], request, ds, de)), [101, 102, 103])
+        self.failUnlessEqual(list(self.lc.findFreeValues(['p1', 'p2'], request, ds, de)), [102, 103])
+
+        # outside of reservation time span
+        later = de + datetime.timedelta(seconds=10)
+        self.failUnlessEqual(list(self.lc.findFreeValues(['p1', 'p2'], request, later, None)), [100, 101, 102, 103])
+
+        self.lc.removeReservation('p1', nsa.Label('vlan', '100'), ds, de)
+        self.failUnlessEqual(list(self.lc.findFreeValues(['p1'], request, ds, de)), [100, 101, 102, 103])
+        self.failUnlessRaises(ValueError, self.lc.removeReservation, 'p1', nsa.Label('vlan', '100'), ds, de)
+
+
+    def testUsedValues(self):
+
+        now = datetime.datetime.utcnow()
+        past   = now - datetime.timedelta(seconds=100)
+        future = now + datetime.timedelta(seconds=100)
+
+        self.lc.addReservation('p1', nsa.Label('vlan', '100'), now, future)
+        self.lc.addReservation('p1', nsa.Label('vlan', '100'), future, None)
+        self.lc.addReservation('p1', nsa.Label('vlan', '101'), None, past)
+        self.failUnlessEqual(self.lc.used, { ('p1', 'vlan') : 0b11 << 100 })
+
+        # values without reservations are free, without looking at the reservations
+        self.lc.busyMask = None
+        self.failUnlessEqual(list(self.lc.findFreeValues(['p1'], nsa.Label('vlan', '102-103'), now, future)), [102, 103])
+        del self.lc.busyMask
+
+        self.lc.evictExpired(now)
+        self.failUnlessEqual(self.lc.used, { ('p1', 'vlan') : 1 << 100 })
+        self.lc.removeReservation('p1', nsa.Label('vlan', '100'), now, future)
+        self.failUnlessEqual(self.lc.used, { ('p1', 'vlan') : 1 << 100 })
+        self.lc.removeReservation('p1', nsa.Label('vlan', '100'), future, None)
+        self.failUnlessEqual( (self.lc.used, self.lc.counts), ({}, {}) )
+
+
+    def testOpenEndedReservation(self):
+
+        ds = datetime.datetime.utcnow() + datetime.timedelta(seconds=10)
+
+        self.lc.addReservation('p1', nsa.Label('vlan', '1780'), None, None)
+        request = nsa.Label('vlan', '1780-1781')
+        self.failUnlessEqual(list(self.lc.findFreeValues(['p1'], request, ds, None)), [1781])
+        self.failUnlessEqual(list(self.lc.findFreeValues(['p1'], request, None, None)), [1781])
+
+
+    def testFindFreeWindows(self):
+
+        now = datetime.datetime.utcnow()
+        t = lambda seconds : now + datetime.timedelta(seconds=seconds)
+        one_sec = datetime.timedelta(seconds=1)
+        minute = datetime.timedelta(seconds=60)
+
+        self.lc.addReservation('p1', nsa.Label('vlan', '1783'), t(100), t(200))
+        self.lc.addReservation('p1', nsa.Label('vlan', '1784'), t(100), t(200))
+        self.lc.addReservation('p1', nsa.Label('vlan', '1786'), t(0), None)
+
+        request = nsa.Label('vlan', '1780-1789')
+        windows = self.lc.findFreeWindows('p1', request, t(0), t(1000), minute)
+        free = [ (t(0), t(1000)) ]
+        split = [ (t(0), t(100) - one_sec), (t(200) + one_sec, t(1000)) ]
+        # values with the same windows are ranges, 1786 has no windows
+        self.failUnlessEqual(windows, [ ((1780, 1782), free), ((1783, 1784), split), ((1785, 1785), free), ((1787, 1789), free) ])
+
+        # windows where the port is busy anyway, apply to all values
+        busy = [ (t(500), t(600)) ]
+        windows = self.lc.findFreeWindows('p1', nsa.Label('vlan', '1783,1787'), t(0), t(1000), minute, busy)
+        self.failUnlessEqual(windows, [ ((1783, 1783), [ split[0], (t(200) + one_sec, t(500) - one_sec), (t(600) + one_sec, t(1000)) ]),
+                                        ((1787, 1787), [ (t(0), t(500) - one_sec), (t(600) + one_sec, t(1000)) ]) ])
@@ -0,0 +1,182 @@
+import os
+import shutil
+import tempfile
+
+from OpenSSL import SSL, crypto
+
+from twisted.trial import unittest
+from twisted.internet import reactor, defer
+from twisted.web import resource, server
+from twisted.web.error import Error as WebError
+
+from opennsa import ctxfactory
+from opennsa.protocols.shared import httpclient
+
+
+
+class TestResource(resource.Resource):
+
+    isLeaf = True
+
+    def render_POST(self, request):
+        if request.path == '/fault':
+            request.setResponseCode(500)
+            return 'fault:' + request.content.read()
+        elif request.path == '/slow':
+            return server.NOT_DONE_YET
+        return 'reply:' + request.content.read()
+
+
+
+def createCertificate(cert_dir):
+    # self-signed certificate for localhost, stored with the hashed name as well, so it is loaded as ca
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+
+    cert = crypto.X509()
+    cert.get_subject().CN = 'localhost'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(-3600)
+    cert.gmtime_adj_notAfter(3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+
+    key_file  = os.path.join(cert_dir, 'key.pem')
+    cert_file = os.path.join(cert_dir, 'cert.pem')
+    open(key_file, 'w').write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+    open(cert_file, 'w').write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+    shutil.copy(cert_file, os.path.join(cert_dir, '%08x.0' % cert.subject_name_hash()))
+
+    return key_file, cert_file
+
+
+
+class CountingSite(server.Site):
+
+    connections = 0
+
+    def buildProtocol(self, addr):
+        self.connections += 1
+        return server.Site.buildProtocol(self, addr)
+
+
+
+class HTTPClientTest(unittest.TestCase):
+
+    def setUp(self):
+        httpclient.configurePool(max_connections_per_host=2, idle_timeout_seconds=10)
+        self.site = CountingSite(TestResource())
+        self.iport = reactor.listenTCP(0, self.site, interface='127.0.0.1')
+        self.base_url = 'http://127.0.0.1:%i' % self.iport.getHost().port
+
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield httpclient.closeConnections()
+        yield self.iport.stopListening()
+        httpclient.configurePool()
+
+
+    @defer.inlineCallbacks
+    def testKeepAlive(self):
+
+        for i in range(3):
+            data = yield httpclient.soapRequest(self.base_url + '/', 'action', 'payload%i' % i)
+            self.failUnlessEqual(data, 'reply:payload%i' % i)
+
+        self.failUnlessEqual(self.site.connections, 1)
+
+
+    @defer.inlineCallbacks
+    def testFault(self):
+
+        try:
+            yield httpclient.soapRequest(self.base_url + '/fault', 'action', 'payload')
+            self.fail('Should have raised WebError')
+        except WebError as e:
+            self.failUnlessEqual(e.status, '500')
+            self.failUnlessEqual(e.response, 'fault:payload')
+
+        # connection is still usable after an error reply
+        data = yield httpclient.soapRequest(self.base_url + '/', 'action', 'payload')
+        self.failUnlessEqual(data, 'reply:payload')
+        self.failUnlessEqual(self.site.connections, 1)
+
+
+    @defer.inlineCallbacks
+    def testTimeout(self):
+
+        try:
+            yield httpclient.soapRequest(self.base_url + '/slow', 'action', 'payload', timeout=0.2)
+            self.fail('Should have raised TimeoutError')
+        except defer.TimeoutError:
+            pass
+
+
+
+class TLSSessionResumptionTest(unittest.TestCase):
+
+    def setUp(self):
+        httpclient.configurePool(max_connections_per_host=0) # new connection (and handshake) for every request
+
+        self.cert_dir = tempfile.mkdtemp()
+        key_file, cert_file = createCertificate(self.cert_dir)
+
+        self.service_factory = ctxfactory.ContextFactory(key_file, cert_file, self.cert_dir, True)
+        self.iport = reactor.listenSSL(0, server.Site(TestResource()), self.service_factory, interface='127.0.0.1')
+        self.url = 'https://localhost:%i/' % self.iport.getHost().port
+
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield httpclient.closeConnections()
+        yield self.iport.stopListening()
+        httpclient.configurePool()
+        shutil.rmtree(self.cert_dir)
+
+
+    def handshakes(self):
+        # ( completed handshakes, resumed handshakes ) seen by the service
+        ctx = self.service_factory.getContext()._context
+        return SSL._lib.SSL_CTX_sess_accept_good(ctx), SSL._lib.SSL_CTX_sess_hits(ctx)
+
+
+    @defer.inlineCallbacks
+    def testSessionResumption(self):
+
+        client_factory = ctxfactory.RequestContextFactory(self.cert_dir, True)
+
+        for i in range(3):
+            data = yield httpclient.soapRequest(self.url, 'action', 'payload%i' % i, ctx_factory=client_factory)
+            self.failUnlessEqual(data, 'reply:payload%i' % i)
+
+        self.failUnlessEqual(self.handshakes(), (3, 2))
+        self.failUnlessEqual(client_factory.connections.keys(), [ ('localhost', self.iport.getHost().port) ])
+
+
+    @defer.inlineCallbacks
+    def testNoSessionResumption(self):
+
+        client_factory = ctxfactory.RequestContextFactory(self.cert_dir, True, resume_sessions=False)
+
+        for i in range(3):
+            yield httpclient.soapRequest(self.url, 'action', 'payload%i' % i, ctx_factory=client_factory)
+
+        self.failUnlessEqual(self.handshakes(), (3, 0))
+
+
+    @defer.inlineCallbacks
+    def testNoSessionOnFailedVerification(self):
+
+        empty_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, empty_dir)
+        client_factory = ctxfactory.RequestContextFactory(empty_dir, True)
+
+        try:
+            yield httpclient.soapRequest(self.url, 'action', 'payload', ctx_factory=client_factory)
+            self.fail('Should have failed certificate verification')
+        except SSL.Error:
+            pass
+
+        self.failUnlessEqual(client_factory.connections, {})
@@ -0,0 +1,87 @@
+from twisted.trial import unittest
+from twisted.internet import task
+
+from opennsa.shared import identitycache
+
+
+
+class Obj:
+    def __init__(self, state='idle'):
+        self.state = state
+
+
+
+class IdentityCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = identitycache.IdentityCache(max_size=3, ttl=600, grace=10,
+                                                 in_flight=lambda o : o.state == 'busy', final=lambda o : o.state == 'done', clock=self.clock)
+
+
+    def testIdentity(self):
+
+        o1 = Obj()
+        self.failUnlessIdentical(self.cache.add('c1', o1), o1)
+        self.failUnlessIdentical(self.cache.get('c1'), o1)
+
+        # concurrent load of the same object, the first one wins
+        self.failUnlessIdentical(self.cache.add('c1', Obj()), o1)
+        self.failUnlessEqual(self.cache.get('c2'), None)
+
+        stats = self.cache.stats()
+        self.failUnlessEqual( (stats['size'], stats['hits'], stats['misses']), (1, 1, 1) )
+        self.failUnlessEqual(stats['hit_rate'], 0.5)
+
+
+    def testSizeLimit(self):
+
+        objs = [ Obj() for _ in range(5) ]
+        for i, o in enumerate(objs):
+            self.cache.add(i, o)
+
+        # nothing is evicted within the grace period
+        self.failUnlessEqual(len(self.cache), 5)
+
+        self.clock.advance(20)
+        self.cache.get(0) # recently used
+        self.cache.add(5, Obj())
+        self.failUnlessEqual(sorted(self.cache.entries.keys()), [0, 4, 5])
+        self.failUnlessEqual(self.cache.evictions, 3)
+
+
+    def testInFlightNeverEvicted(self):
+
+        busy = Obj('busy')
+        self.cache.add('busy', busy)
+        for i in range(5):
+            self.cache.add(i, Obj())
+
+        self.clock.advance(1000) # past ttl
+        self.cache.add('new', Obj())
+        self.failUnlessEqual(sorted(self.cache.entries.keys()), ['busy', 'new'])
+        self.failUnlessIdentical(self.cache.get('busy'), busy)
+
+        busy.state = 'idle'
+        self.clock.advance(1000)
+        self.cache.evict()
+        self.failIf('busy' in self.cache)
+
+
+    def testFinalEvicted(self):
+
+        done = Obj()
+        self.cache.add('done', done)
+        self.cache.add('other', Obj())
+        self.cache.add('recent', Obj())
+
+        done.state = 'done'
+        self.clock.advance(20)
+        self.cache.get('done') # final entries go after the grace period, even when recently used
+        self.cache.get('recent')
+        self.clock.advance(20)
+        self.cache.get('recent')
+        self.cache.evict()
+
+        self.failUnlessEqual(sorted(self.cache.entries.keys()), ['other', 'recent'])
+
@@ -0,0 +1,65 @@
+import random
+
+from twisted.trial import unittest
+
+from opennsa.backends.common import intervaltree
+
+
+
+class IntervalTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = intervaltree.IntervalTree()
+
+
+    def testBasicOverlap(self):
+
+        self.tree.insert(10, 20)
+
+        self.failUnless( self.tree.overlaps(15, 16) )
+        self.failUnless( self.tree.overlaps(5, 10) ) # closed intervals
+        self.failUnless( self.tree.overlaps(20, 25) )
+        self.failIf( self.tree.overlaps(0, 9) )
+        self.failIf( self.tree.overlaps(21, 30) )
+
+
+    def testDuplicateIntervals(self):
+
+        self.tree.insert(10, 20)
+        self.tree.insert(10, 20)
+        self.failUnlessEqual(len(self.tree), 2)
+
+        self.tree.remove(10, 20)
+        self.failUnless( self.tree.overlaps(10, 20) )
+
+        self.tree.remove(10, 20)
+        self.failIf( self.tree.overlaps(10, 20) )
+
+        self.failUnlessRaises(KeyError, self.tree.remove, 10, 20)
+
+
+    def testRandomAgainstLinearScan(self):
+
+        rng = random.Random(4711)
+        intervals = []
+
+        for _ in range(500):
+            start = rng.randint(0, 1000)
+            end = start + rng.randint(0, 50)
+            value = rng.randint(0, 3)
+            intervals.append( (start, end, value) )
+            self.tree.insert(start, end, value)
+
+        for start, end, value in intervals[::3]:
+            intervals.remove( (start, end, value) )
+            self.tree.remove(start, end, value)
+
+        self.failUnlessEqual(list(self.tree), sorted(intervals))
+
+        for _ in range(300):
+            start = rng.randint(0, 1050)
+            end = start + rng.randint(0, 20)
+            expected = sorted( [ (s,e,v) for s,e,v in intervals if s <= end and e >= start ] )
+            self.failUnlessEqual(self.tree.findOverlapping(start, end), expected)
+            self.failUnlessEqual(self.tree.overlaps(start, end), len(expected) > 0)
+
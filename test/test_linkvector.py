@@ -1,4 +1,5 @@
 from twisted.trial import unittest
+from twisted.internet import task
 
 from opennsa.topology import linkvector
 
@@ -74,3 +75,88 @@ class LinkVectorTest(unittest.TestCase):
         self.failUnlessEqual( self.rv.vector(CURACAO_TOPO), None)
 
 
+    def testMultiplePaths(self):
+
+        self.rv.updateVector(ARUBA_PORT,    { ARUBA_TOPO : 1, CURACAO_TOPO : 3 } )
+        self.rv.updateVector(BONAIRE_PORT,  { BONAIRE_TOPO : 1, CURACAO_TOPO : 2 } )
+        self.rv.updateVector(DOMINICA_PORT, { CURACAO_TOPO : 4 } )
+
+        self.failUnlessEqual( self.rv.vectors(CURACAO_TOPO),    [ BONAIRE_PORT, ARUBA_PORT, DOMINICA_PORT ] )
+        self.failUnlessEqual( self.rv.vectors(CURACAO_TOPO, 2), [ BONAIRE_PORT, ARUBA_PORT ] )
+        self.failUnlessEqual( self.rv.vectors(ARUBA_TOPO),      [ ARUBA_PORT ] )
+        self.failUnlessEqual( self.rv.vectors(DOMINCA_TOPO),    [] )
+        self.failUnlessEqual( self.rv.vector(CURACAO_TOPO), BONAIRE_PORT)
+
+
+    def testMaxPaths(self):
+
+        self.rv = linkvector.LinkVector( [ LOCAL_TOPO ], max_paths=2 )
+
+        self.rv.updateVector(ARUBA_PORT,    { CURACAO_TOPO : 1 } )
+        self.rv.updateVector(BONAIRE_PORT,  { CURACAO_TOPO : 2 } )
+        self.rv.updateVector(CURACAO_PORT,  { CURACAO_TOPO : 3 } )
+        self.rv.updateVector(DOMINICA_PORT, { CURACAO_TOPO : 2 } )
+
+        # ports with the same cost as the last kept one are kept as well
+        self.failUnlessEqual( self.rv.vectors(CURACAO_TOPO)[0], ARUBA_PORT)
+        self.failUnlessEqual( sorted(self.rv.vectors(CURACAO_TOPO)[1:]), [ BONAIRE_PORT, DOMINICA_PORT ] )
+
+
+    def testLoadTieBreaking(self):
+
+        self.rv.updateVector(ARUBA_PORT,    { CURACAO_TOPO : 2 } )
+        self.rv.updateVector(BONAIRE_PORT,  { CURACAO_TOPO : 2 } )
+        self.rv.updateVector(DOMINICA_PORT, { CURACAO_TOPO : 1 } )
+
+        self.rv.addPortLoad(ARUBA_PORT, 2)
+        self.rv.addPortLoad(DOMINICA_PORT, 5)
+        self.failUnlessEqual( self.rv.vectors(CURACAO_TOPO), [ DOMINICA_PORT, BONAIRE_PORT, ARUBA_PORT ] ) # cost first
+
+        self.rv.addPortLoad(ARUBA_PORT, -2)
+        self.rv.addPortLoad(BONAIRE_PORT, 1)
+        self.failUnlessEqual( self.rv.vectors(CURACAO_TOPO), [ DOMINICA_PORT, ARUBA_PORT, BONAIRE_PORT ] )
+
+        self.rv.addPortLoad(ARUBA_PORT, -1)
+        self.failUnlessEqual( self.rv.portLoad(ARUBA_PORT), 0)
+
+
+    def testDeleteVector(self):
+
+        self.rv.updateVector(ARUBA_PORT,    { CURACAO_TOPO : 2, DOMINCA_TOPO : 3 } )
+        self.rv.updateVector(BONAIRE_PORT,  { CURACAO_TOPO : 1 } )
+
+        self.rv.deleteVector(BONAIRE_PORT)
+        self.failUnlessEqual( self.rv.vectors(CURACAO_TOPO), [ ARUBA_PORT ] )
+
+        self.rv.deleteVector(ARUBA_PORT)
+        self.failUnlessEqual( self.rv.vector(CURACAO_TOPO), None)
+        self.failUnlessEquals( self.rv.listVectors(), {} )
+
+
+    def testCoalescedNotifications(self):
+
+        clock = task.Clock()
+        self.rv = linkvector.LinkVector( [ LOCAL_TOPO ], notify_delay=2, clock=clock )
+
+        updates = []
+        self.rv.callOnUpdate( lambda : updates.append(True) )
+
+        # a fetch cycle
+        self.rv.updateVector(ARUBA_PORT,   { ARUBA_TOPO : 1, CURACAO_TOPO : 3 } )
+        self.rv.updateVector(BONAIRE_PORT, { BONAIRE_TOPO : 1, CURACAO_TOPO : 2 } )
+        self.failUnlessEqual( self.rv.vector(CURACAO_TOPO), BONAIRE_PORT) # updated right away
+
+        self.failUnlessEqual(len(updates), 0)
+        clock.advance(2)
+        self.failUnlessEqual(len(updates), 1)
+
+        # same vectors again, nothing changed
+        self.rv.updateVector(ARUBA_PORT,   { ARUBA_TOPO : 1, CURACAO_TOPO : 3 } )
+        self.rv.updateVector(BONAIRE_PORT, { BONAIRE_TOPO : 1 } )
+        self.failIf(clock.getDelayedCalls())
+
+        self.rv.updateVector(BONAIRE_PORT, { CURACAO_TOPO : 4 } )
+        self.failUnlessEqual( self.rv.vector(CURACAO_TOPO), ARUBA_PORT)
+        clock.advance(2)
+        self.failUnlessEqual(len(updates), 2)
+
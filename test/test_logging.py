@@ -0,0 +1,63 @@
+import StringIO
+
+from twisted.trial import unittest
+from twisted.python import log
+
+from opennsa import logging
+
+
+
+class CountingStr:
+    # counts how many times it is formatted
+
+    def __init__(self):
+        self.count = 0
+
+    def __str__(self):
+        self.count += 1
+        return 'value'
+
+
+
+class LoggingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log_file = StringIO.StringIO()
+        self.observer = logging.DebugLogObserver(self.log_file, debug=True, payload=False)
+        log.addObserver(self.observer.emit)
+
+
+    def tearDown(self):
+        log.removeObserver(self.observer.emit)
+        logging.setEnabled()
+
+
+    def testSkipFormatting(self):
+
+        value = CountingStr()
+
+        logging.payload('Payload: %s', value, system='Test')
+        self.failUnlessEqual(value.count, 0)
+        self.failIfIn('Payload', self.log_file.getvalue())
+
+        logging.debug('Debug: %s', value, system='Test')
+        self.failUnlessEqual(value.count, 1)
+        self.failUnlessIn('[Test] Debug: value', self.log_file.getvalue())
+
+
+    def testNoArguments(self):
+
+        logging.debug('100% done', system='Test')
+        self.failUnlessIn('100% done', self.log_file.getvalue())
+
+
+    def testQuietNamespaces(self):
+
+        from twisted.web import client
+        factory = client._HTTP11ClientFactory(None, None)
+        factory.doStart()
+        factory.doStop()
+        self.failIfIn('factory', self.log_file.getvalue())
+
+        logging.debug('Not quiet', system='Test')
+        self.failUnlessIn('Not quiet', self.log_file.getvalue())
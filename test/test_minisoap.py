@@ -0,0 +1,137 @@
+import StringIO
+
+from twisted.trial import unittest
+from twisted.python import failure
+from twisted.internet import error
+from twisted.web import resource
+from twisted.test import proto_helpers
+
+from opennsa.protocols.shared import minisoap, soapresource
+
+
+PAYLOAD = '''<?xml version="1.0" encoding="UTF-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+    <soap:Header><header>h</header></soap:Header>
+    <soap:Body><body><value>v</value></body></soap:Body>
+</soap:Envelope>
+'''
+
+ENTITY_PAYLOAD = '''<?xml version="1.0"?>
+<!DOCTYPE lolz [
+ <!ENTITY lol "lol">
+ <!ENTITY lol1 "&lol;&lol;&lol;&lol;&lol;&lol;&lol;&lol;&lol;&lol;">
+]>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+    <soap:Body><body>&lol1;</body></soap:Body>
+</soap:Envelope>
+'''
+
+
+
+class CountingReader(StringIO.StringIO):
+    # counts how much has been read
+
+    def __init__(self, data):
+        StringIO.StringIO.__init__(self, data)
+        self.count = 0
+
+    def read(self, size=-1):
+        data = StringIO.StringIO.read(self, size)
+        self.count += len(data)
+        return data
+
+
+
+class ParseTest(unittest.TestCase):
+
+    def testParse(self):
+
+        for payload in (PAYLOAD, StringIO.StringIO(PAYLOAD)):
+            headers, bodies = minisoap.parseSoapPayload(payload)
+            self.failUnlessEqual( [ h.tag for h in headers ], [ 'header' ])
+            self.failUnlessEqual( [ b.tag for b in bodies ], [ 'body' ])
+            self.failUnlessEqual(bodies[0].find('value').text, 'v')
+
+
+    def testStopAfterBody(self):
+
+        body_end = PAYLOAD.index('</soap:Body>') + len('</soap:Body>')
+        payload = CountingReader(PAYLOAD[:body_end] + '<padding/>' * 100000)
+        headers, bodies = minisoap.parseSoapPayload(payload)
+        self.failUnlessEqual(len(bodies), 1)
+        self.failUnless(payload.count < 100000)
+
+
+    def testSizeLimit(self):
+
+        self.failUnlessRaises(ValueError, minisoap.parseSoapPayload, PAYLOAD, size_limit=100)
+
+        payload = CountingReader(PAYLOAD.replace('<value>v', '<value>' + 'v' * 1000000))
+        self.failUnlessRaises(ValueError, minisoap.parseSoapPayload, payload, size_limit=1000)
+        # the payload is not read much beyond the limit
+        self.failUnlessEqual(payload.count, 1001)
+
+
+    def testDepthLimit(self):
+
+        nested = '<a>' * 50 + '</a>' * 50
+        payload = PAYLOAD.replace('<value>v</value>', nested)
+        self.failUnlessRaises(ValueError, minisoap.parseSoapPayload, payload, depth_limit=40)
+        minisoap.parseSoapPayload(payload, depth_limit=60)
+
+
+    def testRejectEntities(self):
+
+        self.failUnlessRaises(ValueError, minisoap.parseSoapPayload, ENTITY_PAYLOAD)
+        self.failUnlessRaises(ValueError, minisoap.parseFault, ENTITY_PAYLOAD)
+
+
+
+class SizeLimitedRequestTest(unittest.TestCase):
+
+    def setUp(self):
+        top_resource = resource.Resource()
+        soapresource.setupSOAPResource(top_resource, 'CS2', max_payload_size=1000)
+        soapresource.setupSOAPResource(top_resource, 'RequesterService2')
+        top_resource.putChild('other', resource.Resource())
+
+        self.site = soapresource.SizeLimitedSite(top_resource)
+        self.transport = proto_helpers.StringTransport()
+        self.channel = self.site.buildProtocol(None)
+        self.channel.makeConnection(self.transport)
+
+
+    def tearDown(self):
+        self.channel.connectionLost(failure.Failure(error.ConnectionDone()))
+
+
+    def testRejectContentLength(self):
+
+        self.channel.dataReceived('POST /NSI/services/CS2 HTTP/1.1\r\nHost: localhost\r\nContent-Length: 100000\r\n\r\n')
+        # rejected when the headers are received, before any content
+        self.failUnless(self.transport.value().startswith('HTTP/1.1 413'))
+        self.failUnless(self.transport.disconnecting)
+
+
+    def testRejectChunked(self):
+
+        self.channel.dataReceived('POST /NSI/services/CS2 HTTP/1.1\r\nHost: localhost\r\nTransfer-Encoding: chunked\r\n\r\n')
+        self.failUnlessEqual(self.transport.value(), '')
+
+        chunk = 'x' * 600
+        self.channel.dataReceived('%x\r\n%s\r\n' % (len(chunk), chunk))
+        self.failUnlessEqual(self.transport.value(), '')
+        self.channel.dataReceived('%x\r\n%s\r\n' % (len(chunk), chunk))
+        self.failUnless(self.transport.value().startswith('HTTP/1.1 413'))
+        self.failUnless(self.transport.disconnecting)
+
+
+    def testNotLimited(self):
+
+        # soap resources without limit (requester) and other resources are not limited
+        for path in ('/NSI/services/RequesterService2', '/other', '/NSI/services/CS2x'):
+            self.channel.dataReceived('POST %s HTTP/1.1\r\nHost: localhost\r\nContent-Length: 2000\r\n\r\n' % path)
+            self.channel.dataReceived('x' * 2000)
+            self.failIf(self.transport.value().startswith('HTTP/1.1 413'), path)
+            self.failIf(self.transport.disconnecting, path)
+            self.transport.clear()
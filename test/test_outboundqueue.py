@@ -0,0 +1,204 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task, error
+from twisted.web.error import Error as WebError
+
+from twistar.registry import Registry
+
+from opennsa import database
+from opennsa.protocols.nsi2 import providerclient
+from opennsa.protocols.nsi2.bindings import actions
+from opennsa.protocols.shared import minisoap, outboundqueue
+
+from . import db
+
+
+
+class FakeSender:
+    # records the messages sent, each delivery is completed by the test
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, destination, action, payload):
+        d = defer.Deferred()
+        self.calls.append( (destination, payload, d) )
+        return d
+
+    def payloads(self):
+        return [ payload for _, payload, _ in self.calls ]
+
+    def complete(self, payload, result=None):
+        for i, (_, p, d) in enumerate(self.calls):
+            if p == payload:
+                self.calls.pop(i)
+                if isinstance(result, Exception):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+                return
+        raise AssertionError('No call with payload %s' % payload)
+
+
+
+class OutboundQueueTest(unittest.TestCase):
+
+    url1 = 'http://requester1.example.org/NSI/services/RequesterService2'
+    url2 = 'http://requester2.example.org/NSI/services/RequesterService2'
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        db.setupDatabase()
+        yield database.OutboundMessage.deleteAll()
+
+        self.clock = task.Clock()
+        self.clock.advance(1500000000)
+        self.sender = FakeSender()
+        self.queue = self.createQueue()
+
+
+    def createQueue(self, **kwargs):
+        return outboundqueue.OutboundQueue(initial_backoff=2, max_backoff=10, message_ttl=60, sender=self.sender, clock=self.clock, **kwargs)
+
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.queue.stopService()
+        yield database.OutboundMessage.deleteAll()
+        Registry.DBPOOL.close()
+
+
+    @defer.inlineCallbacks
+    def testOrderPerConnection(self):
+
+        yield self.queue.enqueue(self.url1, 'action', 'c1-m1', 'c1')
+        yield self.queue.enqueue(self.url1, 'action', 'c1-m2', 'c1')
+        yield self.queue.enqueue(self.url1, 'action', 'c2-m1', 'c2')
+
+        # second message for c1 waits for the first
+        self.failUnlessEqual(self.sender.payloads(), [ 'c1-m1', 'c2-m1' ])
+
+        self.sender.complete('c1-m1')
+        self.failUnlessEqual(self.sender.payloads(), [ 'c2-m1', 'c1-m2' ])
+
+        self.sender.complete('c2-m1')
+        self.sender.complete('c1-m2')
+        self.failUnlessEqual(self.queue.stats()['queued'], 0)
+        self.failUnlessEqual(self.queue.stats()['delivered'], 3)
+
+        yield self.queue.stopService()
+        messages = yield database.OutboundMessage.find()
+        self.failUnlessEqual(messages, [])
+
+
+    @defer.inlineCallbacks
+    def testRetryBackoff(self):
+
+        yield self.queue.enqueue(self.url1, 'action', 'c1-m1', 'c1')
+        yield self.queue.enqueue(self.url1, 'action', 'c1-m2', 'c1')
+
+        self.sender.complete('c1-m1', error.ConnectionRefusedError())
+        self.failUnlessEqual(self.sender.payloads(), [])
+
+        self.clock.advance(2)
+        self.failUnlessEqual(self.sender.payloads(), [ 'c1-m1' ])
+        self.sender.complete('c1-m1', error.ConnectionRefusedError())
+
+        # backoff is doubled
+        self.clock.advance(2)
+        self.failUnlessEqual(self.sender.payloads(), [])
+        self.clock.advance(2)
+        self.failUnlessEqual(self.sender.payloads(), [ 'c1-m1' ])
+
+        self.sender.complete('c1-m1')
+        self.failUnlessEqual(self.sender.payloads(), [ 'c1-m2' ])
+        self.sender.complete('c1-m2')
+
+        stats = self.queue.stats()
+        self.failUnlessEqual( (stats['delivered'], stats['retries']), (2, 2) )
+        # first message took 6 seconds (5-30 bucket), the second was sent at the same time
+        self.failUnlessEqual(dict(stats['latency'])[30], 2)
+
+
+    @defer.inlineCallbacks
+    def testErrorReplies(self):
+
+        yield self.queue.enqueue(self.url1, 'action', 'c1-m1', 'c1')
+        yield self.queue.enqueue(self.url1, 'action', 'c1-m2', 'c1')
+
+        # bad gateway / unavailable from a proxy, or an error page, are retried
+        self.sender.complete('c1-m1', WebError('503', 'Service Unavailable', 'down for maintenance'))
+        self.clock.advance(2)
+        self.sender.complete('c1-m1', WebError('500', 'Internal Server Error', '<html>oops</html>'))
+        self.clock.advance(4)
+        self.failUnlessEqual(self.sender.payloads(), [ 'c1-m1' ])
+
+        # a soap fault is final
+        fault = minisoap.createSoapFault('Unknown connection')
+        self.sender.complete('c1-m1', WebError('500', 'Internal Server Error', fault))
+        self.failUnlessEqual(self.sender.payloads(), [ 'c1-m2' ])
+
+        stats = self.queue.stats()
+        self.failUnlessEqual( (stats['delivered'], stats['retries']), (1, 2) )
+
+
+    @defer.inlineCallbacks
+    def testInFlightLimit(self):
+
+        self.queue.max_in_flight = 2
+
+        for c in ('c1', 'c2', 'c3'):
+            yield self.queue.enqueue(self.url1, 'action', c, c)
+        yield self.queue.enqueue(self.url2, 'action', 'other', 'c4')
+
+        # limit is per destination
+        self.failUnlessEqual(self.sender.payloads(), [ 'c1', 'c2', 'other' ])
+
+        self.sender.complete('c2')
+        self.failUnlessEqual(self.sender.payloads(), [ 'c1', 'other', 'c3' ])
+
+
+    @defer.inlineCallbacks
+    def testExpiry(self):
+
+        pc = providerclient.ProviderClient(outbound_queue=self.queue)
+
+        yield pc.provisionConfirmed(self.url1, 'urn:uuid:corr', 'urn:ogf:network:requester:nsa', 'urn:ogf:network:provider:nsa', 'conn-1')
+        self.failUnlessEqual(len(self.sender.calls), 1)
+
+        # keeps failing until the message expires
+        for i in range(10):
+            if not self.sender.calls:
+                break
+            self.sender.calls[0][2].errback(error.ConnectionRefusedError())
+            self.sender.calls.pop(0)
+            self.clock.advance(10)
+
+        yield self.queue.stopService() # wait for the message deletes
+        self.failUnlessEqual(self.queue.stats()['expired'], 1)
+
+        # message delivery timeout for the expired message is queued
+        messages = yield database.OutboundMessage.find()
+        self.failUnlessEqual(len(messages), 1)
+        self.failUnlessEqual(messages[0].action, actions.MESSAGE_DELIVERY_TIMEOUT)
+        self.failUnlessEqual(messages[0].connection_id, 'conn-1')
+        self.failUnlessIn('urn:uuid:corr', messages[0].payload)
+
+
+    @defer.inlineCallbacks
+    def testRestart(self):
+
+        yield self.queue.enqueue(self.url1, 'action', 'c1-m1', 'c1')
+        yield self.queue.enqueue(self.url1, 'action', 'c1-m2', 'c1')
+        yield self.queue.enqueue(self.url2, 'action', 'c2-m1', 'c2')
+
+        self.sender.complete('c2-m1')
+        yield self.queue.stopService()
+
+        # undelivered messages are sent again by a new queue, in order
+        self.sender.calls = []
+        self.queue = self.createQueue()
+        yield self.queue.startService()
+
+        self.failUnlessEqual(self.sender.payloads(), [ 'c1-m1' ])
+        self.sender.complete('c1-m1')
+        self.failUnlessEqual(self.sender.payloads(), [ 'c1-m2' ])
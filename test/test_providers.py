@@ -4,9 +4,10 @@ import StringIO
 from twisted.trial import unittest
 from twisted.internet import reactor, defer, task
 
-from opennsa import nsa, provreg, database, error, setup, aggregator, config, plugin, constants as cnt
+from opennsa import nsa, provreg, database, error, setup, aggregator, config, plugin, state, constants as cnt
 from opennsa.topology import nrm
 from opennsa.backends import dud
+from opennsa.protocols.shared import httpclient, outboundqueue
 
 from . import topology, common, db
 
@@ -349,7 +350,7 @@ class GenericProviderTest:
         header, reservations = yield self.requester.query_summary_defer
 
         self.failUnlessEquals(len(reservations), 1)
-        ci = reservations[0]
+        ci = list(reservations)[0]
 
         self.failUnlessEquals(ci.connection_id, acid)
         self.failUnlessEquals(ci.global_reservation_id, 'gid-123')
@@ -834,6 +835,199 @@ class DUDBackendTest(GenericProviderTest, unittest.TestCase):
     testHairpinConnection.skip = 'Tested in aggregator'
 
 
+    @defer.inlineCallbacks
+    def testInsufficientBandwidth(self):
+
+        # dom port has a capacity of 500
+        source_stp  = nsa.STP(self.network, self.source_port, nsa.Label(cnt.ETHERNET_VLAN, '1781-1783') )
+        dest_stp    = nsa.STP(self.network, 'dom',            nsa.Label(cnt.ETHERNET_VLAN, '1781-1783') )
+
+        criteria    = nsa.Criteria(0, self.schedule, nsa.Point2PointService(source_stp, dest_stp, 600, cnt.BIDIRECTIONAL, False, None) )
+        try:
+            yield self.provider.reserve(self.header, None, None, None, criteria)
+            self.fail('Should have raised BandwidthUnavailableError')
+        except error.BandwidthUnavailableError:
+            pass # expected
+
+        criteria    = nsa.Criteria(0, self.schedule, nsa.Point2PointService(source_stp, dest_stp, 300, cnt.BIDIRECTIONAL, False, None) )
+        yield self.provider.reserve(self.header, None, None, None, criteria)
+        yield self.requester.reserve_defer
+
+        # vlans are available, but bandwidth is not
+        self.requester.reserve_defer = defer.Deferred()
+        try:
+            yield self.provider.reserve(self.header, None, None, None, criteria)
+            self.fail('Should have raised BandwidthUnavailableError')
+        except error.BandwidthUnavailableError:
+            pass # expected
+
+        # after the first reservation has ended, the bandwidth is available again
+        schedule    = nsa.Schedule(self.end_time, self.end_time + datetime.timedelta(seconds=120))
+        criteria    = nsa.Criteria(0, schedule, nsa.Point2PointService(source_stp, dest_stp, 300, cnt.BIDIRECTIONAL, False, None) )
+        yield self.provider.reserve(self.header, None, None, None, criteria)
+
+
+    @defer.inlineCallbacks
+    def testLabelAllocationStrategy(self):
+
+        from opennsa.backends.common import genericbackend, allocation
+
+        self.backend.label_allocation = allocation.LastFit()
+
+        source_stp  = nsa.STP(self.network, self.source_port, nsa.Label(cnt.ETHERNET_VLAN, '1781-1789') )
+        dest_stp    = nsa.STP(self.network, self.dest_port,   nsa.Label(cnt.ETHERNET_VLAN, '1781-1789') )
+        criteria    = nsa.Criteria(0, self.schedule, nsa.Point2PointService(source_stp, dest_stp, 100, cnt.BIDIRECTIONAL, False, None) )
+
+        labels = []
+        for _ in range(2):
+            self.requester.reserve_defer = defer.Deferred()
+            connection_id = yield self.provider.reserve(self.header, None, None, None, criteria)
+            yield self.requester.reserve_defer
+            conn = yield genericbackend.GenericBackendConnections.find(where=['connection_id = ?', connection_id], limit=1)
+            labels.append( (conn.source_label.labelValue(), conn.dest_label.labelValue()) )
+
+        self.failUnlessEqual(labels, [ ('1789', '1789'), ('1788', '1788') ])
+
+
+    @defer.inlineCallbacks
+    def testRestoreSchedule(self):
+
+        from opennsa.backends.common import genericbackend
+
+        source_stp  = nsa.STP(self.network, self.source_port, nsa.Label(cnt.ETHERNET_VLAN, '1781-1789') )
+        dest_stp    = nsa.STP(self.network, self.dest_port,   nsa.Label(cnt.ETHERNET_VLAN, '1781-1789') )
+        criteria    = nsa.Criteria(0, self.schedule, nsa.Point2PointService(source_stp, dest_stp, 100, cnt.BIDIRECTIONAL, False, None) )
+
+        for _ in range(5):
+            self.header.newCorrelationId()
+            cid = yield self.provider.reserve(self.header, None, None, None, criteria)
+            yield self.requester.reserve_defer
+            yield self.provider.reserveCommit(self.header, cid)
+            yield self.requester.reserve_commit_defer
+            self.requester.reserve_defer        = defer.Deferred()
+            self.requester.reserve_commit_defer = defer.Deferred()
+
+        # restore in a new backend, reading a few connections at a time
+        self.patch(genericbackend.GenericBackend, 'RESTORE_CHUNK_SIZE', 2)
+        nrm_ports = nrm.parsePortSpec(StringIO.StringIO(topology.ARUBA_TOPOLOGY))
+        backend = dud.DUDNSIBackend(self.network, nrm_ports, self.requester, {})
+        backend.scheduler.clock = self.clock
+        yield backend.restore_defer
+
+        self.failUnlessEqual(len(backend.calendar.reservations), 10)
+        self.failUnlessEqual(backend.capacity_calendar.peakUsage(self.source_port, self.start_time, self.end_time), 500)
+        yield backend.stopService()
+
+
+    @defer.inlineCallbacks
+    def testSnapshotRestore(self):
+
+        import os
+        from opennsa.backends.common import genericbackend
+
+        snapshot_file = self.mktemp()
+        self.patch(genericbackend.GenericBackend, 'snapshot_file', snapshot_file)
+
+        source_stp  = nsa.STP(self.network, self.source_port, nsa.Label(cnt.ETHERNET_VLAN, '1781-1789') )
+        dest_stp    = nsa.STP(self.network, self.dest_port,   nsa.Label(cnt.ETHERNET_VLAN, '1781-1789') )
+        criteria    = nsa.Criteria(0, self.schedule, nsa.Point2PointService(source_stp, dest_stp, 100, cnt.BIDIRECTIONAL, False, None) )
+
+        @defer.inlineCallbacks
+        def reserveAndCommit():
+            self.header.newCorrelationId()
+            cid = yield self.provider.reserve(self.header, None, None, None, criteria)
+            yield self.requester.reserve_defer
+            yield self.provider.reserveCommit(self.header, cid)
+            yield self.requester.reserve_commit_defer
+            self.requester.reserve_defer        = defer.Deferred()
+            self.requester.reserve_commit_defer = defer.Deferred()
+            defer.returnValue(cid)
+
+        cids = []
+        for _ in range(3):
+            cid = yield reserveAndCommit()
+            cids.append(cid)
+
+        yield self.provider.stopService()
+        self.failUnless(os.path.exists(snapshot_file))
+
+        # connection created after the snapshot, must be loaded from the database
+        cid = yield reserveAndCommit()
+        cids.append(cid)
+        # connection changed after the snapshot, its reservations must be removed
+        from twistar.registry import Registry
+        yield Registry.DBPOOL.runOperation('UPDATE generic_backend_connections SET lifecycle_state = %s WHERE connection_id = %s', (state.TERMINATED, cids[0]))
+
+        nrm_ports = nrm.parsePortSpec(StringIO.StringIO(topology.ARUBA_TOPOLOGY))
+        backend = dud.DUDNSIBackend(self.network, nrm_ports, self.requester, {})
+        backend.scheduler.clock = self.clock
+        yield backend.restore_defer
+
+        self.failIf(os.path.exists(snapshot_file)) # snapshots are only used once
+        self.failUnlessEqual(len(backend.calendar.reservations), 6)
+        pending = [ (connection_id, call.__name__) for connection_id, _, call, _ in backend.scheduler.pendingCalls() ]
+        self.failUnlessEqual(sorted(pending), sorted( [ (cid, '_doEndtime') for cid in cids[1:] ] ))
+        yield backend.stopService()
+
+        # corrupt snapshot, full restore
+        with open(snapshot_file, 'r+b') as f:
+            f.seek(-4, os.SEEK_END)
+            f.write('XXXX')
+
+        backend = dud.DUDNSIBackend(self.network, nrm_ports, self.requester, {})
+        backend.scheduler.clock = self.clock
+        yield backend.restore_defer
+
+        self.failUnlessEqual(len(backend.calendar.reservations), 6)
+        yield backend.stopService()
+
+        # connection removed from the database since the snapshot, it cannot be used
+        yield Registry.DBPOOL.runOperation('DELETE FROM generic_backend_connections WHERE connection_id = %s', (cids[0],))
+        result = yield backend._readSnapshot()
+        self.failUnlessEqual(result, None)
+        self.failUnlessEqual(backend.calendar.reservations, {})
+
+
+
+class RemoteDUDProvider:
+    # acks and confirms reservations, or fails them, used as provider for the networks behind the demarc ports
+    # with fail_async the reservations are acked, and failed right away, or when failHeld is called if hold is set
+
+    def __init__(self, fail=False, fail_async=False, hold=False):
+        self.fail = fail
+        self.fail_async = fail_async
+        self.hold = hold
+        self.parent_requester = None
+        self.reservations = []
+        self.terminations = []
+        self.held = []
+
+    def reserve(self, header, connection_id, global_reservation_id, description, criteria, request_info=None):
+        self.reservations.append(criteria.service_def)
+        if self.fail:
+            return defer.fail( error.STPUnavailableError('Remote port unavailable') )
+        connection_id = 'remote-%i' % len(self.reservations)
+        if self.hold:
+            self.held.append( (header, connection_id) )
+        elif self.fail_async:
+            reactor.callLater(0, self.parent_requester.reserveFailed, header, connection_id, None, error.STPUnavailableError('Remote port unavailable'))
+        else:
+            reactor.callLater(0, self.parent_requester.reserveConfirmed, header, connection_id, global_reservation_id, description, criteria)
+        return defer.succeed(connection_id)
+
+    def failHeld(self):
+        held, self.held = self.held, []
+        defs = [ self.parent_requester.reserveFailed(header, connection_id, None, error.STPUnavailableError('Remote port unavailable')) for header, connection_id in held ]
+        return defer.DeferredList(defs, fireOnOneErrback=True)
+
+    def reserveAbort(self, header, connection_id, request_info=None):
+        return defer.succeed(connection_id)
+
+    def terminate(self, header, connection_id, request_info=None):
+        self.terminations.append(connection_id)
+        return defer.succeed(connection_id)
+
+
 
 class AggregatorTest(GenericProviderTest, unittest.TestCase):
 
@@ -905,6 +1099,328 @@ class AggregatorTest(GenericProviderTest, unittest.TestCase):
             self.fail('Should not have raised exception: %s' % str(e))
 
 
+    @defer.inlineCallbacks
+    def testPathFallback(self):
+
+        # curacao can be reached through both bonaire (cheapest) and dominica
+        self.provider.route_vectors.updateVector('bon', { 'curacao:topology' : 2 } )
+        self.provider.route_vectors.updateVector('dom', { 'curacao:topology' : 3 } )
+
+        bonaire  = RemoteDUDProvider(fail=True)
+        dominica = RemoteDUDProvider()
+        for network, provider in ( ('bonaire', bonaire), ('dominica', dominica) ):
+            provider.parent_requester = self.provider
+            self.provider.provider_registry.addProvider('urn:ogf:network:%s:nsa' % network, provider, [ network ] )
+
+        dest_stp = nsa.STP('curacao:topology', 'ps', nsa.Label(cnt.ETHERNET_VLAN, '1782') )
+        sd = nsa.Point2PointService(self.source_stp, dest_stp, self.bandwidth, cnt.BIDIRECTIONAL, False, None)
+        criteria = nsa.Criteria(0, self.schedule, sd)
+
+        self.header.newCorrelationId()
+        acid = yield self.provider.reserve(self.header, None, None, None, criteria)
+        yield self.requester.reserve_defer
+
+        self.failUnlessEqual(len(bonaire.reservations), 1)
+        self.failUnlessEqual(len(dominica.reservations), 1)
+        self.failUnlessEqual(dominica.reservations[0].source_stp.network, 'dominica')
+
+        conn = yield self.provider.getConnection(acid)
+        self.failUnlessEqual(conn.reservation_state, state.RESERVE_HELD)
+
+        sub_conns = yield self.provider.getSubConnectionsByConnectionKey(conn.id)
+        self.failUnlessEqual( [ sc.dest_port for sc in sub_conns ], [ 'dom', 'ps' ])
+        self.failUnlessEqual(conn.sub_connection_count, 2)
+
+        # connection is counted in the load of the port
+        self.failUnlessEqual(self.provider.route_vectors.portLoad('dom'), 1)
+        self.failUnlessEqual(self.provider.route_vectors.portLoad('bon'), 0)
+
+
+    @defer.inlineCallbacks
+    def testPathFallbackReserveFailed(self):
+
+        self.provider.route_vectors.updateVector('bon', { 'curacao:topology' : 2 } )
+        self.provider.route_vectors.updateVector('dom', { 'curacao:topology' : 3 } )
+
+        # bonaire acks the reservation, but sends a reserveFailed afterwards
+        bonaire  = RemoteDUDProvider(fail_async=True, hold=True)
+        dominica = RemoteDUDProvider()
+        for network, provider in ( ('bonaire', bonaire), ('dominica', dominica) ):
+            provider.parent_requester = self.provider
+            self.provider.provider_registry.addProvider('urn:ogf:network:%s:nsa' % network, provider, [ network ] )
+
+        dest_stp = nsa.STP('curacao:topology', 'ps', nsa.Label(cnt.ETHERNET_VLAN, '1782') )
+        sd = nsa.Point2PointService(self.source_stp, dest_stp, self.bandwidth, cnt.BIDIRECTIONAL, False, None)
+        criteria = nsa.Criteria(0, self.schedule, sd)
+
+        self.header.newCorrelationId()
+        acid = yield self.provider.reserve(self.header, None, None, None, criteria)
+        self.failUnlessEqual(len(dominica.reservations), 0)
+        self.failUnlessEqual(self.provider.route_vectors.portLoad('bon'), 1)
+
+        yield bonaire.failHeld()
+        yield self.requester.reserve_defer
+
+        self.failUnlessEqual(len(dominica.reservations), 1)
+        self.failUnlessEqual(bonaire.terminations, [ 'remote-1' ])
+
+        conn = yield self.provider.getConnection(acid)
+        self.failUnlessEqual(conn.reservation_state, state.RESERVE_HELD)
+
+        sub_conns = yield self.provider.getSubConnectionsByConnectionKey(conn.id)
+        self.failUnlessEqual( [ sc.dest_port for sc in sub_conns ], [ 'dom', 'ps' ])
+        self.failUnlessEqual(conn.sub_connection_count, 2)
+
+        self.failUnlessEqual(self.provider.route_vectors.portLoad('dom'), 1)
+        self.failUnlessEqual(self.provider.route_vectors.portLoad('bon'), 0)
+        self.failUnlessEqual(self.provider.path_candidates, {})
+
+        # a terminateConfirmed for the abandoned remote sub connection is still expected
+        self.failUnlessIn( ('urn:ogf:network:bonaire:nsa', 'remote-1'), self.provider.abandoned_sub_connections)
+
+
+    @defer.inlineCallbacks
+    def testPathFallbackReserveFailedBeforeAck(self):
+
+        self.provider.route_vectors.updateVector('bon', { 'curacao:topology' : 2 } )
+        self.provider.route_vectors.updateVector('dom', { 'curacao:topology' : 3 } )
+
+        # the reserveFailed from bonaire arrives before the local backend has acked
+        bonaire  = RemoteDUDProvider(fail_async=True)
+        dominica = RemoteDUDProvider()
+        for network, provider in ( ('bonaire', bonaire), ('dominica', dominica) ):
+            provider.parent_requester = self.provider
+            self.provider.provider_registry.addProvider('urn:ogf:network:%s:nsa' % network, provider, [ network ] )
+
+        dest_stp = nsa.STP('curacao:topology', 'ps', nsa.Label(cnt.ETHERNET_VLAN, '1782') )
+        sd = nsa.Point2PointService(self.source_stp, dest_stp, self.bandwidth, cnt.BIDIRECTIONAL, False, None)
+        criteria = nsa.Criteria(0, self.schedule, sd)
+
+        self.header.newCorrelationId()
+        acid = yield self.provider.reserve(self.header, None, None, None, criteria)
+        yield self.requester.reserve_defer
+
+        self.failUnlessEqual(bonaire.terminations, [ 'remote-1' ])
+        conn = yield self.provider.getConnection(acid)
+        sub_conns = yield self.provider.getSubConnectionsByConnectionKey(conn.id)
+        self.failUnlessEqual( [ sc.dest_port for sc in sub_conns ], [ 'dom', 'ps' ])
+        self.failUnlessEqual(self.provider.route_vectors.portLoad('dom'), 1)
+        self.failUnlessEqual(self.provider.route_vectors.portLoad('bon'), 0)
+
+
+    @defer.inlineCallbacks
+    def testPathAbandonedDuringConfirm(self):
+
+        self.provider.route_vectors.updateVector('bon', { 'curacao:topology' : 2 } )
+
+        bonaire = RemoteDUDProvider(hold=True)
+        bonaire.parent_requester = self.provider
+        self.provider.provider_registry.addProvider('urn:ogf:network:bonaire:nsa', bonaire, [ 'bonaire' ] )
+
+        dest_stp = nsa.STP('curacao:topology', 'ps', nsa.Label(cnt.ETHERNET_VLAN, '1782') )
+        sd = nsa.Point2PointService(self.source_stp, dest_stp, self.bandwidth, cnt.BIDIRECTIONAL, False, None)
+        criteria = nsa.Criteria(0, self.schedule, sd)
+
+        self.header.newCorrelationId()
+        acid = yield self.provider.reserve(self.header, None, None, None, criteria)
+        conn = yield self.provider.getConnection(acid)
+
+        # the sub connection from bonaire is stored, but the save does not finish until the path has been abandoned
+        save_defer = defer.Deferred()
+        org_save = database.SubConnection.save
+        def save(sc):
+            d = org_save(sc)
+            if sc.connection_id == 'remote-1':
+                d.addCallback(lambda r : save_defer.addCallback(lambda _ : r))
+            return d
+        self.patch(database.SubConnection, 'save', save)
+
+        b_header, b_connection_id = bonaire.held[0]
+        b_criteria = nsa.Criteria(0, self.schedule, bonaire.reservations[0])
+        d = self.provider.reserveConfirmed(b_header, b_connection_id, None, None, b_criteria)
+
+        # what a reserveFailed for the path does
+        path, results, conn_info = self.provider.path_candidates[conn.id].pop('reserving')
+        yield self.provider._abandonPath(self.header, conn, results, conn_info)
+
+        save_defer.callback(None)
+        yield d
+
+        self.failUnlessEqual(bonaire.terminations, [ 'remote-1' ])
+        sub_conns = yield self.provider.getSubConnectionsByConnectionKey(conn.id)
+        self.failIfIn('remote-1', [ sc.connection_id for sc in sub_conns ])
+        self.failUnlessEqual(conn.sub_connection_count, len(sub_conns))
+        self.failUnlessEqual(self.provider.reservations, {})
+
+
+    @defer.inlineCallbacks
+    def testPathFallbackReserveFailedExhausted(self):
+
+        self.provider.route_vectors.updateVector('bon', { 'curacao:topology' : 2 } )
+        self.provider.route_vectors.updateVector('dom', { 'curacao:topology' : 3 } )
+
+        bonaire  = RemoteDUDProvider(fail_async=True, hold=True)
+        dominica = RemoteDUDProvider(fail_async=True, hold=True)
+        for network, provider in ( ('bonaire', bonaire), ('dominica', dominica) ):
+            provider.parent_requester = self.provider
+            self.provider.provider_registry.addProvider('urn:ogf:network:%s:nsa' % network, provider, [ network ] )
+
+        dest_stp = nsa.STP('curacao:topology', 'ps', nsa.Label(cnt.ETHERNET_VLAN, '1782') )
+        sd = nsa.Point2PointService(self.source_stp, dest_stp, self.bandwidth, cnt.BIDIRECTIONAL, False, None)
+        criteria = nsa.Criteria(0, self.schedule, sd)
+
+        reserve_failed = defer.Deferred()
+        self.requester.reserveFailed = lambda *args : reserve_failed.callback(args)
+
+        self.header.newCorrelationId()
+        acid = yield self.provider.reserve(self.header, None, None, None, criteria)
+        yield bonaire.failHeld()
+        self.failUnlessEqual(len(dominica.reservations), 1)
+        self.failIf(reserve_failed.called)
+
+        # last candidate, the failure goes upwards
+        yield dominica.failHeld()
+        header, connection_id, connection_states, err = yield reserve_failed
+        self.failUnlessEqual(connection_id, acid)
+        self.failUnlessIsInstance(err, error.STPUnavailableError)
+
+        conn = yield self.provider.getConnection(acid)
+        self.failUnlessEqual(conn.reservation_state, state.RESERVE_FAILED)
+        self.failUnlessEqual(self.provider.route_vectors.portLoad('bon'), 0)
+        self.failUnlessEqual(self.provider.route_vectors.portLoad('dom'), 0)
+        self.failUnlessEqual(self.provider.path_candidates, {})
+
+
+    @defer.inlineCallbacks
+    def testPortLoadReleased(self):
+
+        self.provider.route_vectors.updateVector('bon', { 'curacao:topology' : 2 } )
+
+        bonaire = RemoteDUDProvider()
+        bonaire.parent_requester = self.provider
+        self.provider.provider_registry.addProvider('urn:ogf:network:bonaire:nsa', bonaire, [ 'bonaire' ] )
+
+        dest_stp = nsa.STP('curacao:topology', 'ps', nsa.Label(cnt.ETHERNET_VLAN, '1782') )
+        sd = nsa.Point2PointService(self.source_stp, dest_stp, self.bandwidth, cnt.BIDIRECTIONAL, False, None)
+        criteria = nsa.Criteria(0, self.schedule, sd)
+
+        self.header.newCorrelationId()
+        acid = yield self.provider.reserve(self.header, None, None, None, criteria)
+        yield self.requester.reserve_defer
+        self.failUnlessEqual(self.provider.route_vectors.portLoad('bon'), 1)
+
+        yield self.provider.reserveAbort(self.header, acid)
+        self.failUnlessEqual(self.provider.route_vectors.portLoad('bon'), 0)
+
+        # bonaire never sends terminateConfirmed, the load is removed anyway
+        self.requester.reserve_defer = defer.Deferred()
+        self.header.newCorrelationId()
+        acid = yield self.provider.reserve(self.header, None, None, None, criteria)
+        yield self.requester.reserve_defer
+        self.failUnlessEqual(self.provider.route_vectors.portLoad('bon'), 1)
+
+        yield self.provider.terminate(self.header, acid)
+        self.failUnlessEqual(self.provider.route_vectors.portLoad('bon'), 0)
+        self.failUnlessEqual(self.provider.loaded_ports, {})
+
+
+    @defer.inlineCallbacks
+    def testPathFallbackExhausted(self):
+
+        self.provider.route_vectors.updateVector('bon', { 'curacao:topology' : 2 } )
+        self.provider.route_vectors.updateVector('dom', { 'curacao:topology' : 3 } )
+
+        for network in ('bonaire', 'dominica'):
+            self.provider.provider_registry.addProvider('urn:ogf:network:%s:nsa' % network, RemoteDUDProvider(fail=True), [ network ] )
+
+        dest_stp = nsa.STP('curacao:topology', 'ps', nsa.Label(cnt.ETHERNET_VLAN, '1782') )
+        sd = nsa.Point2PointService(self.source_stp, dest_stp, self.bandwidth, cnt.BIDIRECTIONAL, False, None)
+        criteria = nsa.Criteria(0, self.schedule, sd)
+
+        self.header.newCorrelationId()
+        try:
+            yield self.provider.reserve(self.header, None, None, None, criteria)
+            self.fail('Should have raised ConnectionCreateError')
+        except error.ConnectionCreateError as e:
+            self.failUnlessIn('2/4 reservations failed', str(e))
+
+
+    @defer.inlineCallbacks
+    def testQuerySummaryBatched(self):
+
+        self.header.newCorrelationId()
+        acid = yield self.provider.reserve(self.header, None, 'gid-batch', 'desc-batch', self.criteria)
+        yield self.requester.reserve_defer
+
+        # by global reservation id
+        self.header.newCorrelationId()
+        yield self.provider.querySummary(self.header, global_reservation_ids = [ 'gid-batch' ] )
+        header, reservations = yield self.requester.query_summary_defer
+
+        self.failUnlessEquals(len(reservations), 1)
+        ci = list(reservations)[0]
+        self.failUnlessEquals(ci.connection_id, acid)
+        self.failUnlessEquals(ci.criterias[0].service_def.source_stp.port, self.source_port)
+        self.failUnlessEquals(ci.states[3], (False, 0, False)) # data plane status, not active
+
+        # all connections of the requester
+        self.requester.query_summary_defer = defer.Deferred()
+        self.header.newCorrelationId()
+        yield self.provider.querySummary(self.header)
+        header, reservations = yield self.requester.query_summary_defer
+        self.failUnlessEquals([ ci.connection_id for ci in reservations ], [ acid ])
+
+
+    @defer.inlineCallbacks
+    def testDataPlaneCounters(self):
+
+        self.header.newCorrelationId()
+        acid = yield self.provider.reserve(self.header, None, None, None, self.criteria)
+        yield self.requester.reserve_defer
+
+        conn = yield self.provider.getConnection(acid)
+        self.failUnlessEqual( (conn.sub_connection_count, conn.data_plane_active_count, conn.data_plane_inconsistent_count), (1, 0, 1) )
+        self.failUnlessEqual(database.dataPlaneStatus(conn), (False, 0, False))
+
+        yield self.provider.reserveCommit(self.header, acid)
+        yield self.requester.reserve_commit_defer
+        yield self.provider.provision(self.header, acid)
+        yield self.requester.provision_defer
+
+        self.clock.advance(3)
+        header, cid, nid, timestamp, dps = yield self.requester.data_plane_change_defer
+
+        self.failUnlessEqual( (conn.sub_connection_count, conn.data_plane_active_count, conn.data_plane_inconsistent_count), (1, 1, 0) )
+        self.failUnlessEqual(database.dataPlaneStatus(conn), dps)
+
+        # counters are persisted
+        rows = yield database.ServiceConnection.find(where=['connection_id = ?', acid])
+        self.failUnlessEqual(database.dataPlaneStatus(rows[0]), dps)
+
+
+    @defer.inlineCallbacks
+    def testSubConnectionLoading(self):
+
+        self.header.newCorrelationId()
+        acid = yield self.provider.reserve(self.header, None, None, None, self.criteria)
+        yield self.requester.reserve_defer
+
+        conn = yield self.provider.getConnection(acid)
+        sub_conns = yield self.provider.getSubConnectionsByConnectionKey(conn.id)
+        self.failUnlessEqual(len(sub_conns), 1)
+
+        # same instance as the one from the identity cache
+        sub_conn = yield self.provider.getSubConnection(sub_conns[0].provider_nsa, sub_conns[0].connection_id)
+        self.failUnlessIdentical(sub_conns[0], sub_conn)
+
+        stats = self.provider.cacheStats()
+        self.failUnlessEqual(stats['sub_connections']['hits'] > 0, True)
+        self.failUnlessEqual(stats['connections']['size'] > 0, True)
+
+        self.provider.logCacheStats()
+        self.failUnlessEqual(self.provider.reported_lookups > 0, True)
+
+
 
 class RemoteProviderTest(GenericProviderTest, unittest.TestCase):
 
@@ -916,6 +1432,8 @@ class RemoteProviderTest(GenericProviderTest, unittest.TestCase):
     header   = nsa.NSIHeader(requester_agent.urn(), provider_agent.urn(), reply_to=requester_agent.endpoint, connection_trace=[ requester_agent.urn() + ':1' ],
                              security_attributes = [ nsa.SecurityAttribute('user', 'testuser') ] )
 
+    callback_queue = False # deliver the callbacks to the requester through an outbound queue
+
     def setUp(self):
         from twisted.web import resource, server
         from twisted.application import internet
@@ -946,7 +1464,9 @@ class RemoteProviderTest(GenericProviderTest, unittest.TestCase):
         # provider protocol
         http_top_resource = resource.Resource()
 
-        cs2_prov = nsi2.setupProvider(self.aggregator, http_top_resource)
+        self.outbound_queue = outboundqueue.OutboundQueue() if self.callback_queue else None
+
+        cs2_prov = nsi2.setupProvider(self.aggregator, http_top_resource, outbound_queue=self.outbound_queue)
         self.aggregator.parent_requester = cs2_prov
 
         provider_factory = server.Site(http_top_resource)
@@ -963,6 +1483,8 @@ class RemoteProviderTest(GenericProviderTest, unittest.TestCase):
         requester_factory = server.Site(requester_top_resource, logPath='/dev/null')
 
         # start engines!
+        if self.outbound_queue is not None:
+            self.outbound_queue.startService()
         self.backend.startService()
         self.provider_service.startService()
         self.requester_iport = reactor.listenTCP(self.REQUESTER_PORT, requester_factory)
@@ -979,6 +1501,12 @@ class RemoteProviderTest(GenericProviderTest, unittest.TestCase):
     @defer.inlineCallbacks
     def tearDown(self):
 
+        if self.outbound_queue is not None:
+            yield self.outbound_queue.stopService()
+            yield database.OutboundMessage.deleteAll()
+
+        # pooled connections would outlive the test
+        yield httpclient.closeConnections()
         self.backend.stopService()
         self.provider_service.stopService()
         self.requester_iport.stopListening()
@@ -1164,3 +1692,23 @@ class RemoteProviderTest(GenericProviderTest, unittest.TestCase):
         self.failUnlessEquals(lsm, state.CREATED)
         self.failUnlessEquals(dps[:2], (False, 0) )  # we cannot really expect a consistent result for consistent here
 
+
+
+class QueuedRemoteProviderTest(RemoteProviderTest):
+
+    callback_queue = True
+
+    @defer.inlineCallbacks
+    def testMessageDeliveryTimeout(self):
+
+        self.header.newCorrelationId()
+        msg = database.OutboundMessage(destination=self.requester_agent.endpoint, action='action', connection_id='conn-1',
+                                       correlation_id=self.header.correlation_id, requester_nsa=self.requester_agent.urn(), provider_nsa=self.provider_agent.urn())
+
+        # as if the message could not be delivered before expiring
+        self.outbound_queue.expired(msg)
+
+        header, connection_id, notification_id, timestamp, correlation_id = yield self.requester.message_delivery_timeout_defer
+        self.failUnlessEqual(connection_id, 'conn-1')
+        self.failUnlessEqual(correlation_id, self.header.correlation_id)
+        self.failUnlessEqual(header.provider_nsa, self.provider_agent.urn())
@@ -43,3 +43,20 @@ class TestProviderRegistry(unittest.TestCase):
         self.failUnlessRaises(error.STPResolutionError, self.pr.getProviderByNetwork, 'testnetwork2')
 
 
+    def testNetworkConflict(self):
+
+        agent1 = nsa.NetworkServiceAgent('test1', 'http://example.org/nsi1', cnt.CS2_SERVICE_TYPE)
+        agent2 = nsa.NetworkServiceAgent('test2', 'http://example.org/nsi2', cnt.CS2_SERVICE_TYPE)
+
+        self.pr.spawnProvider(agent1, [ 'testnetwork' ] )
+        self.pr.spawnProvider(agent2, [ 'testnetwork', 'testnetwork2' ] )
+
+        # first claim wins
+        self.failUnlessEqual(self.pr.getProviderByNetwork('testnetwork'),  cnt.URN_OGF_PREFIX + 'test1')
+        self.failUnlessEqual(self.pr.getProviderByNetwork('testnetwork2'), cnt.URN_OGF_PREFIX + 'test2')
+
+        # when the first provider drops the network, it moves to the other one
+        self.pr.spawnProvider(agent1, [ 'testnetwork3' ] )
+        self.failUnlessEqual(self.pr.getProviderByNetwork('testnetwork'),  cnt.URN_OGF_PREFIX + 'test2')
+        self.failUnlessEqual(self.pr.getProviderByNetwork('testnetwork3'), cnt.URN_OGF_PREFIX + 'test1')
+
@@ -56,7 +56,7 @@ class RestInterfaceTest(unittest.TestCase):
         # provider protocol
         http_top_resource = resource.Resource()
 
-        rest.setupService(self.aggregator, http_top_resource)
+        rest.setupService(self.aggregator, http_top_resource, backend=self.backend)
 
         # we need this for the aggregator not to blow up
         cs2_prov = nsi2.setupProvider(self.aggregator, http_top_resource)
@@ -112,6 +112,44 @@ class RestInterfaceTest(unittest.TestCase):
         self.failUnlessEqual(resp.code, 400, 'Service did not return request error')
 
 
+    @defer.inlineCallbacks
+    def testAvailability(self):
+
+        import datetime
+        from opennsa.shared import xmlhelper
+
+        agent = Agent(reactor)
+        header = Headers({'User-Agent': ['OpenNSA Test Client'], 'Host': ['localhost'] } )
+
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        start_time = now + datetime.timedelta(seconds=100)
+        end_time   = now + datetime.timedelta(seconds=200)
+        self.backend._addReservation('ps', nsa.Label('vlan', '1780'), 0, start_time, end_time)
+
+        query = 'stp=aruba:topology:ps?vlan=1780-1781&start=%s&end=%s&duration=60' % \
+                (xmlhelper.createXMLTime(now), xmlhelper.createXMLTime(now + datetime.timedelta(seconds=300)))
+        url = 'http://localhost:%i/%s?%s' % (self.PORT, rest.AVAILABILITY, query)
+
+        resp = yield agent.request('GET', url, header)
+        self.failUnlessEqual(resp.code, 200)
+        body = yield readBody(resp)
+        windows = json.loads(body)
+
+        self.failUnlessEqual([ w['label'] for w in windows ], ['vlan=1780', 'vlan=1781'])
+        self.failUnlessEqual(len(windows[0]['windows']), 2) # before and after reservation
+        self.failUnlessEqual(len(windows[1]['windows']), 1)
+
+        # more bandwidth than the port has
+        resp = yield agent.request('GET', url + '&bandwidth=100000000', header)
+        self.failUnlessEqual(resp.code, 200)
+        body = yield readBody(resp)
+        self.failUnlessEqual(json.loads(body), [])
+
+        resp = yield agent.request('GET', 'http://localhost:%i/%s?stp=aruba:topology:ps' % (self.PORT, rest.AVAILABILITY), header)
+        self.failUnlessEqual(resp.code, 400)
+        yield readBody(resp)
+
+
     @defer.inlineCallbacks
     def testCreateCommitProvision(self):
 
@@ -0,0 +1,112 @@
+import datetime
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from opennsa.backends.common import scheduler
+
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.scheduler = scheduler.CallScheduler()
+        self.scheduler.clock = self.clock
+        self.calls = []
+
+
+    def tearDown(self):
+        self.scheduler.cancelAllCalls()
+
+
+    def inSeconds(self, seconds):
+        return datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds)
+
+
+    def testSingleTimer(self):
+
+        for i in range(100):
+            self.scheduler.scheduleCall('c%i' % i, self.inSeconds(10 + i), self.calls.append, i)
+
+        self.failUnlessEqual(len(self.clock.getDelayedCalls()), 1)
+
+        self.clock.advance(5)
+        self.failUnlessEqual(self.calls, [])
+
+        self.clock.advance(10)
+        self.failUnlessEqual(self.calls, range(6))
+        self.failUnlessEqual(len(self.clock.getDelayedCalls()), 1)
+
+
+    def testSameTickBatch(self):
+
+        transition_time = self.inSeconds(5)
+        for i in range(10):
+            self.scheduler.scheduleCall('c%i' % i, transition_time, self.calls.append, i)
+
+        self.clock.advance(6)
+        self.failUnlessEqual(self.calls, range(10)) # scheduling order is kept
+        self.failUnlessEqual(self.clock.getDelayedCalls(), [])
+
+
+    def testCancelCall(self):
+
+        self.scheduler.scheduleCall('c1', self.inSeconds(5), self.calls.append, 1)
+        self.scheduler.scheduleCall('c2', self.inSeconds(3), self.calls.append, 2)
+
+        self.failUnless(self.scheduler.hasScheduledCall('c2'))
+        self.scheduler.cancelCall('c2')
+        self.failIf(self.scheduler.hasScheduledCall('c2'))
+
+        self.clock.advance(10)
+        self.failUnlessEqual(self.calls, [1])
+
+
+    def testEarlierCallRearmsTimer(self):
+
+        self.scheduler.scheduleCall('c1', self.inSeconds(50), self.calls.append, 1)
+        self.scheduler.scheduleCall('c2', self.inSeconds(5),  self.calls.append, 2)
+
+        self.clock.advance(6)
+        self.failUnlessEqual(self.calls, [2])
+        self.clock.advance(50)
+        self.failUnlessEqual(self.calls, [2, 1])
+
+
+    def testRescheduleFromCall(self):
+
+        def activate():
+            self.calls.append('activate')
+            self.scheduler.scheduleCall('c1', self.inSeconds(5), self.calls.append, 'end')
+
+        self.scheduler.scheduleCall('c1', self.inSeconds(2), activate)
+
+        self.clock.advance(3)
+        self.failUnlessEqual(self.calls, ['activate'])
+        self.clock.advance(6)
+        self.failUnlessEqual(self.calls, ['activate', 'end'])
+
+
+    def testCancelAllCalls(self):
+
+        for i in range(10):
+            self.scheduler.scheduleCall('c%i' % i, self.inSeconds(10 + i), self.calls.append, i)
+
+        self.scheduler.cancelAllCalls()
+        self.failUnlessEqual(self.clock.getDelayedCalls(), [])
+
+        self.clock.advance(30)
+        self.failUnlessEqual(self.calls, [])
+
+
+    def testPendingCalls(self):
+
+        t1, t2, t3 = self.inSeconds(3), self.inSeconds(5), self.inSeconds(7)
+        self.scheduler.scheduleCall('c1', t1, self.calls.append, 1)
+        self.scheduler.scheduleCall('c2', t2, self.calls.append, 2)
+        self.scheduler.scheduleCall('c3', t3, self.calls.append, 3)
+        self.scheduler.cancelCall('c3')
+
+        self.clock.advance(4)
+        self.failUnlessEqual(self.scheduler.pendingCalls(), [ ('c2', t2, self.calls.append, (2,)) ])
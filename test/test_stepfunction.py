@@ -0,0 +1,66 @@
+import random
+
+from twisted.trial import unittest
+
+from opennsa.backends.common import stepfunction
+
+
+
+class StepFunctionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sf = stepfunction.StepFunction()
+
+
+    def testBasicPeak(self):
+
+        self.sf.addStep(10, 20, 100)
+        self.sf.addStep(15, 30, 200)
+
+        self.failUnlessEqual(self.sf.value(5),  0)
+        self.failUnlessEqual(self.sf.value(10), 100)
+        self.failUnlessEqual(self.sf.value(20), 200) # half-open steps
+        self.failUnlessEqual(self.sf.peak(0, 10), 0)
+        self.failUnlessEqual(self.sf.peak(0, 12), 100)
+        self.failUnlessEqual(self.sf.peak(12, 40), 300)
+        self.failUnlessEqual(self.sf.peak(20, 40), 200)
+        self.failUnlessEqual(self.sf.peak(30, 40), 0)
+
+        self.sf.removeStep(15, 30, 200)
+        self.failUnlessEqual(self.sf.peak(0, 40), 100)
+        self.failUnlessRaises(KeyError, self.sf.removeStep, 15, 30, 200)
+
+
+    def testChanges(self):
+
+        self.sf.addStep(10, 20, 100)
+        self.sf.addStep(15, 20, 200)
+
+        self.failUnlessEqual(self.sf.changes(0, 40), [ (10, 100), (15, 200), (20, -300) ])
+        self.failUnlessEqual(self.sf.changes(10, 20), [ (15, 200) ]) # open interval
+        self.failUnlessEqual(self.sf.changes(20, 40), [])
+
+
+    def testRandomAgainstLinearScan(self):
+
+        rng = random.Random(4711)
+        steps = []
+
+        for _ in range(400):
+            start = rng.randint(0, 1000)
+            end = start + rng.randint(1, 100)
+            amount = rng.randint(1, 10) * 10
+            steps.append( (start, end, amount) )
+            self.sf.addStep(start, end, amount)
+
+        for start, end, amount in steps[::4]:
+            steps.remove( (start, end, amount) )
+            self.sf.removeStep(start, end, amount)
+
+        value = lambda t : sum( [ a for s,e,a in steps if s <= t < e ] )
+
+        for _ in range(200):
+            start = rng.randint(0, 1100)
+            end = start + rng.randint(1, 60)
+            expected = max( [ value(t) for t in range(start, end) ] )
+            self.failUnlessEqual(self.sf.peak(start, end), expected)
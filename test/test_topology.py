@@ -218,3 +218,98 @@ class TopologyTest(unittest.TestCase):
 
     testNoAvailableBandwidth.skip = 'Bandwidth currently not available in path finding'
 
+
+
+
+class TopologyIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.topology = nml.Topology()
+        for name, spec in ( ('aruba', topology.ARUBA_TOPOLOGY), ('bonaire', topology.BONAIRE_TOPOLOGY) ):
+            network = nml.createNMLNetwork(nrm.parsePortSpec(StringIO(spec)), name, name)
+            self.topology.addNetwork(network, nsa.NetworkServiceAgent(name + ':nsa', name + '-endpoint'))
+
+
+    def testPortLookup(self):
+
+        network_id, port = self.topology.getNetworkPort('bonaire:aru-in')
+        self.assertEquals(network_id, 'bonaire')
+        self.assertEquals(port.remote_port, 'aruba:bon-out')
+
+        self.assertRaises(error.TopologyError, self.topology.getNetworkPort, 'bonaire:nonexisting')
+        self.assertRaises(error.STPUnavailableError, self.topology.getNetwork('aruba').getPort, 'aruba:nonexisting')
+
+        self.assertEquals( [ p.id_ for p in self.topology.getNetwork('aruba').findPorts(True, exclude='aruba:ps') ],
+                           [ 'aruba:bon', 'aruba:dom', 'aruba:eth1', 'aruba:eth2' ] )
+
+
+    def testDemarcationPort(self):
+
+        aruba_bon = self.topology.getNetwork('aruba').getPort('aruba:bon')
+        self.assertEquals(self.topology.findDemarcationPort(aruba_bon), ('bonaire', 'bonaire:aru') )
+
+        # no dominica network in the topology
+        aruba_dom = self.topology.getNetwork('aruba').getPort('aruba:dom')
+        self.assertEquals(self.topology.findDemarcationPort(aruba_dom), None)
+
+
+    def testUpdateNetwork(self):
+
+        spec = topology.BONAIRE_TOPOLOGY.replace('aru ', 'aruba ')
+        network = nml.createNMLNetwork(nrm.parsePortSpec(StringIO(spec)), 'bonaire', 'bonaire')
+        self.topology.updateNetwork(network, nsa.NetworkServiceAgent('bonaire:nsa', 'bonaire-endpoint'))
+
+        self.assertEquals(self.topology.getNetworkPort('bonaire:aruba-in')[0], 'bonaire')
+        self.assertRaises(error.TopologyError, self.topology.getNetworkPort, 'bonaire:aru-in')
+        self.assertIdentical(self.topology.getNetworkPort('bonaire:ps')[1], network.getPort('bonaire:ps'))
+
+
+
+class PathFindingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.topology = nml.Topology()
+        for name, spec in ( ('aruba', topology.ARUBA_TOPOLOGY), ('bonaire', topology.BONAIRE_TOPOLOGY),
+                            ('curacao', topology.CURACAO_TOPOLOGY), ('dominica', topology.DOMINICA_TOPOLOGY) ):
+            network = nml.createNMLNetwork(nrm.parsePortSpec(StringIO(spec)), name, name)
+            self.topology.addNetwork(network, nsa.NetworkServiceAgent(name + ':nsa', name + '-endpoint'))
+
+        self.source_stp = nsa.STP('aruba',   'ps', LABEL)
+        self.dest_stp   = nsa.STP('curacao', 'ps', LABEL)
+
+
+    def testShortestPathsFirst(self):
+
+        paths = self.topology.findPaths(self.source_stp, self.dest_stp, 100)
+
+        # aruba - bonaire - dominica - curacao has no common label
+        networks = [ [ link.src_stp.network for link in path ] for path in paths ]
+        self.assertEquals(sorted(networks[:2]), [ ['aruba', 'bonaire', 'curacao'], ['aruba', 'dominica', 'curacao'] ])
+        self.assertEquals(networks[2:], [ ['aruba', 'dominica', 'bonaire', 'curacao'] ])
+
+        # no label swapping, so the label is the same through the path
+        for path in paths:
+            labels = set( [ str(link.src_stp.label) for link in path ] + [ str(link.dst_stp.label) for link in path ] )
+            self.assertEquals(len(labels), 1)
+
+        path = [ p for p in paths if len(p) == 3 and p[1].src_stp.network == 'dominica' ][0]
+        self.assertEquals(path[0].src_stp.label, nsa.Label(cnt.ETHERNET_VLAN, '1783-1786'))
+        self.assertEquals( [ (link.src_stp.port, link.dst_stp.port) for link in path ], [ ('ps', 'dom'), ('aru', 'cur'), ('dom', 'ps') ] )
+
+
+    def testLimits(self):
+
+        self.assertEquals(len(self.topology.findPaths(self.source_stp, self.dest_stp, 100, max_hops=3)), 2)
+        self.assertEquals(len(self.topology.findPaths(self.source_stp, self.dest_stp, 100, max_paths=1)), 1)
+        self.assertEquals(len(self.topology.findPaths(self.source_stp, self.dest_stp, 100, max_paths=2)), 2)
+        self.assertEquals(len(self.topology.findPaths(self.source_stp, self.dest_stp, 100, max_hops=2)), 0)
+
+        paths = self.topology.findPaths(self.source_stp, self.dest_stp, 100, exclude_networks=['bonaire'])
+        self.assertEquals( [ [ link.src_stp.network for link in path ] for path in paths ], [ ['aruba', 'dominica', 'curacao'] ])
+
+
+    def testLocalPath(self):
+
+        paths = self.topology.findPaths(self.source_stp, nsa.STP('aruba', 'bon', LABEL), 100)
+        self.assertEquals(len(paths), 1)
+        self.assertEquals(paths[0], [ nsa.Link(nsa.STP('aruba', 'ps', LABEL), nsa.STP('aruba', 'bon', LABEL)) ])